@@ -1,6 +1,7 @@
 import os
 from celery import Celery
 from celery.schedules import crontab
+from decouple import config
 
 # Set the default Django settings module for the 'celery' program.
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'bingo_rentals.settings')
@@ -15,16 +16,37 @@ app.autodiscover_tasks()
 
 # Configure periodic tasks (beat schedule)
 app.conf.beat_schedule = {
-    # Send drop-off reminders daily at 9:00 AM
+    # Reminders are scheduled per booking when it is confirmed; this daily
+    # pass only queues the ones that were missed
     'send-drop-off-reminders': {
         'task': 'notifications.tasks.send_daily_drop_off_reminders',
         'schedule': crontab(hour=9, minute=0),
     },
-    # Send pickup reminders daily at 9:00 AM
+    # Same reconciliation for pickup reminders
     'send-pickup-reminders': {
         'task': 'notifications.tasks.send_daily_pickup_reminders',
         'schedule': crontab(hour=9, minute=0),
     },
+    # Release stock held by abandoned checkouts every minute
+    'release-expired-stock-holds': {
+        'task': 'bookings.tasks.release_expired_stock_holds',
+        'schedule': 60.0,
+    },
+    # Apply Stripe webhook events stored by the webhook view
+    'drain-webhook-inbox': {
+        'task': 'bookings.tasks.drain_webhook_inbox',
+        'schedule': config('WEBHOOK_DRAIN_INTERVAL_SECONDS', default=5, cast=float),
+    },
+    # Deliver queued notifications the after-commit nudge did not reach
+    'deliver-notification-outbox': {
+        'task': 'notifications.tasks.deliver_notification_outbox',
+        'schedule': 10.0,
+    },
+    # Confirm pending bookings whose payment webhook has not arrived
+    'finalize-pending-payments': {
+        'task': 'bookings.tasks.finalize_pending_payments',
+        'schedule': 15.0,
+    },
 }
 
 @app.task(bind=True)
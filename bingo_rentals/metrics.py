@@ -0,0 +1,127 @@
+"""
+In-process latency histograms, counters and gauges.
+
+Each gunicorn worker and Celery process keeps its own registry; the staff
+metrics page and the benchmark commands read a snapshot of it. Buckets are
+fixed, so recording is a bisect and two additions under a lock and
+percentiles are estimated to the bucket's upper bound.
+"""
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Upper bounds in milliseconds; anything slower lands in the overflow bucket
+BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000)
+
+
+class Histogram:
+    """Latency distribution of one operation"""
+
+    def __init__(self, name, buckets=BUCKETS_MS):
+        self.name = name
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, ms):
+        index = bisect_left(self.buckets, ms)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total_ms += ms
+            self.max_ms = max(self.max_ms, ms)
+
+    def percentile(self, fraction):
+        """Upper bound of the bucket holding the given fraction of samples"""
+        if not self.count:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return round(min(float(bound), self.max_ms), 2)
+        return round(self.max_ms, 2)
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'mean_ms': round(self.total_ms / self.count, 2) if self.count else 0.0,
+            'p50_ms': self.percentile(0.50),
+            'p95_ms': self.percentile(0.95),
+            'p99_ms': self.percentile(0.99),
+            'max_ms': round(self.max_ms, 2),
+        }
+
+
+_histograms = {}
+_counters = {}
+_gauges = {}
+_registry_lock = threading.Lock()
+
+
+def histogram(name):
+    """The named histogram, created on first use"""
+    found = _histograms.get(name)
+    if found is None:
+        with _registry_lock:
+            found = _histograms.setdefault(name, Histogram(name))
+    return found
+
+
+def observe(name, ms):
+    histogram(name).observe(ms)
+
+
+@contextmanager
+def timer(name):
+    """Record how long the block took, including when it raises"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, (time.perf_counter() - started) * 1000)
+
+
+def incr(name, amount=1):
+    with _registry_lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+
+def gauge(name, value):
+    """Record the latest value of something, e.g. the rate of the last sweep"""
+    with _registry_lock:
+        _gauges[name] = value
+
+
+def snapshot(prefix=''):
+    """All histograms, counters and gauges whose name starts with prefix"""
+    return {
+        'histograms': {
+            name: hist.snapshot()
+            for name, hist in sorted(_histograms.items()) if name.startswith(prefix)
+        },
+        'counters': {
+            name: value
+            for name, value in sorted(_counters.items()) if name.startswith(prefix)
+        },
+        'gauges': {
+            name: value
+            for name, value in sorted(_gauges.items()) if name.startswith(prefix)
+        },
+    }
+
+
+def reset(prefix=''):
+    """Forget recorded samples, e.g. between benchmark rounds"""
+    with _registry_lock:
+        for name in [name for name in _histograms if name.startswith(prefix)]:
+            del _histograms[name]
+        for name in [name for name in _counters if name.startswith(prefix)]:
+            del _counters[name]
+        for name in [name for name in _gauges if name.startswith(prefix)]:
+            del _gauges[name]
@@ -68,6 +68,42 @@ CELERY_ACCEPT_CONTENT = ['application/json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = 'UTC'
+# Fail fast when Redis is down instead of retrying inside a web request
+CELERY_BROKER_CONNECTION_TIMEOUT = config('CELERY_BROKER_CONNECTION_TIMEOUT', default=1.0, cast=float)
+CELERY_BROKER_TRANSPORT_OPTIONS = {
+    'socket_connect_timeout': CELERY_BROKER_CONNECTION_TIMEOUT,
+    'socket_timeout': CELERY_BROKER_CONNECTION_TIMEOUT * 2,
+    # One immediate reconnect attempt when publishing, not kombu's backoff
+    'max_retries': 1,
+    'interval_start': 0,
+}
+CELERY_REDIS_SOCKET_CONNECT_TIMEOUT = CELERY_BROKER_CONNECTION_TIMEOUT
+# Notification dispatch (see notifications/dispatch.py): how long to skip the
+# broker after a failure, and the thread pool used while it is unavailable
+NOTIFICATION_BREAKER_RESET_SECONDS = config('NOTIFICATION_BREAKER_RESET_SECONDS', default=30, cast=int)
+NOTIFICATION_FALLBACK_WORKERS = config('NOTIFICATION_FALLBACK_WORKERS', default=4, cast=int)
+NOTIFICATION_FALLBACK_QUEUE_LIMIT = config('NOTIFICATION_FALLBACK_QUEUE_LIMIT', default=200, cast=int)
+# Notification outbox delivery (see notifications/outbox.py): rows per batch,
+# concurrent sends, and retry schedule for failed channels
+NOTIFICATION_OUTBOX_BATCH_SIZE = config('NOTIFICATION_OUTBOX_BATCH_SIZE', default=50, cast=int)
+NOTIFICATION_OUTBOX_WORKERS = config('NOTIFICATION_OUTBOX_WORKERS', default=8, cast=int)
+NOTIFICATION_RETRY_BASE_SECONDS = config('NOTIFICATION_RETRY_BASE_SECONDS', default=30, cast=int)
+NOTIFICATION_MAX_ATTEMPTS = config('NOTIFICATION_MAX_ATTEMPTS', default=6, cast=int)
+# A batch sends its emails and SMS at once; after this long a channel starts
+# no further sends and retries the rest. Keep both well under the outbox
+# lease (LEASE_SECONDS, 300s); 60s lets a full batch of SMS through at 1/s
+NOTIFICATION_EMAIL_TIMEOUT_SECONDS = config('NOTIFICATION_EMAIL_TIMEOUT_SECONDS', default=60, cast=float)
+NOTIFICATION_SMS_TIMEOUT_SECONDS = config('NOTIFICATION_SMS_TIMEOUT_SECONDS', default=60, cast=float)
+# Reminder sweeps queue and dispatch this many notifications per batch task
+REMINDER_SWEEP_CHUNK_SIZE = config('REMINDER_SWEEP_CHUNK_SIZE', default=200, cast=int)
+# Reminders are scheduled per booking for this local time, this many days
+# before drop-off or pickup (see notifications/reminders.py)
+REMINDER_TIME_ZONE = config('REMINDER_TIME_ZONE', default='UTC')
+REMINDER_SEND_TIME = config('REMINDER_SEND_TIME', default='09:00')
+REMINDER_DAYS_BEFORE = config('REMINDER_DAYS_BEFORE', default=1, cast=int)
+# Periodic tasks hold a cluster-wide lease while they run (see
+# bookings/leases.py); a crashed holder blocks the task for at most this long
+TASK_LEASE_SECONDS = config('TASK_LEASE_SECONDS', default=300, cast=int)
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
@@ -194,6 +230,11 @@ EMAIL_HOST_USER = config('EMAIL_HOST_USER', default='apikey')
 EMAIL_HOST_PASSWORD = config('EMAIL_HOST_PASSWORD', default='')
 DEFAULT_FROM_EMAIL = config('DEFAULT_FROM_EMAIL', default='noreply@rentals.com')
 SENDGRID_API_KEY = config('SENDGRID_API_KEY', default='')
+# Seconds any one SMTP socket operation may take, so a hung server fails the
+# send instead of blocking the worker
+EMAIL_TIMEOUT = config('EMAIL_TIMEOUT', default=10, cast=float)
+# Emails sent over one SMTP connection before reconnecting, under the provider limit
+EMAIL_BATCH_SIZE = config('EMAIL_BATCH_SIZE', default=100, cast=int)
 
 # ============================
 # Stripe Configuration
@@ -201,6 +242,29 @@ SENDGRID_API_KEY = config('SENDGRID_API_KEY', default='')
 STRIPE_PUBLIC_KEY = config('STRIPE_PUBLIC_KEY', default='pk_test_')
 STRIPE_SECRET_KEY = config('STRIPE_SECRET_KEY', default='sk_test_')
 STRIPE_WEBHOOK_SECRET = config('STRIPE_WEBHOOK_SECRET', default='')
+# 'stripe', or 'fake' for offline load tests (see bookings/gateway.py)
+PAYMENT_GATEWAY = config('PAYMENT_GATEWAY', default='stripe')
+# Point the Stripe client at a stand-in, e.g. http://127.0.0.1:12111 from run_fake_stripe
+STRIPE_API_BASE = config('STRIPE_API_BASE', default='')
+FAKE_GATEWAY_LATENCY_MS = config('FAKE_GATEWAY_LATENCY_MS', default=0, cast=float)
+FAKE_GATEWAY_FAILURE_RATE = config('FAKE_GATEWAY_FAILURE_RATE', default=0.0, cast=float)
+# Webhook inbox: events applied per batch, and failed attempts before an event
+# is set aside for replay_webhooks (the drain interval is in celery.py)
+WEBHOOK_DRAIN_BATCH_SIZE = config('WEBHOOK_DRAIN_BATCH_SIZE', default=200, cast=int)
+WEBHOOK_MAX_ATTEMPTS = config('WEBHOOK_MAX_ATTEMPTS', default=5, cast=int)
+# 'sync' verifies the payment before process_payment responds; 'async' saves a
+# pending booking at once and lets the webhook or poller confirm it
+# (see bookings/finalization.py)
+PAYMENT_FINALIZATION = config('PAYMENT_FINALIZATION', default='sync')
+PAYMENT_POLL_AFTER_SECONDS = config('PAYMENT_POLL_AFTER_SECONDS', default=20, cast=int)
+# How long the unit of a pending booking stays held while awaiting payment
+PAYMENT_FINALIZATION_TIMEOUT_SECONDS = config('PAYMENT_FINALIZATION_TIMEOUT_SECONDS', default=1800, cast=int)
+
+# ============================
+# Stock Reservation Configuration
+# ============================
+# How long a unit stays held for a customer on the payment page
+STOCK_HOLD_TTL_SECONDS = config('STOCK_HOLD_TTL_SECONDS', default=900, cast=int)
 
 # ============================
 # Twilio Configuration
@@ -208,6 +272,45 @@ STRIPE_WEBHOOK_SECRET = config('STRIPE_WEBHOOK_SECRET', default='')
 TWILIO_ACCOUNT_SID = config('TWILIO_ACCOUNT_SID', default='')
 TWILIO_AUTH_TOKEN = config('TWILIO_AUTH_TOKEN', default='')
 TWILIO_PHONE_NUMBER = config('TWILIO_PHONE_NUMBER', default='')
+# Messages per second our Twilio sender accepts (1 for a long code, more for
+# toll-free or short codes), and the burst allowed above it, per process
+TWILIO_SMS_PER_SECOND = config('TWILIO_SMS_PER_SECOND', default=1.0, cast=float)
+TWILIO_SMS_BURST = config('TWILIO_SMS_BURST', default=5, cast=int)
+# Longest a send waits for the rate limiter before giving up (and retrying later)
+TWILIO_RATE_LIMIT_WAIT_SECONDS = config('TWILIO_RATE_LIMIT_WAIT_SECONDS', default=30, cast=float)
+TWILIO_POOL_SIZE = config('TWILIO_POOL_SIZE', default=8, cast=int)
+TWILIO_TIMEOUT_SECONDS = config('TWILIO_TIMEOUT_SECONDS', default=10, cast=float)
+# Point the Twilio client at a stand-in, e.g. http://127.0.0.1:12112 from run_fake_twilio
+TWILIO_API_BASE = config('TWILIO_API_BASE', default='')
+
+# ============================
+# Cache Configuration
+# ============================
+# Defaults to the Redis that already serves as the Celery broker, so version
+# bumps (products/cache.py) and circuit breaker state reach every gunicorn
+# and Celery process. Set it empty to use per-process memory instead, e.g.
+# for a single dev server; cached copies are then reloaded after
+# LOCAL_CACHE_MAX_AGE_SECONDS, as they also are while Redis is unreachable.
+REDIS_CACHE_URL = config('REDIS_CACHE_URL', default='redis://127.0.0.1:6379/1')
+LOCAL_CACHE_MAX_AGE_SECONDS = config('LOCAL_CACHE_MAX_AGE_SECONDS', default=5, cast=int)
+if REDIS_CACHE_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_CACHE_URL,
+            # Fail fast like the broker connection when Redis is down
+            'OPTIONS': {
+                'socket_connect_timeout': CELERY_BROKER_CONNECTION_TIMEOUT,
+                'socket_timeout': CELERY_BROKER_CONNECTION_TIMEOUT * 2,
+            },
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
 
 # ============================
 # Session Configuration
@@ -0,0 +1,188 @@
+"""
+Asynchronous payment finalization.
+
+With PAYMENT_FINALIZATION = 'async', process_payment no longer waits on the
+payment gateway. It saves the booking as pending (payment_status 'pending',
+status PENDING), extends the checkout's StockHold so the unit stays
+reserved, and sends the customer straight to the confirmation page, which
+polls booking_status until the outcome is known.
+
+The booking is then finalized by whichever comes first:
+
+- the payment_intent.succeeded / payment_failed webhook, via bookings.webhooks
+- finalize_pending_payments(), which asks the gateway about bookings still
+  pending after PAYMENT_POLL_AFTER_SECONDS, in case the webhook is late,
+  lost, or arrived before the booking was saved
+
+finalize_booking() locks the booking row, so both paths can race safely and
+only the first one confirms the booking and queues its confirmation.
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from notifications.models import NotificationKind
+from notifications.outbox import queue_notification
+
+from .gateway import PaymentError, get_gateway
+from .models import Booking, BookingStatus, StockHold
+from .reservations import StockUnavailable, confirm_booking, release_hold
+
+logger = logging.getLogger(__name__)
+
+# Intent states after which the customer has to start a new checkout
+FAILED_INTENT_STATUSES = ('canceled', 'requires_payment_method')
+
+# Parallel gateway requests when polling pending bookings
+POLL_WORKERS = 8
+
+
+def record_pending_booking(booking, hold_id):
+    """
+    Save a booking whose payment is not yet verified.
+
+    The hold keeps the unit reserved until the booking is finalized, and is
+    tagged with the intent so finalization can find it.
+    """
+    booking.status = BookingStatus.PENDING
+    booking.payment_status = 'pending'
+    booking.confirmed_at = None
+    with transaction.atomic():
+        if hold_id:
+            StockHold.objects.filter(pk=hold_id).update(
+                stripe_payment_intent_id=booking.stripe_payment_intent_id,
+                expires_at=timezone.now() + timedelta(seconds=settings.PAYMENT_FINALIZATION_TIMEOUT_SECONDS),
+            )
+        booking.save()
+    return booking
+
+
+def finalize_booking(booking_pk, intent_status, charge_id='', lease=None):
+    """
+    Confirm or fail a pending booking from its PaymentIntent's status.
+
+    A payment that arrives after the stock is gone is marked 'refunding'
+    under the row lock and refunded once the outermost transaction has
+    committed (the webhook inbox finalizes inside its batch transaction),
+    so a slow gateway never holds the booking row or the ledger days.
+
+    Args:
+        lease: fenced in the booking's transaction (bookings/leases.py)
+
+    Returns:
+        str: 'confirmed', 'failed', 'refunded', or '' if nothing changed
+    """
+    with transaction.atomic():
+        if lease:
+            lease.fence()
+        outcome = _finalize_locked(booking_pk, intent_status, charge_id)
+    if outcome == 'refunded':
+        transaction.on_commit(lambda: refund_booking(booking_pk))
+    return outcome
+
+
+def _finalize_locked(booking_pk, intent_status, charge_id):
+    booking = Booking.objects.select_for_update().filter(
+        pk=booking_pk, payment_status='pending', status=BookingStatus.PENDING
+    ).first()
+    if booking is None:
+        return ''
+    hold_id = StockHold.objects.filter(
+        product_id=booking.product_id,
+        stripe_payment_intent_id=booking.stripe_payment_intent_id,
+    ).values_list('pk', flat=True).first()
+
+    if intent_status == 'succeeded':
+        booking.status = BookingStatus.CONFIRMED
+        booking.payment_status = 'paid'
+        booking.confirmed_at = timezone.now()
+        booking.stripe_charge_id = booking.stripe_charge_id or charge_id
+        try:
+            confirm_booking(booking, hold_id=hold_id)
+        except StockUnavailable as e:
+            logger.error(f'Stock lost after payment {booking.stripe_payment_intent_id}: {str(e)}')
+            Booking.objects.filter(pk=booking.pk).update(
+                status=BookingStatus.CANCELLED, payment_status='refunding', confirmed_at=None
+            )
+            return 'refunded'
+        queue_notification(NotificationKind.BOOKING_CONFIRMATION, booking)
+        return 'confirmed'
+
+    if intent_status in FAILED_INTENT_STATUSES:
+        if hold_id:
+            release_hold(hold_id)
+        Booking.objects.filter(pk=booking.pk).update(
+            status=BookingStatus.CANCELLED, payment_status='failed'
+        )
+        return 'failed'
+    return ''
+
+
+def refund_booking(booking_pk):
+    """
+    Refund a booking marked 'refunding' and mark it 'refunded'.
+
+    If the gateway call fails the booking stays 'refunding', where staff
+    can see it and refund it by hand.
+
+    Returns:
+        bool: whether the refund went through
+    """
+    intent_id = Booking.objects.filter(pk=booking_pk, payment_status='refunding').values_list(
+        'stripe_payment_intent_id', flat=True
+    ).first()
+    if intent_id is None:
+        return False
+    try:
+        get_gateway().refund(intent_id)
+    except PaymentError as e:
+        logger.error(f'Refund of PaymentIntent {intent_id} failed: {str(e)}')
+        return False
+    Booking.objects.filter(pk=booking_pk, payment_status='refunding').update(payment_status='refunded')
+    return True
+
+
+def _retrieve(intent_id):
+    try:
+        return get_gateway().retrieve_intent(intent_id)
+    except PaymentError as e:
+        logger.error(f'Could not poll PaymentIntent {intent_id}: {str(e)}')
+        return None
+
+
+def finalize_pending_payments(limit=200, lease=None):
+    """
+    Poll the gateway for bookings the webhook has not finalized yet.
+
+    Args:
+        lease: fenced for every booking finalized; LeaseLost stops the run
+
+    Returns:
+        dict: count of bookings per outcome
+    """
+    cutoff = timezone.now() - timedelta(seconds=settings.PAYMENT_POLL_AFTER_SECONDS)
+    pending = list(
+        Booking.objects.filter(
+            payment_status='pending',
+            status=BookingStatus.PENDING,
+            created_at__lte=cutoff,
+        ).exclude(stripe_payment_intent_id='')
+        .order_by('created_at')
+        .values_list('pk', 'stripe_payment_intent_id')[:limit]
+    )
+    outcomes = {}
+    if not pending:
+        return outcomes
+    with ThreadPoolExecutor(max_workers=min(POLL_WORKERS, len(pending))) as pool:
+        intents = pool.map(_retrieve, [intent_id for _, intent_id in pending])
+        for (booking_pk, _), intent in zip(pending, intents):
+            if intent is None:
+                continue
+            outcome = finalize_booking(booking_pk, intent.status, intent.latest_charge, lease=lease)
+            if outcome:
+                outcomes[outcome] = outcomes.get(outcome, 0) + 1
+    return outcomes
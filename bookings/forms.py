@@ -13,6 +13,43 @@ DISTANCE_RANGE_CHOICES = [
     ('100+', 'Beyond 100 km (Contact for quote)'),
 ]
 
+# Representative distance used to price each range
+DISTANCE_RANGE_KM = {
+    '0-30': 15,
+    '30-100': 65,
+    '100+': 150,
+}
+
+
+# Rental terms offered on the date picker
+RENTAL_MONTH_CHOICES = [
+    (1, '1 Month'),
+    (2, '2 Months'),
+    (3, '3 Months'),
+    (4, '4 Months'),
+    (5, '5 Months'),
+    (6, '6 Months'),
+    (12, '1 Year'),
+]
+
+
+class AvailabilitySearchForm(forms.Form):
+    """Find products that are in stock for a drop-off date and term"""
+    drop_off_date = forms.DateField(
+        widget=forms.DateInput(attrs={
+            'class': 'w-full px-4 py-2 border border-gray-300 rounded-lg',
+            'type': 'date',
+        })
+    )
+    rental_months = forms.TypedChoiceField(
+        choices=RENTAL_MONTH_CHOICES,
+        coerce=int,
+        initial=1,
+        widget=forms.Select(attrs={
+            'class': 'w-full px-4 py-2 border border-gray-300 rounded-lg',
+        })
+    )
+
 
 class BookingForm(forms.Form):
     """Form for capturing customer details during checkout"""
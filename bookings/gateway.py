@@ -0,0 +1,276 @@
+"""
+Payment gateway adapter.
+
+Views and tasks talk to a PaymentGateway instead of the stripe module, so
+the checkout can run against an in-process fake for offline load tests and
+every gateway call is timed into a per-operation latency histogram
+(gateway.<name>.<operation> in bingo_rentals.metrics).
+
+settings.PAYMENT_GATEWAY selects the implementation:
+    stripe  StripeGateway, optionally pointed at STRIPE_API_BASE
+    fake    FakeGateway with FAKE_GATEWAY_LATENCY_MS / FAKE_GATEWAY_FAILURE_RATE
+
+`python manage.py run_fake_stripe` serves a FakeGateway over HTTP with the
+Stripe API's URLs, so the real stripe client can be load-tested end to end
+by setting STRIPE_API_BASE to the server's address.
+"""
+import itertools
+import random
+import secrets
+import threading
+import time
+from dataclasses import dataclass, field, replace
+
+import stripe
+from django.conf import settings
+
+from bingo_rentals import metrics
+
+
+class PaymentError(Exception):
+    """A gateway call failed; the message is safe to log"""
+
+    def __init__(self, message, retryable=False):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+@dataclass(frozen=True)
+class Intent:
+    """The fields of a PaymentIntent the application uses"""
+    id: str
+    amount: int
+    status: str
+    client_secret: str = ''
+    latest_charge: str = ''
+    currency: str = 'usd'
+    metadata: dict = field(default_factory=dict)
+
+
+class PaymentGateway:
+    """Interface and timing for payment gateway calls"""
+    name = ''
+
+    def _timed(self, operation):
+        return metrics.timer(f'gateway.{self.name}.{operation}')
+
+    def _failed(self, operation):
+        metrics.incr(f'gateway.{self.name}.{operation}.errors')
+
+    def _call(self, operation, func, *args, **kwargs):
+        with self._timed(operation):
+            try:
+                return func(*args, **kwargs)
+            except PaymentError:
+                self._failed(operation)
+                raise
+
+    def create_intent(self, amount, currency='usd', metadata=None, idempotency_key=None):
+        return self._call('create_intent', self._create_intent,
+                          amount, currency, metadata or {}, idempotency_key)
+
+    def retrieve_intent(self, intent_id):
+        return self._call('retrieve_intent', self._retrieve_intent, intent_id)
+
+    def modify_intent(self, intent_id, amount=None, metadata=None):
+        return self._call('modify_intent', self._modify_intent, intent_id, amount, metadata)
+
+    def cancel_intent(self, intent_id, reason='abandoned'):
+        return self._call('cancel_intent', self._cancel_intent, intent_id, reason)
+
+    def refund(self, intent_id):
+        """Refund an intent in full; returns the refund id"""
+        return self._call('refund', self._refund, intent_id)
+
+    def construct_event(self, payload, sig_header):
+        """Verify a webhook signature locally and return the event"""
+        return stripe.Webhook.construct_event(
+            payload, sig_header, settings.STRIPE_WEBHOOK_SECRET
+        )
+
+
+class StripeGateway(PaymentGateway):
+    """Stripe's API, or a stand-in at api_base"""
+    name = 'stripe'
+
+    def __init__(self, api_key, api_base=''):
+        self.api_key = api_key
+        if api_base:
+            stripe.api_base = api_base
+
+    def _intent(self, obj):
+        return Intent(
+            id=obj.id,
+            amount=obj.amount,
+            status=obj.status,
+            client_secret=getattr(obj, 'client_secret', None) or '',
+            latest_charge=getattr(obj, 'latest_charge', None) or '',
+            currency=getattr(obj, 'currency', None) or 'usd',
+            metadata=obj.metadata.to_dict() if getattr(obj, 'metadata', None) else {},
+        )
+
+    def _stripe(self, func, *args, **kwargs):
+        try:
+            return func(*args, api_key=self.api_key, **kwargs)
+        except stripe.error.StripeError as e:
+            retryable = isinstance(e, (stripe.error.APIConnectionError, stripe.error.RateLimitError))
+            raise PaymentError(str(e), retryable=retryable) from e
+
+    def _create_intent(self, amount, currency, metadata, idempotency_key):
+        options = {'idempotency_key': idempotency_key} if idempotency_key else {}
+        return self._intent(self._stripe(
+            stripe.PaymentIntent.create,
+            amount=amount, currency=currency, metadata=metadata, **options
+        ))
+
+    def _retrieve_intent(self, intent_id):
+        return self._intent(self._stripe(stripe.PaymentIntent.retrieve, intent_id))
+
+    def _modify_intent(self, intent_id, amount, metadata):
+        changes = {}
+        if amount is not None:
+            changes['amount'] = amount
+        if metadata is not None:
+            changes['metadata'] = metadata
+        return self._intent(self._stripe(stripe.PaymentIntent.modify, intent_id, **changes))
+
+    def _cancel_intent(self, intent_id, reason):
+        return self._intent(self._stripe(
+            stripe.PaymentIntent.cancel, intent_id, cancellation_reason=reason
+        ))
+
+    def _refund(self, intent_id):
+        return self._stripe(stripe.Refund.create, payment_intent=intent_id).id
+
+
+class FakeGateway(PaymentGateway):
+    """
+    In-memory gateway with injected latency and failures.
+
+    Args:
+        latency_ms: delay added to every call
+        jitter_ms: extra random delay of up to this much
+        failure_rate: share of calls that raise a retryable PaymentError
+        auto_succeed: retrieving an intent marks it paid, standing in for
+            the customer confirming the card on the payment page
+        seed: random seed for reproducible runs
+    """
+    name = 'fake'
+
+    def __init__(self, latency_ms=0, jitter_ms=0, failure_rate=0.0, auto_succeed=True, seed=None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.failure_rate = failure_rate
+        self.auto_succeed = auto_succeed
+        self._rng = random.Random(seed)
+        self._ids = itertools.count(1)
+        self._intents = {}
+        self._idempotent = {}
+        self._lock = threading.Lock()
+
+    def _simulate(self, operation):
+        with self._lock:
+            delay = self.latency_ms + self._rng.uniform(0, self.jitter_ms)
+            fail = self._rng.random() < self.failure_rate
+        if delay:
+            time.sleep(delay / 1000)
+        if fail:
+            raise PaymentError(f'Injected failure in {operation}', retryable=True)
+
+    def _get(self, intent_id):
+        try:
+            return self._intents[intent_id]
+        except KeyError:
+            raise PaymentError(f'No such payment_intent: {intent_id}') from None
+
+    def _create_intent(self, amount, currency, metadata, idempotency_key):
+        self._simulate('create_intent')
+        with self._lock:
+            if idempotency_key in self._idempotent:
+                return self._intents[self._idempotent[idempotency_key]]
+            number = next(self._ids)
+            intent = Intent(
+                id=f'pi_fake_{number}',
+                amount=amount,
+                status='requires_payment_method',
+                client_secret=f'pi_fake_{number}_secret_{secrets.token_hex(8)}',
+                currency=currency,
+                metadata=dict(metadata),
+            )
+            self._intents[intent.id] = intent
+            if idempotency_key:
+                self._idempotent[idempotency_key] = intent.id
+            return intent
+
+    def _retrieve_intent(self, intent_id):
+        self._simulate('retrieve_intent')
+        with self._lock:
+            intent = self._get(intent_id)
+            if self.auto_succeed and intent.status == 'requires_payment_method':
+                intent = replace(intent, status='succeeded', latest_charge=f'ch_fake_{intent_id[8:]}')
+                self._intents[intent_id] = intent
+            return intent
+
+    def _modify_intent(self, intent_id, amount, metadata):
+        self._simulate('modify_intent')
+        with self._lock:
+            intent = self._get(intent_id)
+            if intent.status in ('succeeded', 'canceled'):
+                raise PaymentError(f'PaymentIntent {intent_id} is {intent.status}')
+            intent = replace(
+                intent,
+                amount=intent.amount if amount is None else amount,
+                metadata=intent.metadata if metadata is None else dict(metadata),
+            )
+            self._intents[intent_id] = intent
+            return intent
+
+    def _cancel_intent(self, intent_id, reason):
+        self._simulate('cancel_intent')
+        with self._lock:
+            intent = self._get(intent_id)
+            if intent.status in ('succeeded', 'canceled'):
+                raise PaymentError(f'PaymentIntent {intent_id} is {intent.status}')
+            intent = replace(intent, status='canceled')
+            self._intents[intent_id] = intent
+            return intent
+
+    def _refund(self, intent_id):
+        self._simulate('refund')
+        with self._lock:
+            intent = self._get(intent_id)
+            if intent.status != 'succeeded':
+                raise PaymentError(f'PaymentIntent {intent_id} has not been paid')
+            return f're_fake_{intent_id[8:]}'
+
+
+_gateway = None
+_gateway_lock = threading.Lock()
+
+
+def build_gateway():
+    """Gateway configured by settings.PAYMENT_GATEWAY"""
+    if settings.PAYMENT_GATEWAY == 'fake':
+        return FakeGateway(
+            latency_ms=settings.FAKE_GATEWAY_LATENCY_MS,
+            failure_rate=settings.FAKE_GATEWAY_FAILURE_RATE,
+        )
+    return StripeGateway(settings.STRIPE_SECRET_KEY, api_base=settings.STRIPE_API_BASE)
+
+
+def get_gateway():
+    """The process-wide payment gateway"""
+    global _gateway
+    if _gateway is None:
+        with _gateway_lock:
+            if _gateway is None:
+                _gateway = build_gateway()
+    return _gateway
+
+
+def set_gateway(gateway):
+    """Swap the process-wide gateway, e.g. for a load test; returns the old one"""
+    global _gateway
+    with _gateway_lock:
+        previous, _gateway = _gateway, gateway
+    return previous
@@ -0,0 +1,134 @@
+"""
+Cluster-wide leases for periodic tasks.
+
+Celery beat knows nothing about other beat processes: two of them, or a
+sweep that overruns and is triggered again, run the same task twice at
+once. A task wrapped in @singleton, or a sweep that calls acquire() itself,
+first takes the TaskLease row of its name:
+
+- acquiring locks the row and only succeeds on an expired lease, so exactly
+  one caller wins; the others skip the run
+- every acquisition bumps the fencing token. Lease.fence() renews the lease
+  inside the caller's transaction and raises LeaseLost if the token has
+  moved on, so a holder that stalled past its lease cannot commit work
+  after someone else took over
+- a lease whose holder died expires on its own after ttl seconds
+
+A lease is only renewed by fence(), so a holder that works for longer than
+ttl must fence at least once per ttl, e.g. once per batch as sweeps do.
+@singleton hands its lease to the task for that.
+
+The lease lives in the database rather than in Redis so that it works while
+the broker is down and so that fence() commits or rolls back together with
+the holder's writes.
+"""
+import functools
+import logging
+import os
+import socket
+import threading
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from bingo_rentals import metrics
+from .models import TaskLease
+
+logger = logging.getLogger(__name__)
+
+
+class LeaseLost(Exception):
+    """The lease expired and was taken over; the holder must stop"""
+
+
+class Lease:
+    """A held lease; token is the fencing token"""
+
+    def __init__(self, name, token, ttl):
+        self.name = name
+        self.token = token
+        self.ttl = ttl
+
+    def fence(self):
+        """
+        Renew the lease within the current transaction.
+
+        Raises:
+            LeaseLost: if the lease was taken over
+        """
+        renewed = TaskLease.objects.filter(name=self.name, token=self.token).update(
+            expires_at=timezone.now() + timedelta(seconds=self.ttl)
+        )
+        if not renewed:
+            metrics.incr(f'leases.lost.{self.name}')
+            raise LeaseLost(f'Lease {self.name} #{self.token} was taken over')
+
+    def release(self):
+        """Let the next caller take the lease right away"""
+        TaskLease.objects.filter(name=self.name, token=self.token).update(expires_at=timezone.now())
+
+
+def _owner():
+    return f'{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}'
+
+
+def acquire(name, ttl=None):
+    """
+    Take the lease on name for ttl seconds (default TASK_LEASE_SECONDS).
+
+    Returns:
+        Lease: the lease, or None if someone else holds it
+    """
+    ttl = ttl or settings.TASK_LEASE_SECONDS
+    now = timezone.now()
+    TaskLease.objects.get_or_create(name=name, defaults={'expires_at': now})
+    with transaction.atomic():
+        lease = TaskLease.objects.select_for_update().get(name=name)
+        if lease.expires_at > now:
+            metrics.incr(f'leases.busy.{name}')
+            return None
+        lease.token += 1
+        lease.owner = _owner()
+        lease.acquired_at = now
+        lease.expires_at = now + timedelta(seconds=ttl)
+        lease.save()
+    return Lease(name, lease.token, ttl)
+
+
+@contextmanager
+def held(name, ttl=None):
+    """Hold the lease on name for the block; yields None if it is taken"""
+    lease = acquire(name, ttl)
+    try:
+        yield lease
+    finally:
+        if lease:
+            lease.release()
+
+
+def singleton(func=None, *, name=None, ttl=None):
+    """
+    Run the decorated periodic task only while holding its lease, named
+    after the function unless name is given; concurrent runs are skipped.
+    Put it below @shared_task.
+
+    The task is called with the Lease as lease= and must call lease.fence()
+    in every batch's transaction, which renews the lease and stops a run
+    that was taken over; otherwise the lease runs out after ttl seconds and
+    a second run starts alongside it.
+    """
+    if func is None:
+        return functools.partial(singleton, name=name, ttl=ttl)
+    lease_name = name or f'{func.__module__}.{func.__name__}'
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with held(lease_name, ttl) as lease:
+            if lease is None:
+                logger.info(f'Skipping {lease_name}: already running elsewhere')
+                return None
+            return func(*args, lease=lease, **kwargs)
+    return wrapper
@@ -0,0 +1,166 @@
+"""
+Load-test the checkout funnel offline and report gateway latency.
+
+Each simulated customer picks dates, fills in details, renders the order
+summary twice (a refresh) and pays, through the test client. The payment
+gateway is a FakeGateway in this process, or with --http the real Stripe
+client talking to a run_fake_stripe server started on a background thread:
+    python manage.py benchmark_checkout --checkouts 200 --threads 8 --latency-ms 150
+With --finalize async, payments are confirmed afterwards by the poller
+(bookings/finalization.py), the way a late webhook would leave them.
+Confirmation notifications are queued but not delivered, so only the funnel
+is measured.
+All data created by the run is deleted at the end.
+"""
+import random
+import threading
+import time
+from datetime import timedelta
+from unittest import mock
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client
+from django.test.utils import override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from bingo_rentals import metrics
+from bookings.finalization import finalize_pending_payments
+from bookings.gateway import FakeGateway, StripeGateway, set_gateway
+from bookings.models import Booking, StockHold
+from bookings.management.commands.run_fake_stripe import make_server
+from products.models import DistanceBasedFee, Product, ProductDayOccupancy
+
+
+class Command(BaseCommand):
+    help = 'Run concurrent checkouts against a fake payment gateway'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--checkouts', type=int, default=100)
+        parser.add_argument('--threads', type=int, default=4)
+        parser.add_argument('--latency-ms', type=float, default=100)
+        parser.add_argument('--jitter-ms', type=float, default=50)
+        parser.add_argument('--failure-rate', type=float, default=0.0)
+        parser.add_argument('--http', action='store_true',
+                            help='Go through the stripe client and a local HTTP stand-in')
+        parser.add_argument('--finalize', choices=['sync', 'async'], default='sync',
+                            help='PAYMENT_FINALIZATION mode to run the checkout in')
+
+    def handle(self, *args, **options):
+        fake = FakeGateway(
+            latency_ms=options['latency_ms'],
+            jitter_ms=options['jitter_ms'],
+            failure_rate=options['failure_rate'],
+            seed=42,
+        )
+        server = None
+        if options['http']:
+            server = make_server(fake, port=0)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            gateway = StripeGateway('sk_test_fake', api_base=f'http://127.0.0.1:{server.server_port}')
+        else:
+            gateway = fake
+
+        if not DistanceBasedFee.objects.filter(is_active=True).exists():
+            self.stdout.write(self.style.WARNING('No active distance fee tiers; the 250.00 fallback applies'))
+        product = Product.objects.create(
+            name=f'Checkout Bench {timezone.now():%H%M%S%f}',
+            category='storage_pod',
+            description='Synthetic product for the checkout benchmark',
+            size_description='16ft',
+            monthly_rate=199,
+            stock_quantity=options['checkouts'],
+            image='',
+        )
+        previous = set_gateway(gateway)
+        metrics.reset('gateway.')
+        storages = {'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'}}
+        try:
+            with override_settings(STORAGES=storages, PAYMENT_FINALIZATION=options['finalize'],
+                                   PAYMENT_POLL_AFTER_SECONDS=0), \
+                    mock.patch('notifications.outbox.nudge_delivery'):
+                self.run(product, options, gateway.name)
+        finally:
+            set_gateway(previous)
+            if server:
+                server.shutdown()
+            Booking.objects.filter(product=product).delete()
+            StockHold.objects.filter(product=product).delete()
+            ProductDayOccupancy.objects.filter(product=product).delete()
+            product.delete()
+
+    def run(self, product, options, gateway_name):
+        outcomes = {'paid': 0, 'failed': 0}
+        lock = threading.Lock()
+        remaining = iter(range(options['checkouts']))
+
+        def checkout(client, rng):
+            drop_off = timezone.now().date() + timedelta(days=rng.randint(7, 60))
+            client.post(reverse('booking:select_dates', args=[product.slug]), {
+                'drop_off_date': drop_off.isoformat(),
+                'rental_months': rng.choice([1, 2, 3]),
+            })
+            client.post(reverse('booking:customer_details'), {
+                'customer_name': 'Checkout Bench',
+                'customer_email': 'bench@example.com',
+                'country_code': '+1',
+                'customer_phone': '4165550123',
+                'delivery_address': '1 Bench St',
+                'delivery_city': 'Toronto',
+                'delivery_state': 'ON',
+                'delivery_zip': 'M5H2N2',
+                'delivery_distance_range': '0-30',
+            })
+            client.get(reverse('booking:order_summary'))
+            client.get(reverse('booking:order_summary'))
+            cached_intent = client.session.get('booking_data', {}).get('payment_intent')
+            if not cached_intent:
+                return 'failed'
+            intent_id = cached_intent['id']
+            response = client.post(reverse('booking:process_payment'), {'payment_intent_id': intent_id})
+            return 'paid' if response.status_code == 200 else 'failed'
+
+        def worker(seed):
+            rng = random.Random(seed)
+            try:
+                while True:
+                    with lock:
+                        if next(remaining, None) is None:
+                            return
+                    outcome = checkout(Client(HTTP_HOST='localhost'), rng)
+                    with lock:
+                        outcomes[outcome] += 1
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker, args=(seed,)) for seed in range(options['threads'])]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        self.stdout.write(f"checkouts={options['checkouts']} threads={options['threads']} "
+                          f"paid={outcomes['paid']} failed={outcomes['failed']} "
+                          f"in {elapsed:.1f}s ({options['checkouts'] / elapsed:.1f}/s)")
+        if options['finalize'] == 'async':
+            started = time.perf_counter()
+            finalized = finalize_pending_payments(limit=options['checkouts'])
+            self.stdout.write(f"poller finalized {finalized} in {time.perf_counter() - started:.1f}s")
+        snapshot = metrics.snapshot('gateway.')
+        # With --http the stand-in's own FakeGateway timings are listed too
+        calls = sum(
+            hist['count'] for name, hist in snapshot['histograms'].items()
+            if name.startswith(f'gateway.{gateway_name}.')
+        )
+        self.stdout.write(f"gateway calls per paid checkout: {calls / max(outcomes['paid'], 1):.2f}")
+        self.stdout.write(f"{'operation':<32} {'count':>6} {'mean':>8} {'p50':>8} {'p95':>8} "
+                          f"{'p99':>8} {'max':>8} {'errors':>7}")
+        for name, hist in snapshot['histograms'].items():
+            errors = snapshot['counters'].get(f'{name}.errors', 0)
+            self.stdout.write(
+                f"{name:<32} {hist['count']:>6} {hist['mean_ms']:>8} {hist['p50_ms']:>8} "
+                f"{hist['p95_ms']:>8} {hist['p99_ms']:>8} {hist['max_ms']:>8} {errors:>7}"
+            )
@@ -0,0 +1,75 @@
+"""
+Re-apply stored Stripe webhook events, or report the inbox backlog.
+
+    python manage.py replay_webhooks --stats
+    python manage.py replay_webhooks --failed
+    python manage.py replay_webhooks --event evt_123 --event evt_456
+    python manage.py replay_webhooks --type charge.succeeded --since 2025-06-01
+
+Selected events are marked pending again and drained in this process, so
+the handlers in bookings.webhooks run on them a second time.
+"""
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from bingo_rentals import metrics
+from bookings.models import WebhookEvent
+from bookings.webhooks import drain_inbox, inbox_stats
+
+
+class Command(BaseCommand):
+    help = 'Replay stored Stripe webhook events'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--event', action='append', default=[], help='Event id, repeatable')
+        parser.add_argument('--type', help='Only events of this type')
+        parser.add_argument('--since', help='Only events received on or after this date or datetime')
+        parser.add_argument('--failed', action='store_true', help='Only events whose last attempt raised')
+        parser.add_argument('--dry-run', action='store_true', help='Count the events without replaying')
+        parser.add_argument('--stats', action='store_true', help='Only print the inbox backlog')
+
+    def handle(self, *args, **options):
+        if options['stats']:
+            return self.print_stats()
+
+        events = WebhookEvent.objects.all()
+        if options['event']:
+            events = events.filter(event_id__in=options['event'])
+        if options['type']:
+            events = events.filter(event_type=options['type'])
+        if options['since']:
+            events = events.filter(received_at__gte=self.parse_since(options['since']))
+        if options['failed']:
+            events = events.exclude(last_error='')
+        if not any(options[key] for key in ('event', 'type', 'since', 'failed')):
+            raise CommandError('Select events with --event, --type, --since or --failed')
+
+        count = events.count()
+        if options['dry_run']:
+            self.stdout.write(f'{count} events would be replayed')
+            return
+        events.update(processed_at=None, attempts=0, last_error='')
+        metrics.reset('webhooks.')
+        applied = drain_inbox()
+        self.stdout.write(self.style.SUCCESS(f'Replayed {count} events, applied {applied}'))
+        self.print_stats()
+
+    def parse_since(self, value):
+        moment = parse_datetime(value)
+        if moment is None:
+            day = parse_date(value)
+            if day is None:
+                raise CommandError(f'Invalid --since: {value}')
+            moment = timezone.datetime.combine(day, timezone.datetime.min.time())
+        if timezone.is_naive(moment):
+            moment = timezone.make_aware(moment)
+        return moment
+
+    def print_stats(self):
+        stats = inbox_stats()
+        self.stdout.write(f"pending={stats['pending']} oldest_pending_age={stats['oldest_pending_age_s']}s "
+                          f"failed={stats['failed']}")
+        for name, hist in metrics.snapshot('webhooks.')['histograms'].items():
+            self.stdout.write(f"{name:<26} count={hist['count']} p50={hist['p50_ms']}ms "
+                              f"p95={hist['p95_ms']}ms max={hist['max_ms']}ms")
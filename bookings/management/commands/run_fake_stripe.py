@@ -0,0 +1,139 @@
+"""
+Serve a FakeGateway over HTTP with the Stripe API's URLs.
+
+Lets the real stripe client, and so StripeGateway, be load-tested offline:
+    python manage.py run_fake_stripe --port 12111 --latency-ms 120 --failure-rate 0.01
+    STRIPE_API_BASE=http://127.0.0.1:12111 gunicorn bingo_rentals.wsgi
+Only the PaymentIntent and Refund calls the checkout makes are implemented.
+"""
+import json
+import re
+from dataclasses import asdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+from django.core.management.base import BaseCommand
+
+from bingo_rentals import metrics
+from bookings.gateway import FakeGateway, PaymentError
+
+INTENT_URL = re.compile(r'^/v1/payment_intents/(?P<id>[\w]+)(?P<cancel>/cancel)?$')
+METADATA_KEY = re.compile(r'^metadata\[(?P<key>[^\]]+)\]$')
+
+
+def parse_form(body):
+    """Stripe-style form body, with metadata[key]=value collected into a dict"""
+    params = {'metadata': {}}
+    for key, values in parse_qs(body.decode(), keep_blank_values=True).items():
+        match = METADATA_KEY.match(key)
+        if match:
+            params['metadata'][match['key']] = values[-1]
+        else:
+            params[key] = values[-1]
+    return params
+
+
+def intent_json(intent):
+    return {'object': 'payment_intent', **asdict(intent), 'latest_charge': intent.latest_charge or None}
+
+
+class FakeStripeHandler(BaseHTTPRequestHandler):
+    gateway = None
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _error(self, error):
+        if error.retryable:
+            self._reply(500, {'error': {'type': 'api_error', 'message': str(error)}})
+        else:
+            self._reply(400, {'error': {'type': 'invalid_request_error', 'message': str(error)}})
+
+    def do_GET(self):
+        match = INTENT_URL.match(self.path)
+        if not match or match['cancel']:
+            return self._reply(404, {'error': {'type': 'invalid_request_error', 'message': 'Unknown URL'}})
+        with metrics.timer('fake_stripe.retrieve_intent'):
+            try:
+                self._reply(200, intent_json(self.gateway.retrieve_intent(match['id'])))
+            except PaymentError as e:
+                self._error(e)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        params = parse_form(self.rfile.read(length))
+        match = INTENT_URL.match(self.path)
+        try:
+            if self.path == '/v1/payment_intents':
+                intent = self.gateway.create_intent(
+                    amount=int(params['amount']),
+                    currency=params.get('currency', 'usd'),
+                    metadata=params['metadata'],
+                    idempotency_key=self.headers.get('Idempotency-Key'),
+                )
+                return self._reply(200, intent_json(intent))
+            if self.path == '/v1/refunds':
+                refund_id = self.gateway.refund(params['payment_intent'])
+                return self._reply(200, {'object': 'refund', 'id': refund_id,
+                                         'payment_intent': params['payment_intent']})
+            if match and match['cancel']:
+                intent = self.gateway.cancel_intent(
+                    match['id'], reason=params.get('cancellation_reason', 'abandoned')
+                )
+                return self._reply(200, intent_json(intent))
+            if match:
+                intent = self.gateway.modify_intent(
+                    match['id'],
+                    amount=int(params['amount']) if 'amount' in params else None,
+                    metadata=params['metadata'] or None,
+                )
+                return self._reply(200, intent_json(intent))
+        except PaymentError as e:
+            return self._error(e)
+        self._reply(404, {'error': {'type': 'invalid_request_error', 'message': 'Unknown URL'}})
+
+
+def make_server(gateway, host='127.0.0.1', port=12111):
+    """ThreadingHTTPServer answering Stripe API calls from the given FakeGateway"""
+    handler = type('Handler', (FakeStripeHandler,), {'gateway': gateway})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+class Command(BaseCommand):
+    help = 'Run a local Stripe API stand-in with injected latency and failures'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=12111)
+        parser.add_argument('--latency-ms', type=float, default=0)
+        parser.add_argument('--jitter-ms', type=float, default=0)
+        parser.add_argument('--failure-rate', type=float, default=0.0)
+        parser.add_argument('--seed', type=int, default=None)
+
+    def handle(self, *args, **options):
+        gateway = FakeGateway(
+            latency_ms=options['latency_ms'],
+            jitter_ms=options['jitter_ms'],
+            failure_rate=options['failure_rate'],
+            seed=options['seed'],
+        )
+        server = make_server(gateway, options['host'], options['port'])
+        self.stdout.write(f"Fake Stripe listening on http://{options['host']}:{options['port']} "
+                          f"(latency {options['latency_ms']}ms, failure rate {options['failure_rate']})")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
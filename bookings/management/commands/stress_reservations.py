@@ -0,0 +1,161 @@
+"""
+Multi-threaded oversell stress test for the reservation subsystem.
+
+Many threads race to hold and confirm units of one product for overlapping
+dates. Afterwards the command checks that no day has more confirmed bookings
+than stock and that the ledger matches the bookings table, then reports the
+sustained throughput.
+
+Run against PostgreSQL for meaningful row-locking results:
+    python manage.py stress_reservations --threads 64 --checkouts 2000 --stock 25
+All data created by the run is deleted at the end.
+"""
+import random
+import threading
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+
+from bookings.models import Booking, BookingStatus, StockHold
+from bookings.reservations import (
+    StockUnavailable,
+    confirm_booking,
+    place_hold,
+    release_expired_holds,
+)
+from products.availability import daterange, occupancy_from_intervals
+from products.ledger import rebuild_ledger
+from products.models import Product, ProductDayOccupancy
+
+
+class Command(BaseCommand):
+    help = 'Race concurrent checkouts against the stock ledger and check for oversell'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=32)
+        parser.add_argument('--checkouts', type=int, default=1000)
+        parser.add_argument('--stock', type=int, default=10)
+        parser.add_argument('--abandon-rate', type=float, default=0.2,
+                            help='Share of checkouts that never pay and let the hold expire')
+        parser.add_argument('--days', type=int, default=14,
+                            help='Spread drop-off dates over this many days')
+
+    def handle(self, *args, **options):
+        if connection.vendor == 'sqlite':
+            self.stdout.write(self.style.WARNING(
+                'SQLite ignores SELECT ... FOR UPDATE and serializes writers; '
+                'expect "database is locked" errors. Use PostgreSQL for real numbers.'
+            ))
+
+        product = Product.objects.create(
+            name=f'Stress Pod {timezone.now():%H%M%S%f}',
+            category='storage_pod',
+            description='Synthetic product for the reservation stress test',
+            size_description='16ft',
+            monthly_rate=199,
+            stock_quantity=options['stock'],
+            image='',
+        )
+        try:
+            self.run(product, options)
+        finally:
+            Booking.objects.filter(product=product).delete()
+            StockHold.objects.filter(product=product).delete()
+            ProductDayOccupancy.objects.filter(product=product).delete()
+            product.delete()
+
+    def run(self, product, options):
+        first_day = timezone.now().date() + timedelta(days=30)
+        counters = {'confirmed': 0, 'sold_out': 0, 'abandoned': 0, 'errors': 0}
+        lock = threading.Lock()
+        remaining = iter(range(options['checkouts']))
+
+        def checkout(rng):
+            drop_off = first_day + timedelta(days=rng.randrange(options['days']))
+            hold = place_hold(product, drop_off, 1, ttl_seconds=300)
+            if rng.random() < options['abandon_rate']:
+                StockHold.objects.filter(pk=hold.pk).update(expires_at=timezone.now())
+                return 'abandoned'
+            booking = Booking(
+                product=product,
+                customer_name='Stress',
+                customer_email='stress@example.com',
+                customer_phone='4165550123',
+                delivery_address='1 Stress St',
+                delivery_city='Toronto',
+                delivery_state='ON',
+                delivery_zip='M5H2N2',
+                drop_off_date=drop_off,
+                rental_months=1,
+                monthly_rate=product.monthly_rate,
+                status=BookingStatus.CONFIRMED,
+                payment_status='paid',
+            )
+            confirm_booking(booking, hold_id=hold.pk)
+            return 'confirmed'
+
+        def worker(seed):
+            rng = random.Random(seed)
+            try:
+                while True:
+                    with lock:
+                        if next(remaining, None) is None:
+                            return
+                    try:
+                        outcome = checkout(rng)
+                    except StockUnavailable:
+                        outcome = 'sold_out'
+                    except Exception as e:
+                        outcome = 'errors'
+                        self.stderr.write(f'{type(e).__name__}: {e}')
+                    with lock:
+                        counters[outcome] += 1
+                    if outcome == 'abandoned' or rng.random() < 0.05:
+                        release_expired_holds()
+            finally:
+                connection.close()
+
+        threads = [
+            threading.Thread(target=worker, args=(seed,))
+            for seed in range(options['threads'])
+        ]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        release_expired_holds()
+
+        oversold = self._oversold_days(product, first_day, options['days'])
+        drift = rebuild_ledger([product.id], dry_run=True)
+
+        self.stdout.write(
+            f"checkouts={options['checkouts']} threads={options['threads']} "
+            f"stock={options['stock']}"
+        )
+        for outcome, count in counters.items():
+            self.stdout.write(f'  {outcome:<10} {count}')
+        self.stdout.write(f'  throughput {options["checkouts"] / elapsed:.1f} checkouts/s '
+                          f'over {elapsed:.2f}s')
+        self.stdout.write(f'  oversold days {len(oversold)}, ledger drift {len(drift)}')
+
+        if oversold or drift:
+            raise CommandError(f'Oversell detected on {oversold[:5]} / drift {drift[:5]}')
+        self.stdout.write(self.style.SUCCESS('Zero oversell'))
+
+    def _oversold_days(self, product, first_day, days):
+        """Days on which confirmed bookings exceed stock, counted from the bookings table"""
+        last_day = first_day + timedelta(days=days + 62)
+        intervals = Booking.objects.filter(product=product).overlapping(
+            first_day, last_day
+        ).values_list('drop_off_date', 'expected_end_date')
+        occupancy = occupancy_from_intervals(intervals, first_day, last_day)
+        return [
+            (day, booked)
+            for day, booked in zip(daterange(first_day, last_day), occupancy)
+            if booked > product.stock_quantity
+        ]
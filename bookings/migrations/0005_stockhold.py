@@ -0,0 +1,42 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:58
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bookings', '0004_booking_delivery_distance_km'),
+        ('products', '0006_productdayoccupancy_held_units'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='booking',
+            name='monthly_rate',
+            field=models.DecimalField(decimal_places=2, help_text='Rate at time of booking (HST included)', max_digits=10),
+        ),
+        migrations.AlterField(
+            model_name='booking',
+            name='transport_fee',
+            field=models.DecimalField(decimal_places=2, default=250.0, help_text='Transport/delivery+removal fee at time of booking (HST included)', max_digits=10),
+        ),
+        migrations.CreateModel(
+            name='StockHold',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('drop_off_date', models.DateField()),
+                ('end_date', models.DateField(help_text='Last day the held unit is out')),
+                ('rental_months', models.IntegerField(default=1)),
+                ('session_key', models.CharField(blank=True, max_length=40)),
+                ('stripe_payment_intent_id', models.CharField(blank=True, max_length=200)),
+                ('expires_at', models.DateTimeField(db_index=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stock_holds', to='products.product')),
+            ],
+            options={
+                'ordering': ['expires_at'],
+            },
+        ),
+    ]
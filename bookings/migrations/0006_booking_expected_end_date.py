@@ -0,0 +1,59 @@
+# Generated by Django 5.2.18 on 2026-10-17 02:02
+
+import calendar
+
+from django.db import migrations, models
+
+
+# Frozen copies of the products.availability helpers as they were when this
+# migration was written, so later changes to them cannot alter it
+
+def add_months(start_date, months):
+    month_index = start_date.month - 1 + months
+    year = start_date.year + month_index // 12
+    month = month_index % 12 + 1
+    day = min(start_date.day, calendar.monthrange(year, month)[1])
+    return start_date.replace(year=year, month=month, day=day)
+
+
+def rental_end_date(drop_off_date, pickup_date, rental_months):
+    if pickup_date:
+        return pickup_date
+    return add_months(drop_off_date, rental_months)
+
+
+def backfill_expected_end_date(apps, schema_editor):
+    Booking = apps.get_model('bookings', 'Booking')
+    batch = []
+    for booking in Booking.objects.only(
+        'pk', 'drop_off_date', 'pickup_date', 'rental_months'
+    ).iterator(chunk_size=1000):
+        booking.expected_end_date = rental_end_date(
+            booking.drop_off_date, booking.pickup_date, booking.rental_months
+        )
+        batch.append(booking)
+        if len(batch) >= 1000:
+            Booking.objects.bulk_update(batch, ['expected_end_date'])
+            batch = []
+    Booking.objects.bulk_update(batch, ['expected_end_date'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bookings', '0005_stockhold'),
+        ('products', '0006_productdayoccupancy_held_units'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='booking',
+            name='expected_end_date',
+            field=models.DateField(blank=True, editable=False, help_text='Last day the unit is out: pickup date if scheduled, else drop-off + rental months', null=True),
+        ),
+        migrations.RunPython(backfill_expected_end_date, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='booking',
+            index=models.Index(fields=['product', 'status', 'drop_off_date', 'expected_end_date'], name='booking_overlap_idx'),
+        ),
+    ]
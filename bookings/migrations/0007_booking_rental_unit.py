@@ -0,0 +1,20 @@
+# Generated by Django 5.2.18 on 2026-10-17 02:06
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bookings', '0006_booking_expected_end_date'),
+        ('products', '0007_rentalunit'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='booking',
+            name='rental_unit',
+            field=models.ForeignKey(blank=True, help_text='Physical unit assigned by the allocator', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='bookings', to='products.rentalunit'),
+        ),
+    ]
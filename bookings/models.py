@@ -1,6 +1,9 @@
-from django.db import models
+from collections import defaultdict
+from django.db import models, transaction
+from datetime import date
 from django.core.validators import MinValueValidator
 from products.models import Product, PricingSetting
+from products.availability import active_statuses, rental_end_date
 import uuid
 
 
@@ -13,6 +16,143 @@ class BookingStatus(models.TextChoices):
     CANCELLED = 'cancelled', 'Cancelled'
 
 
+# Fields that decide which days a booking occupies a unit
+OCCUPANCY_FIELDS = ('product', 'status', 'drop_off_date', 'pickup_date', 'rental_months')
+
+# Fields expected_end_date is derived from
+END_DATE_FIELDS = {'drop_off_date', 'pickup_date', 'rental_months'}
+
+
+def _touches_occupancy(field_names):
+    """Whether a write to these fields (or their *_id attnames) can move a booking's interval"""
+    return bool({name.removesuffix('_id') for name in field_names} & set(OCCUPANCY_FIELDS))
+
+
+class BookingQuerySet(models.QuerySet):
+    """
+    Keeps expected_end_date, the occupancy ledger and unit assignments in
+    sync through bulk operations, as Booking.save() and delete() do for
+    single bookings.
+    """
+    
+    def overlapping(self, start_date, end_date):
+        """Active bookings holding a unit on any day from start_date to end_date"""
+        return self.filter(
+            status__in=active_statuses(),
+            drop_off_date__lte=end_date,
+            expected_end_date__gte=start_date,
+        )
+    
+    def update(self, **kwargs):
+        if not _touches_occupancy(kwargs):
+            return super().update(**kwargs)
+        
+        with transaction.atomic(using=self.db):
+            previous = self._lock_intervals()
+            # Write exactly the rows that were locked, not whatever matches now
+            bookings = self.model.objects.filter(pk__in=previous)
+            pickup_date = kwargs.get('pickup_date')
+            if kwargs.keys() & END_DATE_FIELDS == {'pickup_date'} and isinstance(pickup_date, (date, str)):
+                # A concrete pickup date is the end date, so it can be set in SQL
+                updated = super(BookingQuerySet, bookings).update(expected_end_date=pickup_date, **kwargs)
+            else:
+                updated = super(BookingQuerySet, bookings).update(**kwargs)
+                if END_DATE_FIELDS & kwargs.keys():
+                    bookings.sync_expected_end_dates()
+            bookings._sync_occupancy(previous)
+        return updated
+    
+    def bulk_create(self, objs, batch_size=None, ignore_conflicts=False, update_conflicts=False, **kwargs):
+        if ignore_conflicts or update_conflicts:
+            # Skipped or merged rows come back without a pk, so there is no
+            # telling which intervals reached the ledger
+            raise ValueError('Bookings cannot be bulk created with ignore_conflicts or update_conflicts')
+        objs = list(objs)
+        for obj in objs:
+            obj.expected_end_date = obj.compute_expected_end_date()
+        with transaction.atomic(using=self.db):
+            created = super().bulk_create(objs, batch_size=batch_size, **kwargs)
+            self.model.objects.filter(pk__in=[obj.pk for obj in created])._sync_occupancy(
+                dict.fromkeys(obj.pk for obj in created)
+            )
+        return created
+    
+    def bulk_update(self, objs, fields, *args, **kwargs):
+        # Each batch is written through update() above, which moves the ledger
+        if END_DATE_FIELDS & set(fields):
+            objs = list(objs)
+            for obj in objs:
+                obj.expected_end_date = obj.compute_expected_end_date()
+            fields = [*fields, 'expected_end_date']
+        return super().bulk_update(objs, fields, *args, **kwargs)
+    
+    def delete(self):
+        from products.ledger import move_intervals
+        with transaction.atomic(using=self.db):
+            previous = self._lock_intervals()
+            deleted = super(BookingQuerySet, self.model.objects.filter(pk__in=previous)).delete()
+            move_intervals([(interval, None) for interval in previous.values()])
+        return deleted
+    
+    def _lock_intervals(self):
+        """Lock these bookings until commit and return {pk: stored occupancy interval}"""
+        return {
+            booking.pk: booking.occupancy_interval()
+            for booking in self.select_for_update(of=('self',)).only(*OCCUPANCY_FIELDS).order_by('pk')
+        }
+    
+    def _sync_occupancy(self, previous):
+        """
+        Move the ledger and unit assignments of these bookings after a bulk
+        write, given {pk: occupancy interval} from before it.
+        """
+        from products.allocation import allocate_booking, allocate_unassigned
+        from products.ledger import move_intervals
+        from products.models import RentalUnit
+        
+        moved = [
+            booking
+            for booking in self.only('pk', 'rental_unit', *OCCUPANCY_FIELDS).order_by('pk')
+            if booking.occupancy_interval() != previous.get(booking.pk)
+        ]
+        if not moved:
+            return
+        move_intervals([(previous.get(booking.pk), booking.occupancy_interval()) for booking in moved])
+        
+        tracked = set(RentalUnit.objects.filter(
+            product_id__in={booking.product_id for booking in moved}
+        ).values_list('product_id', flat=True).distinct())
+        holding = [booking for booking in moved if booking.occupancy_interval() and booking.product_id in tracked]
+        holding_pks = {booking.pk for booking in holding}
+        freed = [booking.pk for booking in moved if booking.rental_unit_id and booking.pk not in holding_pks]
+        if freed:
+            self.model.objects.filter(pk__in=freed).update(rental_unit=None)
+        
+        if any(previous.get(booking.pk) for booking in holding):
+            for booking in holding:
+                allocate_booking(booking)
+            return
+        # Only new intervals: bookings that came with a unit keep it, the
+        # rest are placed together, longest rentals first
+        first_days = defaultdict(list)
+        for booking in holding:
+            if not booking.rental_unit_id:
+                first_days[booking.product_id].append(booking.drop_off_date)
+        for product_id in sorted(first_days):
+            allocate_unassigned(product_id, min(first_days[product_id]))
+    
+    def sync_expected_end_dates(self, batch_size=1000):
+        """Recompute expected_end_date for every booking in this queryset"""
+        changed = []
+        for booking in self.only('pk', 'expected_end_date', *END_DATE_FIELDS).iterator(chunk_size=batch_size):
+            expected_end_date = booking.compute_expected_end_date()
+            if booking.expected_end_date != expected_end_date:
+                booking.expected_end_date = expected_end_date
+                changed.append(booking)
+        self.model.objects.bulk_update(changed, ['expected_end_date'], batch_size=batch_size)
+        return len(changed)
+
+
 class Booking(models.Model):
     """Main booking model for guest checkout"""
     # Unique identifier
@@ -28,6 +168,14 @@ class Booking(models.Model):
         on_delete=models.PROTECT,
         related_name='bookings'
     )
+    rental_unit = models.ForeignKey(
+        'products.RentalUnit',
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='bookings',
+        help_text="Physical unit assigned by the allocator"
+    )
     
     # Customer information (guest checkout - no user account)
     customer_name = models.CharField(max_length=200)
@@ -54,6 +202,12 @@ class Booking(models.Model):
         default=1,
         validators=[MinValueValidator(1)]
     )
+    expected_end_date = models.DateField(
+        null=True,
+        blank=True,
+        editable=False,
+        help_text="Last day the unit is out: pickup date if scheduled, else drop-off + rental months"
+    )
     
     # Pricing (all prices include HST)
     monthly_rate = models.DecimalField(
@@ -73,7 +227,7 @@ class Booking(models.Model):
     )
     
     # Payment information
-    stripe_payment_intent_id = models.CharField(max_length=200, blank=True)
+    stripe_payment_intent_id = models.CharField(max_length=200, blank=True, db_index=True)
     stripe_charge_id = models.CharField(max_length=200, blank=True)
     payment_status = models.CharField(
         max_length=20,
@@ -81,6 +235,7 @@ class Booking(models.Model):
         choices=[
             ('pending', 'Pending'),
             ('paid', 'Paid'),
+            ('refunding', 'Refund Pending'),
             ('refunded', 'Refunded'),
             ('failed', 'Failed'),
         ]
@@ -109,22 +264,112 @@ class Booking(models.Model):
         indexes = [
             models.Index(fields=['status', 'drop_off_date']),
             models.Index(fields=['customer_email']),
+            models.Index(
+                fields=['product', 'status', 'drop_off_date', 'expected_end_date'],
+                name='booking_overlap_idx'
+            ),
+            # Keyset pages of the dashboard order list (dashboard/pagination.py)
+            models.Index(fields=['-created_at', '-id'], name='booking_created_keyset_idx'),
+            models.Index(fields=['status', '-created_at', '-id'], name='booking_status_keyset_idx'),
         ]
     
+    objects = BookingQuerySet.as_manager()
+    
     def __str__(self):
         return f"{self.booking_id} - {self.customer_name} - {self.product.name}"
     
     def calculate_total(self):
         """Calculate total booking amount"""
-        monthly_cost = self.monthly_rate * self.rental_months
-        total = monthly_cost + self.transport_fee
-        return total
+        from products.pricing import quote
+        return quote(self.monthly_rate, self.rental_months, self.transport_fee).total
+    
+    def compute_expected_end_date(self):
+        """Pickup date if scheduled, otherwise the end of the paid term"""
+        return rental_end_date(self.drop_off_date, self.pickup_date, self.rental_months)
+    
+    def occupancy_interval(self):
+        """(product_id, first_day, last_day) while this booking holds a unit, else None"""
+        if self.status not in active_statuses():
+            return None
+        return (self.product_id, self.drop_off_date, self.compute_expected_end_date())
+    
+    def _stored_occupancy_interval(self):
+        """Occupancy interval as currently saved, locking the row until commit"""
+        if self._state.adding or self.pk is None:
+            return None
+        stored = Booking.objects.select_for_update().filter(pk=self.pk).only(
+            *OCCUPANCY_FIELDS
+        ).first()
+        return stored.occupancy_interval() if stored else None
     
     def save(self, *args, **kwargs):
         # Auto-calculate total if not set
         if not self.total_amount:
             self.total_amount = self.calculate_total()
-        super().save(*args, **kwargs)
+        
+        # Dates may arrive as ISO strings from the session
+        for field_name in ('drop_off_date', 'pickup_date'):
+            field = self._meta.get_field(field_name)
+            setattr(self, field_name, field.to_python(getattr(self, field_name)))
+        
+        self.expected_end_date = self.compute_expected_end_date()
+        
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and END_DATE_FIELDS & set(update_fields):
+            kwargs['update_fields'] = {*update_fields, 'expected_end_date'}
+            update_fields = kwargs['update_fields']
+        if update_fields is not None and not set(update_fields) & set(OCCUPANCY_FIELDS):
+            super().save(*args, **kwargs)
+            return
+        
+        # Keep the occupancy ledger in step within the same transaction
+        from products.allocation import allocate_booking
+        from products.ledger import move_interval
+        with transaction.atomic():
+            previous = self._stored_occupancy_interval()
+            super().save(*args, **kwargs)
+            current = self.occupancy_interval()
+            move_interval(previous, current)
+            if current != previous:
+                allocate_booking(self)
+    
+    def delete(self, *args, **kwargs):
+        from products.ledger import move_interval
+        with transaction.atomic():
+            previous = self._stored_occupancy_interval()
+            result = super().delete(*args, **kwargs)
+            move_interval(previous, None)
+        return result
+
+
+class StockHold(models.Model):
+    """Short-lived reservation of one unit while a customer completes payment"""
+    product = models.ForeignKey(
+        Product,
+        on_delete=models.CASCADE,
+        related_name='stock_holds'
+    )
+    drop_off_date = models.DateField()
+    end_date = models.DateField(help_text="Last day the held unit is out")
+    rental_months = models.IntegerField(default=1)
+    session_key = models.CharField(max_length=40, blank=True)
+    stripe_payment_intent_id = models.CharField(max_length=200, blank=True)
+    expires_at = models.DateTimeField(db_index=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        ordering = ['expires_at']
+    
+    def __str__(self):
+        return f"Hold on {self.product_id} from {self.drop_off_date} until {self.expires_at}"
+    
+    def matches(self, product_id, drop_off_date, rental_months):
+        """True if this hold covers the same product, date and term"""
+        return (
+            self.product_id == product_id
+            and self.drop_off_date.isoformat() == str(drop_off_date)
+            and self.rental_months == rental_months
+        )
 
 
 class PickupRequest(models.Model):
@@ -162,3 +407,52 @@ class PickupRequest(models.Model):
     
     def __str__(self):
         return f"Pickup for {self.booking.booking_id}"
+
+
+class WebhookEvent(models.Model):
+    """
+    Append-only inbox of verified Stripe webhook events.
+
+    The webhook view only stores the event and returns 200; bookings.webhooks
+    applies pending events in batches. Stripe retries deliveries, so event_id
+    is unique and a redelivered event is dropped on insert.
+    """
+    event_id = models.CharField(max_length=255, unique=True)
+    event_type = models.CharField(max_length=100)
+    payload = models.JSONField()
+    created = models.DateTimeField(null=True, blank=True, help_text="When Stripe created the event")
+    received_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+    attempts = models.IntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    
+    class Meta:
+        ordering = ['received_at']
+        indexes = [
+            models.Index(
+                fields=['received_at'],
+                condition=models.Q(processed_at__isnull=True),
+                name='webhookevent_pending_idx',
+            ),
+        ]
+    
+    def __str__(self):
+        return f"{self.event_type} {self.event_id}"
+
+
+class TaskLease(models.Model):
+    """
+    Cluster-wide lease on a periodic task (see bookings/leases.py).
+
+    token goes up by one every time the lease changes hands and is the
+    fencing token: a holder whose lease expired and was taken over can no
+    longer write under it.
+    """
+    name = models.CharField(max_length=100, primary_key=True)
+    token = models.BigIntegerField(default=0)
+    owner = models.CharField(max_length=200, blank=True)
+    acquired_at = models.DateTimeField(null=True, blank=True)
+    expires_at = models.DateTimeField()
+    
+    def __str__(self):
+        return f"{self.name} #{self.token} ({self.owner})"
@@ -0,0 +1,119 @@
+"""
+PaymentIntent reuse for the checkout funnel.
+
+order_summary used to create a new PaymentIntent on every render, so each
+refresh cost a Stripe round trip and left an orphaned intent behind. The
+intent is now cached in the checkout session together with a hash of the
+quote it was created for:
+
+- unchanged quote: the cached intent is returned without calling Stripe
+- changed quote: the existing intent is modified in place
+- new checkout or lost hold: one intent is created, with an idempotency key
+  so concurrent renders of the same checkout share it
+
+Intents are only reused while the checkout's StockHold is alive. When the
+sweeper releases an expired hold it cancels the hold's intent, see
+cancel_payment_intents().
+"""
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from .gateway import PaymentError, get_gateway
+
+logger = logging.getLogger(__name__)
+
+# Parallel gateway requests when cancelling abandoned intents
+CANCEL_WORKERS = 8
+
+
+def quote_hash(product, booking_data, quote):
+    """Fingerprint of everything a checkout's PaymentIntent was created for"""
+    parts = (
+        product.id,
+        booking_data['drop_off_date'],
+        booking_data['rental_months'],
+        booking_data['customer_email'],
+        quote.total_cents,
+    )
+    return hashlib.sha256('|'.join(map(str, parts)).encode()).hexdigest()[:24]
+
+
+def _intent_params(product, booking_data, quote):
+    return {
+        'amount': quote.total_cents,  # Stripe uses cents
+        'metadata': {
+            'product_name': product.name,
+            'customer_email': booking_data['customer_email'],
+            'drop_off_date': booking_data['drop_off_date'],
+        },
+    }
+
+
+def checkout_intent(session, product, booking_data, quote, hold):
+    """
+    The PaymentIntent for this checkout, creating or updating it only when needed.
+
+    The cache entry lives in booking_data['payment_intent'] and is tied to
+    the hold, because the hold sweeper cancels the intents of expired holds.
+
+    Returns:
+        tuple: (intent_id, client_secret)
+    """
+    fingerprint = quote_hash(product, booking_data, quote)
+    cached = booking_data.get('payment_intent')
+
+    if cached and cached['hold_id'] == hold.id:
+        if cached['quote_hash'] == fingerprint:
+            return cached['id'], cached['client_secret']
+        try:
+            intent = get_gateway().modify_intent(
+                cached['id'], **_intent_params(product, booking_data, quote)
+            )
+        except PaymentError as e:
+            # Already paid or cancelled: fall through and start a new one
+            logger.error(f'PaymentIntent {cached["id"]} could not be updated: {str(e)}')
+        else:
+            return _remember(session, booking_data, intent, hold, fingerprint)
+
+    intent = get_gateway().create_intent(
+        currency='usd',
+        idempotency_key=f'checkout-{session.session_key}-{hold.id}-{fingerprint}',
+        **_intent_params(product, booking_data, quote),
+    )
+    return _remember(session, booking_data, intent, hold, fingerprint)
+
+
+def _remember(session, booking_data, intent, hold, fingerprint):
+    booking_data['payment_intent'] = {
+        'id': intent.id,
+        'client_secret': intent.client_secret,
+        'hold_id': hold.id,
+        'quote_hash': fingerprint,
+    }
+    session.modified = True
+    return intent.id, intent.client_secret
+
+
+def _cancel(intent_id):
+    try:
+        get_gateway().cancel_intent(intent_id, reason='abandoned')
+        return True
+    except PaymentError as e:
+        # Paid or already cancelled intents cannot be cancelled; nothing to do
+        logger.info(f'PaymentIntent {intent_id} not cancelled: {str(e)}')
+        return False
+
+
+def cancel_payment_intents(intent_ids):
+    """
+    Cancel abandoned PaymentIntents, several requests at a time.
+
+    Returns:
+        int: number of intents cancelled
+    """
+    intent_ids = sorted(set(filter(None, intent_ids)))
+    if not intent_ids:
+        return 0
+    with ThreadPoolExecutor(max_workers=min(CANCEL_WORKERS, len(intent_ids))) as pool:
+        return sum(pool.map(_cancel, intent_ids))
@@ -0,0 +1,183 @@
+"""
+Oversell-proof stock reservation.
+
+order_summary places a StockHold on one unit before the PaymentIntent is
+created. process_payment turns the hold into a confirmed booking with
+confirm_booking(). Both steps lock the product's ledger rows for the rental
+interval (in day order) and re-check capacity under that lock, so concurrent
+checkouts can never book more units than stock_quantity. Expired holds are
+released in bulk by release_expired_holds().
+"""
+from collections import Counter
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from products.availability import rental_end_date
+from products.ledger import apply_interval, lock_days
+from products.models import Product
+from .models import StockHold
+
+
+class StockUnavailable(Exception):
+    """Raised when no unit is free for every day of the requested interval"""
+
+
+def _check_capacity(product, locked_days):
+    """Raise StockUnavailable unless one more unit fits on every locked day"""
+    for row in locked_days:
+        if row.booked_units + row.held_units + 1 > product.stock_quantity:
+            raise StockUnavailable(
+                f'{product.name} is fully booked on {row.day:%b %d, %Y}'
+            )
+
+
+def _release(hold):
+    """Give a hold's unit back to the ledger and delete it"""
+    apply_interval(hold.product_id, hold.drop_off_date, hold.end_date, -1, field='held_units')
+    hold.delete()
+
+
+def place_hold(product, drop_off_date, rental_months, session_key='', ttl_seconds=None):
+    """
+    Reserve one unit of a product for the whole rental interval.
+
+    Args:
+        product: Product to reserve
+        drop_off_date: date (or ISO string) of delivery
+        rental_months: paid term in months
+        session_key: checkout session that owns the hold
+        ttl_seconds: hold lifetime, defaults to settings.STOCK_HOLD_TTL_SECONDS
+
+    Returns:
+        StockHold
+
+    Raises:
+        StockUnavailable: if any day of the interval is already full
+    """
+    drop_off_date = StockHold._meta.get_field('drop_off_date').to_python(drop_off_date)
+    end_date = rental_end_date(drop_off_date, None, rental_months)
+    if ttl_seconds is None:
+        ttl_seconds = settings.STOCK_HOLD_TTL_SECONDS
+
+    with transaction.atomic():
+        locked_days = lock_days(product.id, drop_off_date, end_date)
+        # Stock may have been edited since the product was loaded
+        product = Product.objects.get(pk=product.pk)
+        _check_capacity(product, locked_days)
+
+        apply_interval(product.id, drop_off_date, end_date, 1, field='held_units')
+        return StockHold.objects.create(
+            product=product,
+            drop_off_date=drop_off_date,
+            end_date=end_date,
+            rental_months=rental_months,
+            session_key=session_key or '',
+            expires_at=timezone.now() + timedelta(seconds=ttl_seconds),
+        )
+
+
+def release_hold(hold_id):
+    """
+    Release a hold early, e.g. when the customer changes their order.
+
+    Returns:
+        bool: False if the hold was already gone
+    """
+    with transaction.atomic():
+        hold = StockHold.objects.select_for_update().filter(pk=hold_id).first()
+        if hold:
+            _release(hold)
+        return hold is not None
+
+
+def confirm_booking(booking, hold_id=None):
+    """
+    Save a confirmed booking, converting its hold atomically.
+
+    The hold (if still present) is released and the booking is saved in the
+    same transaction, under a lock on the ledger rows of the booking's
+    interval. If the hold has already been swept, the booking only succeeds
+    when a unit is still free.
+
+    Args:
+        booking: unsaved Booking with an active status
+        hold_id: StockHold placed for this checkout, if any
+
+    Returns:
+        Booking: the saved booking
+
+    Raises:
+        StockUnavailable: if the hold was lost and the interval is now full
+    """
+    with transaction.atomic():
+        hold = None
+        if hold_id:
+            hold = StockHold.objects.select_for_update().filter(pk=hold_id).first()
+
+        booking.drop_off_date = booking._meta.get_field('drop_off_date').to_python(
+            booking.drop_off_date
+        )
+        _, first_day, last_day = booking.occupancy_interval()
+        lock_days(booking.product_id, first_day, last_day)
+        if hold:
+            _release(hold)
+        # Re-read the locked rows now that our own hold is no longer counted
+        locked_days = lock_days(booking.product_id, first_day, last_day)
+
+        product = Product.objects.get(pk=booking.product_id)
+        _check_capacity(product, locked_days)
+        booking.save()
+        return booking
+
+
+def release_expired_holds(batch_size=500, abandoned_intents=None, lease=None):
+    """
+    Release every expired hold in bulk.
+
+    Holds that a checkout is confirming right now are row-locked and skipped.
+    Holds sharing the same interval are released with one ledger update.
+
+    Args:
+        batch_size: holds released per transaction
+        abandoned_intents: list that receives the PaymentIntent ids of the
+            released holds, for the caller to cancel
+        lease: fenced in every batch's transaction (bookings/leases.py)
+
+    Returns:
+        int: number of holds released
+    """
+    released = 0
+    while True:
+        with transaction.atomic():
+            if lease:
+                lease.fence()
+            holds = list(
+                StockHold.objects.select_for_update(skip_locked=True).filter(
+                    expires_at__lte=timezone.now()
+                ).values_list(
+                    'pk', 'product_id', 'drop_off_date', 'end_date', 'stripe_payment_intent_id'
+                )[:batch_size]
+            )
+            if not holds:
+                return released
+
+            intervals = Counter(
+                (product_id, first, last) for _, product_id, first, last, _ in holds
+            )
+            # Lock each product's whole span up front, in day order, so the
+            # per-interval updates below never lock days out of order
+            spans = {}
+            for product_id, first_day, last_day in intervals:
+                low, high = spans.get(product_id, (first_day, last_day))
+                spans[product_id] = (min(low, first_day), max(high, last_day))
+            for product_id, (first_day, last_day) in sorted(spans.items()):
+                lock_days(product_id, first_day, last_day)
+            for (product_id, first_day, last_day), count in intervals.items():
+                apply_interval(product_id, first_day, last_day, -count, field='held_units')
+            StockHold.objects.filter(pk__in=[pk for pk, *_ in holds]).delete()
+            released += len(holds)
+            if abandoned_intents is not None:
+                abandoned_intents.extend(intent_id for *_, intent_id in holds if intent_id)
@@ -0,0 +1,58 @@
+from celery import shared_task
+from . import finalization
+from .leases import singleton
+from .payments import cancel_payment_intents
+from .reservations import release_expired_holds
+from .webhooks import drain_inbox
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+@shared_task
+@singleton
+def release_expired_stock_holds(lease=None):
+    """Give units held by abandoned checkouts back to the pool and cancel their payments"""
+    abandoned_intents = []
+    try:
+        released = release_expired_holds(abandoned_intents=abandoned_intents, lease=lease)
+        if released:
+            logger.info(f'Released {released} expired stock holds')
+    except Exception as e:
+        logger.error(f'Error releasing expired stock holds: {str(e)}')
+    
+    try:
+        cancelled = cancel_payment_intents(abandoned_intents)
+        if cancelled:
+            logger.info(f'Cancelled {cancelled} abandoned PaymentIntents')
+    except Exception as e:
+        logger.error(f'Error cancelling abandoned PaymentIntents: {str(e)}')
+
+
+@shared_task
+def drain_webhook_inbox():
+    """
+    Apply Stripe webhook events stored by the webhook view.
+
+    Not a @singleton: drain_inbox() claims events with SKIP LOCKED and
+    holds their row locks until the batch commits, so overlapping runs
+    split the backlog instead of applying an event twice.
+    """
+    try:
+        applied = drain_inbox()
+        if applied:
+            logger.info(f'Applied {applied} webhook events')
+    except Exception as e:
+        logger.error(f'Error draining webhook inbox: {str(e)}')
+
+
+@shared_task
+@singleton
+def finalize_pending_payments(lease=None):
+    """Ask the gateway about pending bookings the webhook has not finalized"""
+    try:
+        outcomes = finalization.finalize_pending_payments(lease=lease)
+        if outcomes:
+            logger.info(f'Finalized pending bookings: {outcomes}')
+    except Exception as e:
+        logger.error(f'Error finalizing pending payments: {str(e)}')
@@ -1,3 +1,693 @@
-from django.test import TestCase
+import threading
+from datetime import date, timedelta
+from decimal import Decimal
 
-# Create your tests here.
+from django.contrib.sessions.backends.db import SessionStore
+from django.db import connection, transaction
+from django.db.models import F
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from notifications.models import NotificationKind, NotificationOutbox
+from products.availability import active_statuses, rental_end_date
+from products.ledger import ensure_days, rebuild_ledger
+from products.models import DistanceBasedFee, PricingSetting, Product, ProductDayOccupancy, RentalUnit
+from products.pricing import quote
+from . import leases
+from .finalization import finalize_booking, finalize_pending_payments, record_pending_booking
+from .gateway import FakeGateway, set_gateway
+from .models import Booking, BookingStatus, StockHold, TaskLease, WebhookEvent
+from .payments import cancel_payment_intents, checkout_intent, quote_hash
+from .reservations import (
+    StockUnavailable,
+    confirm_booking,
+    place_hold,
+    release_expired_holds,
+    release_hold,
+)
+from .webhooks import drain_inbox
+
+LOCAL_CACHE = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+# The manifest storage needs collectstatic before any page renders
+PLAIN_STATIC = {'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'}}
+
+DROP_OFF = date(2030, 3, 1)
+
+
+def make_product(stock_quantity=2, **fields):
+    return Product.objects.create(
+        name=fields.pop('name', 'Test Pod'),
+        category='storage_pod',
+        description='Test product',
+        size_description='16ft',
+        monthly_rate=fields.pop('monthly_rate', 199),
+        stock_quantity=stock_quantity,
+        image='',
+        **fields,
+    )
+
+
+def make_booking(product, **fields):
+    values = {
+        'customer_name': 'Test Customer',
+        'customer_email': 'customer@example.com',
+        'customer_phone': '4165550000',
+        'delivery_address': '1 Test St',
+        'delivery_city': 'Toronto',
+        'delivery_state': 'ON',
+        'delivery_zip': 'M5H2N2',
+        'drop_off_date': DROP_OFF,
+        'rental_months': 2,
+        'monthly_rate': product.monthly_rate,
+        'status': BookingStatus.CONFIRMED,
+        'payment_status': 'paid',
+    }
+    values.update(fields)
+    return Booking(product=product, **values)
+
+
+def ledger_units(product, day):
+    """(booked_units, held_units) stored for a product's day"""
+    row = ProductDayOccupancy.objects.filter(product=product, day=day).first()
+    return (row.booked_units, row.held_units) if row else (0, 0)
+
+
+def webhook_event(event_id, event_type, obj):
+    return WebhookEvent.objects.create(
+        event_id=event_id,
+        event_type=event_type,
+        payload={'id': event_id, 'type': event_type, 'data': {'object': obj}},
+    )
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class WebhookInboxTests(TestCase):
+    def test_mixed_batch_keeps_finalized_booking(self):
+        product = make_product()
+        hold = place_hold(product, DROP_OFF, 2)
+        pending = record_pending_booking(
+            make_booking(product, stripe_payment_intent_id='pi_pending'), hold.pk
+        )
+        paid_later = make_booking(product, stripe_payment_intent_id='pi_other', payment_status='pending')
+        paid_later.save()
+
+        webhook_event('evt_1', 'payment_intent.succeeded', {'object': 'payment_intent', 'id': 'pi_pending'})
+        webhook_event('evt_2', 'charge.succeeded', {'object': 'charge', 'id': 'ch_1', 'payment_intent': 'pi_pending'})
+        webhook_event('evt_3', 'payment_intent.payment_failed', {'object': 'payment_intent', 'id': 'pi_other'})
+        self.assertEqual(drain_inbox(), 3)
+
+        pending.refresh_from_db()
+        self.assertEqual(pending.status, BookingStatus.CONFIRMED)
+        self.assertEqual(pending.payment_status, 'paid')
+        self.assertEqual(pending.stripe_charge_id, 'ch_1')
+        paid_later.refresh_from_db()
+        self.assertEqual(paid_later.payment_status, 'failed')
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class ReservationTests(TestCase):
+    def setUp(self):
+        self.product = make_product(stock_quantity=2)
+        self.last_day = rental_end_date(DROP_OFF, None, 2)
+
+    def assertLedgerConsistent(self):
+        self.assertEqual(rebuild_ledger([self.product.id], dry_run=True), [])
+
+    def test_hold_counts_every_day_of_the_term(self):
+        place_hold(self.product, DROP_OFF, 2)
+        for day in (DROP_OFF, self.last_day):
+            self.assertEqual(ledger_units(self.product, day), (0, 1))
+        self.assertEqual(ledger_units(self.product, self.last_day + timedelta(days=1)), (0, 0))
+        self.assertLedgerConsistent()
+
+    def test_holds_cannot_exceed_stock(self):
+        place_hold(self.product, DROP_OFF, 2)
+        place_hold(self.product, self.last_day, 1)
+        # Overlaps both on its last day
+        with self.assertRaises(StockUnavailable):
+            place_hold(self.product, self.last_day - timedelta(days=10), 1)
+        self.assertEqual(StockHold.objects.count(), 2)
+        self.assertLedgerConsistent()
+
+    def test_confirm_moves_the_hold_to_a_booking(self):
+        hold = place_hold(self.product, DROP_OFF, 2)
+        booking = confirm_booking(make_booking(self.product), hold_id=hold.pk)
+        self.assertIsNotNone(booking.pk)
+        self.assertFalse(StockHold.objects.filter(pk=hold.pk).exists())
+        self.assertEqual(ledger_units(self.product, DROP_OFF), (1, 0))
+        self.assertLedgerConsistent()
+
+    def test_confirm_uses_its_own_hold_on_the_last_unit(self):
+        place_hold(self.product, DROP_OFF, 2)
+        hold = place_hold(self.product, DROP_OFF, 2)
+        confirm_booking(make_booking(self.product), hold_id=hold.pk)
+        self.assertEqual(ledger_units(self.product, DROP_OFF), (1, 1))
+        self.assertLedgerConsistent()
+
+    def test_confirm_without_hold_fails_when_full(self):
+        place_hold(self.product, DROP_OFF, 2)
+        place_hold(self.product, DROP_OFF, 2)
+        with self.assertRaises(StockUnavailable):
+            confirm_booking(make_booking(self.product))
+        self.assertFalse(Booking.objects.exists())
+        self.assertEqual(ledger_units(self.product, DROP_OFF), (0, 2))
+
+    def test_release_hold_is_idempotent(self):
+        hold = place_hold(self.product, DROP_OFF, 2)
+        self.assertTrue(release_hold(hold.pk))
+        self.assertFalse(release_hold(hold.pk))
+        self.assertEqual(ledger_units(self.product, DROP_OFF), (0, 0))
+
+    def test_release_expired_holds_only_releases_expired(self):
+        expired = [place_hold(self.product, DROP_OFF, 2), place_hold(self.product, DROP_OFF, 1)]
+        StockHold.objects.filter(pk__in=[hold.pk for hold in expired]).update(
+            expires_at=timezone.now() - timedelta(seconds=1), stripe_payment_intent_id='pi_abandoned'
+        )
+        other = make_product(stock_quantity=1, name='Other Pod')
+        kept = place_hold(other, DROP_OFF, 2)
+
+        abandoned = []
+        self.assertEqual(release_expired_holds(abandoned_intents=abandoned), 2)
+        self.assertEqual(abandoned, ['pi_abandoned', 'pi_abandoned'])
+        self.assertEqual(list(StockHold.objects.values_list('pk', flat=True)), [kept.pk])
+        self.assertEqual(ledger_units(self.product, DROP_OFF), (0, 0))
+        self.assertEqual(ledger_units(other, DROP_OFF), (0, 1))
+        self.assertLedgerConsistent()
+
+    def test_release_expired_holds_stops_once_its_lease_is_lost(self):
+        hold = place_hold(self.product, DROP_OFF, 2)
+        StockHold.objects.filter(pk=hold.pk).update(expires_at=timezone.now() - timedelta(seconds=1))
+        stale = leases.acquire('holds', ttl=60)
+        TaskLease.objects.filter(name='holds').update(expires_at=timezone.now())
+        self.assertIsNotNone(leases.acquire('holds', ttl=60))
+
+        with self.assertRaises(leases.LeaseLost):
+            release_expired_holds(lease=stale)
+        self.assertTrue(StockHold.objects.filter(pk=hold.pk).exists())
+        self.assertEqual(ledger_units(self.product, DROP_OFF), (0, 1))
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class ExpectedEndDateTests(TestCase):
+    def setUp(self):
+        self.product = make_product(stock_quantity=10)
+
+    def stored_end(self, booking):
+        return Booking.objects.values_list('expected_end_date', flat=True).get(pk=booking.pk)
+
+    def test_save_tracks_the_term_and_the_pickup(self):
+        booking = make_booking(self.product, drop_off_date=date(2030, 1, 31), rental_months=1)
+        booking.save()
+        self.assertEqual(self.stored_end(booking), date(2030, 2, 28))
+
+        booking.rental_months = 3
+        booking.save(update_fields=['rental_months'])
+        self.assertEqual(self.stored_end(booking), date(2030, 4, 30))
+
+        booking.pickup_date = date(2030, 2, 10)
+        booking.save()
+        self.assertEqual(self.stored_end(booking), date(2030, 2, 10))
+
+    def test_update_and_bulk_update_keep_it_in_sync(self):
+        booking = make_booking(self.product)
+        booking.save()
+        bookings = Booking.objects.filter(pk=booking.pk)
+
+        bookings.update(pickup_date=date(2030, 3, 20))
+        self.assertEqual(self.stored_end(booking), date(2030, 3, 20))
+        bookings.update(pickup_date=None, rental_months=3)
+        self.assertEqual(self.stored_end(booking), date(2030, 6, 1))
+        bookings.update(drop_off_date=F('drop_off_date') + timedelta(days=30))
+        self.assertEqual(self.stored_end(booking), date(2030, 6, 30))
+
+        booking.refresh_from_db()
+        booking.rental_months = 1
+        Booking.objects.bulk_update([booking], ['rental_months'])
+        self.assertEqual(self.stored_end(booking), date(2030, 4, 30))
+        self.assertEqual(rebuild_ledger([self.product.id], dry_run=True), [])
+
+    def test_overlapping_matches_rental_end_date(self):
+        rows = [
+            (date(2030, 1, 31), None, 1, BookingStatus.CONFIRMED),
+            (date(2030, 2, 10), date(2030, 2, 12), 6, BookingStatus.IN_PROGRESS),
+            (date(2030, 2, 27), None, 2, BookingStatus.PICKUP_SCHEDULED),
+            (date(2030, 3, 1), date(2030, 3, 1), 1, BookingStatus.CONFIRMED),
+            (date(2030, 2, 1), None, 3, BookingStatus.CANCELLED),
+            (date(2030, 2, 1), None, 3, BookingStatus.COMPLETED),
+        ]
+        bookings = []
+        for drop_off, pickup, months, status in rows:
+            booking = make_booking(
+                self.product, drop_off_date=drop_off, pickup_date=pickup, rental_months=months, status=status
+            )
+            booking.save()
+            bookings.append(booking)
+
+        windows = [
+            (date(2030, 2, 28), date(2030, 2, 28)),
+            (date(2030, 3, 1), date(2030, 3, 1)),
+            (date(2030, 2, 13), date(2030, 2, 26)),
+            (date(2030, 1, 1), date(2030, 1, 30)),
+            (date(2030, 4, 27), date(2030, 5, 31)),
+        ]
+        for start_date, end_date in windows:
+            # The old filter: the rental end date worked out per booking in Python
+            expected = {
+                booking.pk for booking in bookings
+                if booking.status in active_statuses()
+                and booking.drop_off_date <= end_date
+                and rental_end_date(booking.drop_off_date, booking.pickup_date, booking.rental_months) >= start_date
+            }
+            found = set(Booking.objects.overlapping(start_date, end_date).values_list('pk', flat=True))
+            self.assertEqual(found, expected, (start_date, end_date))
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class BulkWriteLedgerTests(TestCase):
+    def setUp(self):
+        self.product = make_product(stock_quantity=3)
+        self.units = [
+            RentalUnit.objects.create(serial_number=f'UNIT-{i}', product=self.product)
+            for i in range(2)
+        ]
+
+    def assertLedgerConsistent(self):
+        self.assertEqual(rebuild_ledger(dry_run=True), [])
+
+    def test_bulk_create_books_the_ledger_and_places_units(self):
+        Booking.objects.bulk_create([make_booking(self.product, total_amount=398) for _ in range(3)])
+        self.assertEqual(ledger_units(self.product, DROP_OFF), (3, 0))
+        self.assertLedgerConsistent()
+        # Two tracked units for three overlapping bookings
+        placed = Booking.objects.filter(rental_unit__isnull=False).values_list('rental_unit', flat=True)
+        self.assertEqual(sorted(placed), [unit.pk for unit in self.units])
+
+    def test_bulk_create_refuses_conflict_handling(self):
+        with self.assertRaises(ValueError):
+            Booking.objects.bulk_create([make_booking(self.product, total_amount=398)], ignore_conflicts=True)
+
+    def test_update_moves_and_frees_intervals(self):
+        booking = make_booking(self.product)
+        booking.save()
+        new_end = DROP_OFF + timedelta(days=5)
+        Booking.objects.filter(pk=booking.pk).update(pickup_date=new_end)
+        self.assertEqual(ledger_units(self.product, new_end), (1, 0))
+        self.assertEqual(ledger_units(self.product, new_end + timedelta(days=1)), (0, 0))
+        self.assertLedgerConsistent()
+
+        Booking.objects.filter(pk=booking.pk).update(status=BookingStatus.COMPLETED)
+        self.assertEqual(ledger_units(self.product, DROP_OFF), (0, 0))
+        booking.refresh_from_db()
+        self.assertIsNone(booking.rental_unit_id)
+        self.assertLedgerConsistent()
+
+    def test_bulk_update_moves_to_another_product(self):
+        other = make_product(name='Other Pod')
+        bookings = [make_booking(self.product) for _ in range(2)]
+        for booking in bookings:
+            booking.save()
+            booking.product = other
+            booking.drop_off_date = DROP_OFF + timedelta(days=10)
+        Booking.objects.bulk_update(bookings, ['product', 'drop_off_date'])
+        self.assertEqual(ledger_units(self.product, DROP_OFF), (0, 0))
+        self.assertEqual(ledger_units(other, DROP_OFF + timedelta(days=10)), (2, 0))
+        # The units belong to the old product, so neither booking keeps one
+        self.assertFalse(Booking.objects.filter(rental_unit__isnull=False).exists())
+        self.assertLedgerConsistent()
+
+    def test_bulk_update_of_many_intervals_nets_per_day(self):
+        bookings = [make_booking(self.product, pickup_date=DROP_OFF + timedelta(days=i)) for i in range(3)]
+        for booking in bookings:
+            booking.save()
+        for booking in bookings:
+            booking.pickup_date += timedelta(days=2)
+        Booking.objects.bulk_update(bookings, ['pickup_date'])
+        self.assertEqual(ledger_units(self.product, DROP_OFF + timedelta(days=4)), (1, 0))
+        self.assertLedgerConsistent()
+
+    def test_queryset_delete_gives_the_days_back(self):
+        for _ in range(2):
+            make_booking(self.product).save()
+        Booking.objects.filter(product=self.product).delete()
+        self.assertEqual(ledger_units(self.product, DROP_OFF), (0, 0))
+        self.assertLedgerConsistent()
+
+
+class RecordingGateway(FakeGateway):
+    """FakeGateway that records each call's operation and arguments"""
+
+    def __init__(self, **kwargs):
+        super().__init__(auto_succeed=False, **kwargs)
+        self.calls = []
+
+    def _call(self, operation, func, *args, **kwargs):
+        self.calls.append((operation, args))
+        return super()._call(operation, func, *args, **kwargs)
+
+    def operations(self):
+        return [operation for operation, _ in self.calls]
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class CheckoutIntentTests(TestCase):
+    def setUp(self):
+        self.gateway = RecordingGateway()
+        self.addCleanup(set_gateway, set_gateway(self.gateway))
+        self.product = make_product()
+        self.session = SessionStore()
+        self.session.create()
+        self.hold = place_hold(self.product, DROP_OFF, 2, session_key=self.session.session_key)
+        self.booking_data = {
+            'drop_off_date': DROP_OFF.isoformat(),
+            'rental_months': 2,
+            'customer_email': 'customer@example.com',
+        }
+
+    def intent(self, quote, hold=None):
+        return checkout_intent(self.session, self.product, self.booking_data, quote, hold or self.hold)
+
+    def test_unchanged_quote_reuses_the_intent_without_a_call(self):
+        first = self.intent(quote(199, 2, 250))
+        self.assertEqual(self.gateway.operations(), ['create_intent'])
+        self.session.modified = False
+        self.assertEqual(self.intent(quote('199.00', 2, Decimal('250'))), first)
+        self.assertEqual(self.gateway.operations(), ['create_intent'])
+        self.assertFalse(self.session.modified)
+
+    def test_changed_quote_updates_the_intent_in_place(self):
+        intent_id, _ = self.intent(quote(199, 2, 250))
+        self.assertEqual(self.intent(quote(199, 2, 300))[0], intent_id)
+        self.assertEqual(self.gateway.operations(), ['create_intent', 'modify_intent'])
+        self.assertEqual(self.gateway.retrieve_intent(intent_id).amount, 69800)
+        self.assertEqual(
+            self.booking_data['payment_intent']['quote_hash'],
+            quote_hash(self.product, self.booking_data, quote(199, 2, 300)),
+        )
+
+    def test_intent_that_cannot_be_updated_is_replaced(self):
+        intent_id, _ = self.intent(quote(199, 2, 250))
+        self.gateway.cancel_intent(intent_id)
+        self.assertNotEqual(self.intent(quote(199, 2, 300))[0], intent_id)
+
+    def test_idempotency_key_names_the_session_hold_and_quote(self):
+        price = quote(199, 2, 250)
+        intent_id, _ = self.intent(price)
+        _, args = self.gateway.calls[0]
+        self.assertEqual(
+            args[-1],
+            f'checkout-{self.session.session_key}-{self.hold.id}-'
+            f'{quote_hash(self.product, self.booking_data, price)}',
+        )
+        # A concurrent render that has not seen the cached entry gets the same intent
+        del self.booking_data['payment_intent']
+        self.assertEqual(self.intent(price)[0], intent_id)
+        # A new hold is a new checkout
+        other_hold = place_hold(self.product, DROP_OFF, 2, session_key=self.session.session_key)
+        self.assertNotEqual(self.intent(price, hold=other_hold)[0], intent_id)
+
+    def test_cancel_payment_intents(self):
+        open_ids = [self.gateway.create_intent(100).id for _ in range(2)]
+        paid = self.gateway.create_intent(100)
+        self.gateway.auto_succeed = True
+        self.gateway.retrieve_intent(paid.id)
+        self.gateway.calls.clear()
+
+        self.assertEqual(cancel_payment_intents([*open_ids, open_ids[0], paid.id, '', None]), 2)
+        self.assertEqual(self.gateway.operations(), ['cancel_intent'] * 3)
+        statuses = [self.gateway.retrieve_intent(intent_id).status for intent_id in [*open_ids, paid.id]]
+        self.assertEqual(statuses, ['canceled', 'canceled', 'succeeded'])
+        self.assertEqual(cancel_payment_intents([]), 0)
+
+
+@override_settings(CACHES=LOCAL_CACHE, PAYMENT_POLL_AFTER_SECONDS=0)
+class FinalizationTests(TestCase):
+    def setUp(self):
+        self.gateway = RecordingGateway()
+        self.addCleanup(set_gateway, set_gateway(self.gateway))
+        self.product = make_product(stock_quantity=1)
+        self.hold = place_hold(self.product, DROP_OFF, 2)
+        intent = self.gateway.create_intent(64800)
+        self.booking = record_pending_booking(
+            make_booking(self.product, stripe_payment_intent_id=intent.id), self.hold.pk
+        )
+
+    def pay(self):
+        """The customer confirms the card on the payment page"""
+        self.gateway.auto_succeed = True
+        self.gateway.retrieve_intent(self.booking.stripe_payment_intent_id)
+
+    def status(self):
+        response = self.client.get(reverse('booking:booking_status', args=[self.booking.booking_id]))
+        return response.json()
+
+    def test_success_confirms_once(self):
+        self.assertEqual(self.status(), {'status': 'pending', 'payment_status': 'pending', 'pending': True})
+        self.pay()
+        self.assertEqual(finalize_booking(self.booking.pk, 'succeeded', 'ch_1'), 'confirmed')
+
+        self.booking.refresh_from_db()
+        self.assertEqual((self.booking.status, self.booking.payment_status), (BookingStatus.CONFIRMED, 'paid'))
+        self.assertEqual(self.booking.stripe_charge_id, 'ch_1')
+        self.assertFalse(StockHold.objects.exists())
+        self.assertEqual(ledger_units(self.product, DROP_OFF), (1, 0))
+        self.assertEqual(self.status(), {'status': 'confirmed', 'payment_status': 'paid', 'pending': False})
+
+        # A late webhook or a second poll changes nothing
+        for intent_status in ('succeeded', 'canceled'):
+            self.assertEqual(finalize_booking(self.booking.pk, intent_status), '')
+        self.assertEqual(
+            NotificationOutbox.objects.filter(
+                booking=self.booking, kind=NotificationKind.BOOKING_CONFIRMATION
+            ).count(),
+            1,
+        )
+
+    def test_lost_stock_is_refunded_after_commit(self):
+        # The hold lapsed and someone else took the only unit
+        release_hold(self.hold.pk)
+        make_booking(self.product).save()
+        self.pay()
+        self.gateway.calls.clear()
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.assertEqual(finalize_booking(self.booking.pk, 'succeeded'), 'refunded')
+        self.booking.refresh_from_db()
+        self.assertEqual((self.booking.status, self.booking.payment_status), (BookingStatus.CANCELLED, 'refunding'))
+        self.assertEqual(self.gateway.operations(), [])
+
+        for callback in callbacks:
+            callback()
+        self.assertEqual(self.gateway.operations(), ['refund'])
+        self.assertEqual(self.status(), {'status': 'cancelled', 'payment_status': 'refunded', 'pending': False})
+        self.assertEqual(finalize_booking(self.booking.pk, 'succeeded'), '')
+        self.assertEqual(ledger_units(self.product, DROP_OFF), (1, 0))
+
+    def test_failed_payment_releases_the_hold(self):
+        self.assertEqual(finalize_booking(self.booking.pk, 'requires_payment_method'), 'failed')
+        self.assertFalse(StockHold.objects.exists())
+        self.assertEqual(ledger_units(self.product, DROP_OFF), (0, 0))
+        self.assertEqual(self.status()['payment_status'], 'failed')
+
+    def test_poller_finalizes_what_the_webhook_missed(self):
+        abandoned = record_pending_booking(
+            make_booking(self.product, stripe_payment_intent_id=self.gateway.create_intent(100).id), None
+        )
+        self.pay()
+        self.gateway.auto_succeed = False
+
+        # The other intent still wants a card, so that checkout has failed
+        self.assertEqual(finalize_pending_payments(), {'confirmed': 1, 'failed': 1})
+        self.assertEqual(finalize_pending_payments(), {})
+        abandoned.refresh_from_db()
+        self.assertEqual((abandoned.status, abandoned.payment_status), (BookingStatus.CANCELLED, 'failed'))
+        self.assertEqual(self.status()['status'], 'confirmed')
+        missing = self.client.get(reverse('booking:booking_status', args=['00000000-0000-0000-0000-000000000000']))
+        self.assertEqual(missing.status_code, 404)
+
+    def test_poller_renews_its_lease_and_stops_once_it_is_lost(self):
+        self.pay()
+        lease = leases.acquire('poller', ttl=60)
+        TaskLease.objects.filter(name='poller').update(expires_at=timezone.now())
+        self.assertEqual(finalize_pending_payments(lease=lease), {'confirmed': 1})
+        self.assertIsNone(leases.acquire('poller', ttl=60))
+
+        second = record_pending_booking(
+            make_booking(self.product, stripe_payment_intent_id=self.gateway.create_intent(100).id), None
+        )
+        TaskLease.objects.filter(name='poller').update(expires_at=timezone.now())
+        self.assertIsNotNone(leases.acquire('poller', ttl=60))
+        with self.assertRaises(leases.LeaseLost):
+            finalize_pending_payments(lease=lease)
+        second.refresh_from_db()
+        self.assertEqual((second.status, second.payment_status), (BookingStatus.PENDING, 'pending'))
+
+
+class LeaseTests(TestCase):
+    def expire(self, name):
+        TaskLease.objects.filter(name=name).update(expires_at=timezone.now() - timedelta(seconds=1))
+
+    def test_held_lease_is_not_granted_again(self):
+        self.assertIsNotNone(leases.acquire('sweep', ttl=60))
+        self.assertIsNone(leases.acquire('sweep', ttl=60))
+
+    def test_release_lets_the_next_caller_in(self):
+        first = leases.acquire('sweep', ttl=60)
+        first.release()
+        second = leases.acquire('sweep', ttl=60)
+        self.assertEqual(second.token, first.token + 1)
+
+    def test_takeover_fences_out_the_stale_holder(self):
+        stale = leases.acquire('sweep', ttl=60)
+        self.expire('sweep')
+        current = leases.acquire('sweep', ttl=60)
+        self.assertGreater(current.token, stale.token)
+
+        with self.assertRaises(leases.LeaseLost), transaction.atomic():
+            stale.fence()
+        current.fence()
+        # The stale holder's release must not free the new holder's lease
+        stale.release()
+        self.assertIsNone(leases.acquire('sweep', ttl=60))
+
+    def test_fence_renews_the_lease(self):
+        lease = leases.acquire('sweep', ttl=60)
+        self.expire('sweep')
+        lease.fence()
+        self.assertIsNone(leases.acquire('sweep', ttl=60))
+
+    def test_singleton_skips_while_the_lease_is_held(self):
+        runs = []
+
+        @leases.singleton(name='job', ttl=60)
+        def job(lease=None):
+            runs.append(lease.token)
+            return 'ran'
+
+        with leases.held('job', ttl=60):
+            self.assertIsNone(job())
+        self.assertEqual(job(), 'ran')
+        self.assertEqual(runs, [2])
+
+    def test_singleton_task_keeps_its_lease_by_fencing(self):
+        @leases.singleton(name='job', ttl=60)
+        def job(lease=None):
+            for _ in range(3):
+                # A batch that outlasted the ttl
+                self.expire('job')
+                with transaction.atomic():
+                    lease.fence()
+                self.assertIsNone(leases.acquire('job', ttl=60))
+            return lease.token
+
+        token = job()
+        # Released when the task returns
+        self.assertEqual(leases.acquire('job', ttl=60).token, token + 1)
+
+@override_settings(CACHES=LOCAL_CACHE)
+class ConcurrentReservationTests(TransactionTestCase):
+    def test_last_unit_goes_to_one_checkout(self):
+        product = make_product(stock_quantity=1)
+        # With the day rows already there, only their row locks keep the
+        # checkouts apart
+        ensure_days(product.id, DROP_OFF, rental_end_date(DROP_OFF, None, 2))
+        start = threading.Barrier(4)
+        outcomes = []
+
+        def checkout():
+            try:
+                start.wait()
+                outcomes.append(place_hold(product, DROP_OFF, 2))
+            except StockUnavailable:
+                outcomes.append(None)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=checkout) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len([hold for hold in outcomes if hold]), 1)
+        self.assertEqual(ledger_units(product, DROP_OFF), (0, 1))
+        self.assertEqual(rebuild_ledger([product.id], dry_run=True), [])
+
+
+@override_settings(CACHES=LOCAL_CACHE, STORAGES=PLAIN_STATIC, PAYMENT_FINALIZATION='sync')
+class CheckoutFunnelQueryTests(TestCase):
+    # Tables served from process memory once warm
+    PRICING_TABLES = (PricingSetting._meta.db_table, DistanceBasedFee._meta.db_table)
+    # Queries per step once warm: the session read and save, plus the step's own
+    WARM_QUERIES = {
+        'landing': 5,
+        'booking_home': 5,
+        'select_dates': 5,
+        'select_dates POST': 5,
+        'customer_details': 5,
+        'customer_details POST': 5,
+        'order_summary': 15,
+        'process_payment': 32,
+    }
+
+    def setUp(self):
+        self.addCleanup(set_gateway, set_gateway(FakeGateway()))
+        # Saving bumps the cache versions, so no copy from an earlier test survives
+        with self.captureOnCommitCallbacks(execute=True):
+            PricingSetting.get_settings(cached=False).save()
+            DistanceBasedFee.objects.create(
+                min_distance_km=0, max_distance_km=999, fee=250, description='Any distance'
+            )
+        self.product = make_product(stock_quantity=5)
+        self.client.defaults['HTTP_HOST'] = 'localhost'
+
+    def funnel(self):
+        """(step, method, url, data) for one checkout, landing page to payment"""
+        select_dates = reverse('booking:select_dates', args=[self.product.slug])
+        details = reverse('booking:customer_details')
+        return [
+            ('landing', 'get', reverse('home'), None),
+            ('booking_home', 'get', reverse('booking:home'), None),
+            ('select_dates', 'get', select_dates, None),
+            ('select_dates POST', 'post', select_dates, {
+                'drop_off_date': DROP_OFF.isoformat(),
+                'rental_months': 2,
+            }),
+            ('customer_details', 'get', details, None),
+            ('customer_details POST', 'post', details, {
+                'customer_name': 'Test Customer',
+                'customer_email': 'customer@example.com',
+                'country_code': '+1',
+                'customer_phone': '4165550000',
+                'delivery_address': '1 Test St',
+                'delivery_city': 'Toronto',
+                'delivery_state': 'ON',
+                'delivery_zip': 'M5H2N2',
+                'delivery_distance_range': '0-30',
+            }),
+            ('order_summary', 'get', reverse('booking:order_summary'), None),
+            ('process_payment', 'post', reverse('booking:process_payment'), self.payment_data),
+        ]
+
+    def payment_data(self):
+        # The intent order_summary created; FakeGateway marks it paid when retrieved
+        return {'payment_intent_id': self.client.session['booking_data']['payment_intent']['id']}
+
+    def request(self, method, url, data):
+        response = getattr(self.client, method)(url, data)
+        self.assertIn(response.status_code, (200, 302), response.content[:200])
+        return response
+
+    def test_warm_funnel_never_queries_pricing_tables(self):
+        for step, method, url, data in self.funnel():
+            self.request(method, url, data() if callable(data) else data)
+        for step, method, url, data in self.funnel():
+            data = data() if callable(data) else data
+            with self.assertNumQueries(self.WARM_QUERIES[step]) as queries:
+                self.request(method, url, data)
+            pricing = [
+                query['sql'] for query in queries.captured_queries
+                if any(table in query['sql'] for table in self.PRICING_TABLES)
+            ]
+            self.assertEqual(pricing, [], step)
+        self.assertEqual(Booking.objects.filter(payment_status='paid').count(), 2)
@@ -6,10 +6,12 @@ app_name = 'booking'
 urlpatterns = [
     path('', views.booking_home, name='home'),
     path('product/<slug:product_slug>/', views.select_dates, name='select_dates'),
+    path('product/<slug:product_slug>/availability/<int:year>/<int:month>/', views.availability_month, name='availability_month'),
     path('details/', views.customer_details, name='customer_details'),
     path('summary/', views.order_summary, name='order_summary'),
     path('process-payment/', views.process_payment, name='process_payment'),
     path('confirmation/<uuid:booking_id>/', views.booking_confirmation, name='confirmation'),
+    path('confirmation/<uuid:booking_id>/status/', views.booking_status, name='booking_status'),
     path('pickup/', views.schedule_pickup, name='schedule_pickup'),
     path('pickup/payment/', views.pickup_payment, name='pickup_payment'),
     path('pickup/process/', views.process_pickup, name='process_pickup'),
@@ -1,4 +1,5 @@
 from django.shortcuts import render, redirect, get_object_or_404
+from django.urls import reverse
 from django.views.decorators.http import require_http_methods
 from django.views.decorators.csrf import csrf_exempt
 from django.http import JsonResponse
@@ -6,10 +7,20 @@ from django.utils import timezone
 from django.contrib import messages
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.decorators import login_required
+from django.db import transaction
 from django.db.models import Q
-from products.models import Product, PricingSetting, BlackoutDate, DistanceBasedFee
-from .models import Booking, PickupRequest, BookingStatus
-from .forms import BookingForm, PickupRequestForm
+from notifications.models import NotificationKind
+from notifications.outbox import queue_notification
+from products.models import Product, PricingSetting, BlackoutDate
+from products.availability import get_cached_month_grid, search_available_products
+from products.pricing import quote_for, quote_matrix, to_cents
+from .models import Booking, PickupRequest, BookingStatus, StockHold
+from .forms import DISTANCE_RANGE_KM, AvailabilitySearchForm, BookingForm, PickupRequestForm
+from .finalization import record_pending_booking
+from .gateway import get_gateway
+from .payments import checkout_intent
+from .reservations import StockUnavailable, place_hold, release_hold, confirm_booking
+from .webhooks import record_event
 import stripe
 from django.conf import settings
 import json
@@ -17,7 +28,6 @@ from datetime import datetime, timedelta
 import logging
 
 logger = logging.getLogger(__name__)
-stripe.api_key = settings.STRIPE_SECRET_KEY
 
 
 def staff_login(request):
@@ -57,12 +67,26 @@ def landing_page(request):
 
 
 def booking_home(request):
-    """Step 1: Select Product"""
+    """Step 1: Select Product, optionally filtered by drop-off date and term"""
     products = Product.objects.filter(is_active=True)
+    search_form = AvailabilitySearchForm(request.GET or None)
+    
+    searched = search_form.is_valid()
+    if searched:
+        products = search_available_products(
+            products,
+            search_form.cleaned_data['drop_off_date'],
+            search_form.cleaned_data['rental_months'],
+        )
+    
     context = {
         'products': products,
+        'search_form': search_form,
+        'searched': searched,
         'page_title': 'Book Your Rental'
     }
+    if request.htmx:
+        return render(request, 'booking/_product_results.html', context)
     return render(request, 'booking/select_product.html', context)
 
 
@@ -71,18 +95,6 @@ def select_dates(request, product_slug):
     product = get_object_or_404(Product, slug=product_slug, is_active=True)
     pricing = PricingSetting.get_settings()
     
-    # Get blackout dates for calendar
-    blackout_dates = list(
-        BlackoutDate.objects.filter(
-            Q(product=product) | Q(product__isnull=True)
-        ).values_list('date', flat=True)
-    )
-    
-    # Convert to ISO format for JavaScript
-    blackout_dates_json = json.dumps(
-        [date.isoformat() for date in blackout_dates]
-    )
-    
     if request.method == 'POST':
         drop_off_date = request.POST.get('drop_off_date')
         rental_months = int(request.POST.get('rental_months', 1))
@@ -99,13 +111,27 @@ def select_dates(request, product_slug):
     context = {
         'product': product,
         'pricing': pricing,
-        'blackout_dates': blackout_dates_json,
         'min_date': (timezone.now() + timedelta(days=1)).date().isoformat(),
+        # Day states are fetched month by month; JS fills in the /0/0/ placeholder
+        'availability_url': reverse('booking:availability_month', args=[product.slug, 0, 0]),
         'page_title': f'Book {product.name}'
     }
     return render(request, 'booking/select_dates.html', context)
 
 
+def availability_month(request, product_slug, year, month):
+    """Day states (available, low, sold out, blackout) for one calendar month"""
+    product = get_object_or_404(Product, slug=product_slug, is_active=True)
+    
+    if not (1 <= month <= 12 and 1 <= year <= 9999):
+        return JsonResponse({'error': 'Invalid month'}, status=400)
+    
+    return JsonResponse({
+        'month': f'{year}-{month:02d}',
+        'days': get_cached_month_grid(product, year, month),
+    })
+
+
 def customer_details(request):
     """Step 3: Customer Information & Location"""
     booking_data = request.session.get('booking_data')
@@ -115,13 +141,17 @@ def customer_details(request):
         return redirect('booking:home')
     
     product = get_object_or_404(Product, id=booking_data['product_id'])
-    pricing = PricingSetting.get_settings()
     
-    # Calculate pricing - transport fee will be determined by distance in next step
-    monthly_cost = product.monthly_rate * booking_data['rental_months']
-    # Estimate default transport fee (within 30km) until distance is provided
-    transport_fee = DistanceBasedFee.get_fee_for_distance(15)  # Default 15km estimate
-    total = monthly_cost + transport_fee
+    # Quote every distance range so the page can update the total as the
+    # customer picks one; the estimate shown first is within 30 km
+    range_quotes = quote_matrix(
+        [product], [booking_data['rental_months']], DISTANCE_RANGE_KM.values()
+    )
+    quotes_by_range = {
+        distance_range: range_quotes[(product.id, booking_data['rental_months'], distance_km)]
+        for distance_range, distance_km in DISTANCE_RANGE_KM.items()
+    }
+    estimate = quotes_by_range['0-30']
     
     if request.method == 'POST':
         form = BookingForm(request.POST)
@@ -130,12 +160,7 @@ def customer_details(request):
             distance_range = form.cleaned_data['delivery_distance_range']
             
             # Convert distance range to km for fee calculation
-            if distance_range == '0-30':
-                distance_km = 15  # Representative value within 30km
-            elif distance_range == '30-100':
-                distance_km = 65  # Representative value within 30-100km
-            else:  # 100+
-                distance_km = 150  # Beyond 100km
+            distance_km = DISTANCE_RANGE_KM[distance_range]
             
             # Store customer details in session
             request.session['booking_data'].update({
@@ -160,14 +185,48 @@ def customer_details(request):
         'form': form,
         'product': product,
         'booking_data': booking_data,
-        'monthly_cost': float(monthly_cost),
-        'transport_fee': float(transport_fee),
-        'total': float(total),
+        'monthly_cost': estimate.monthly_cost,
+        'transport_fee': estimate.transport_fee,
+        'total': estimate.total,
+        'range_fees': {
+            distance_range: str(range_quote.transport_fee)
+            for distance_range, range_quote in quotes_by_range.items()
+        },
         'page_title': 'Your Information'
     }
     return render(request, 'booking/customer_details.html', context)
 
 
+def _hold_unit(request, product, booking_data):
+    """Reuse this checkout's stock hold, or place a new one"""
+    hold_id = booking_data.get('hold_id')
+    released_own_hold = False
+    if hold_id:
+        hold = StockHold.objects.filter(pk=hold_id).first()
+        if (hold and hold.expires_at > timezone.now()
+                and hold.matches(product.id, booking_data['drop_off_date'], booking_data['rental_months'])):
+            StockHold.objects.filter(pk=hold.pk).update(
+                expires_at=timezone.now() + timedelta(seconds=settings.STOCK_HOLD_TTL_SECONDS)
+            )
+            return hold
+        released_own_hold = release_hold(hold_id)
+    
+    hold = place_hold(
+        product,
+        booking_data['drop_off_date'],
+        booking_data['rental_months'],
+        session_key=request.session.session_key,
+    )
+    # We released the old hold ourselves, so the sweeper never cancelled its
+    # PaymentIntent and the new hold can carry it on
+    cached_intent = booking_data.get('payment_intent')
+    if released_own_hold and cached_intent and cached_intent['hold_id'] == hold_id:
+        cached_intent['hold_id'] = hold.id
+    booking_data['hold_id'] = hold.id
+    request.session.modified = True
+    return hold
+
+
 def order_summary(request):
     """Step 4: Order Summary & Payment"""
     booking_data = request.session.get('booking_data')
@@ -177,7 +236,6 @@ def order_summary(request):
         return redirect('booking:home')
     
     product = get_object_or_404(Product, id=booking_data['product_id'])
-    pricing = PricingSetting.get_settings()
     
     # Get distance range selection
     distance_range = booking_data.get('delivery_distance_range')
@@ -187,9 +245,7 @@ def order_summary(request):
     beyond_100km = distance_range == '100+'
     
     # Calculate pricing - transport fee based on distance selection
-    monthly_cost = float(product.monthly_rate) * booking_data['rental_months']
-    transport_fee = float(DistanceBasedFee.get_fee_for_distance(delivery_distance_km))
-    total = monthly_cost + transport_fee
+    quote = quote_for(product, booking_data['rental_months'], delivery_distance_km)
     
     # Get distance range label for display
     distance_range_labels = {
@@ -204,20 +260,20 @@ def order_summary(request):
     intent_id = None
     
     if not beyond_100km:
-        # Create Stripe PaymentIntent only for distances within range
+        # Hold a unit for this checkout before taking payment
+        try:
+            hold = _hold_unit(request, product, booking_data)
+        except StockUnavailable as e:
+            messages.error(request, f'{e}. Please choose another drop-off date.')
+            return redirect('booking:select_dates', product_slug=product.slug)
+        
+        # Reuse this checkout's PaymentIntent, only for distances within range
         try:
-            intent = stripe.PaymentIntent.create(
-                amount=int(total * 100),  # Stripe uses cents
-                currency='usd',
-                metadata={
-                    'product_name': product.name,
-                    'customer_email': booking_data['customer_email'],
-                    'drop_off_date': booking_data['drop_off_date'],
-                }
+            intent_id, client_secret = checkout_intent(
+                request.session, product, booking_data, quote, hold
             )
-            
-            client_secret = intent.client_secret
-            intent_id = intent.id
+            if hold.stripe_payment_intent_id != intent_id:
+                StockHold.objects.filter(pk=hold.pk).update(stripe_payment_intent_id=intent_id)
         except Exception as e:
             logger.error(f'Stripe PaymentIntent creation error: {str(e)}')
             messages.error(request, f'Payment setup error: {str(e)}')
@@ -226,9 +282,9 @@ def order_summary(request):
     context = {
         'product': product,
         'booking_data': booking_data,
-        'monthly_cost': monthly_cost,
-        'transport_fee': transport_fee,
-        'total': total,
+        'monthly_cost': quote.monthly_cost,
+        'transport_fee': quote.transport_fee,
+        'total': quote.total,
         'distance_label': distance_label,
         'beyond_100km': beyond_100km,
         'stripe_public_key': settings.STRIPE_PUBLIC_KEY,
@@ -249,31 +305,32 @@ def process_payment(request):
     
     try:
         payment_intent_id = request.POST.get('payment_intent_id')
+        finalize_later = settings.PAYMENT_FINALIZATION == 'async'
         
-        # Verify payment with Stripe
-        intent = stripe.PaymentIntent.retrieve(payment_intent_id)
-        
-        if intent.status != 'succeeded':
-            return JsonResponse({'error': 'Payment not completed'}, status=400)
+        if finalize_later:
+            # The webhook or poller verifies the payment; only accept the
+            # intent this checkout created
+            if payment_intent_id != booking_data.get('payment_intent', {}).get('id'):
+                return JsonResponse({'error': 'Unknown payment'}, status=400)
+            charge_id = ''
+        else:
+            # Verify payment with Stripe
+            intent = get_gateway().retrieve_intent(payment_intent_id)
+            
+            if intent.status != 'succeeded':
+                return JsonResponse({'error': 'Payment not completed'}, status=400)
+            
+            # latest_charge is the charge ID; otherwise it will be populated by webhook
+            charge_id = intent.latest_charge or ''
         
         # Create booking
         product = Product.objects.get(id=booking_data['product_id'])
-        pricing = PricingSetting.get_settings()
-        
-        # Get charge ID from intent if available, otherwise will be populated by webhook
-        charge_id = ''
-        if intent.latest_charge:
-            try:
-                charge = stripe.Charge.retrieve(intent.latest_charge)
-                charge_id = charge.id
-            except:
-                pass
         
-        # Calculate transport fee based on delivery distance
+        # Price the booking exactly as the order summary did
         delivery_distance_km = booking_data.get('delivery_distance_km')
-        calculated_transport_fee = DistanceBasedFee.get_fee_for_distance(delivery_distance_km)
+        quote = quote_for(product, booking_data['rental_months'], delivery_distance_km)
         
-        booking = Booking.objects.create(
+        booking = Booking(
             product=product,
             customer_name=booking_data['customer_name'],
             customer_email=booking_data['customer_email'],
@@ -287,8 +344,9 @@ def process_payment(request):
             delivery_notes=booking_data.get('delivery_notes', ''),
             drop_off_date=booking_data['drop_off_date'],
             rental_months=booking_data['rental_months'],
-            monthly_rate=product.monthly_rate,
-            transport_fee=calculated_transport_fee,
+            monthly_rate=quote.monthly_rate,
+            transport_fee=quote.transport_fee,
+            total_amount=quote.total,
             stripe_payment_intent_id=payment_intent_id,
             stripe_charge_id=charge_id,
             payment_status='paid',
@@ -296,14 +354,26 @@ def process_payment(request):
             confirmed_at=timezone.now()
         )
         
+        if finalize_later:
+            # Confirmed, and notified, once the payment is verified
+            record_pending_booking(booking, booking_data.get('hold_id'))
+        else:
+            # Convert the checkout's hold into the booking under the ledger lock,
+            # queueing the confirmation in the same transaction
+            try:
+                with transaction.atomic():
+                    confirm_booking(booking, hold_id=booking_data.get('hold_id'))
+                    queue_notification(NotificationKind.BOOKING_CONFIRMATION, booking)
+            except StockUnavailable as e:
+                logger.error(f'Stock lost after payment {payment_intent_id}: {str(e)}')
+                get_gateway().refund(payment_intent_id)
+                return JsonResponse({
+                    'error': f'{e}. Your payment has been refunded.'
+                }, status=409)
+        
         # Clear session
         del request.session['booking_data']
         
-        # Send notifications (async with synchronous fallback if Redis unavailable)
-        from notifications.tasks import send_booking_confirmation
-        from notifications.utils import send_notification_safe
-        send_notification_safe(send_booking_confirmation, booking.id)
-        
         return JsonResponse({
             'success': True,
             'booking_id': str(booking.booking_id),
@@ -326,6 +396,18 @@ def booking_confirmation(request, booking_id):
     return render(request, 'booking/confirmation.html', context)
 
 
+def booking_status(request, booking_id):
+    """Payment state polled by the confirmation page while finalization is pending"""
+    booking = get_object_or_404(
+        Booking.objects.only('status', 'payment_status'), booking_id=booking_id
+    )
+    return JsonResponse({
+        'status': booking.status,
+        'payment_status': booking.payment_status,
+        'pending': booking.payment_status == 'pending',
+    })
+
+
 def schedule_pickup(request):
     """Guest pickup scheduling form"""
     if request.method == 'POST':
@@ -351,15 +433,15 @@ def schedule_pickup(request):
                 return redirect('booking:pickup_confirmed', booking_id=booking_id)
             
             # Create pickup request (no payment needed - already paid in initial booking)
-            pickup_request = PickupRequest.objects.create(
-                booking=booking,
-                requested_pickup_date=form.cleaned_data['requested_pickup_date'],
-                pickup_notes=form.cleaned_data.get('pickup_notes', ''),
-            )
-            
-            # Send pickup confirmation email/SMS (async)
-            from notifications.tasks import send_pickup_confirmation
-            send_pickup_confirmation.delay(pickup_request.id)
+            with transaction.atomic():
+                pickup_request = PickupRequest.objects.create(
+                    booking=booking,
+                    requested_pickup_date=form.cleaned_data['requested_pickup_date'],
+                    pickup_notes=form.cleaned_data.get('pickup_notes', ''),
+                )
+                
+                # Pickup confirmation email/SMS, delivered from the outbox
+                queue_notification(NotificationKind.PICKUP_CONFIRMATION, booking, pickup_request)
             
             # Clear session
             if 'pickup_data' in request.session:
@@ -389,8 +471,8 @@ def pickup_payment(request):
     
     # Create Stripe PaymentIntent for pickup fee
     try:
-        intent = stripe.PaymentIntent.create(
-            amount=int(float(pricing.pickup_fee) * 100),
+        intent = get_gateway().create_intent(
+            amount=to_cents(pricing.pickup_fee),
             currency='usd',
             metadata={
                 'booking_id': str(booking.booking_id),
@@ -428,7 +510,7 @@ def process_pickup(request):
         payment_intent_id = request.POST.get('payment_intent_id')
         
         # Verify payment
-        intent = stripe.PaymentIntent.retrieve(payment_intent_id)
+        intent = get_gateway().retrieve_intent(payment_intent_id)
         
         if intent.status != 'succeeded':
             return JsonResponse({'error': 'Payment not completed'}, status=400)
@@ -436,28 +518,27 @@ def process_pickup(request):
         # Create pickup request
         booking = Booking.objects.get(booking_id=pickup_data['booking_id'])
         
-        pickup_request = PickupRequest.objects.create(
-            booking=booking,
-            requested_pickup_date=pickup_data['requested_pickup_date'],
-            pickup_notes=pickup_data.get('pickup_notes', ''),
-            stripe_payment_intent_id=payment_intent_id,
-            payment_status='paid',
-            confirmed_at=timezone.now()
-        )
-        
-        # Update booking
-        booking.status = BookingStatus.PICKUP_SCHEDULED
-        booking.pickup_date = pickup_data['requested_pickup_date']
-        booking.save()
+        with transaction.atomic():
+            pickup_request = PickupRequest.objects.create(
+                booking=booking,
+                requested_pickup_date=pickup_data['requested_pickup_date'],
+                pickup_notes=pickup_data.get('pickup_notes', ''),
+                stripe_payment_intent_id=payment_intent_id,
+                payment_status='paid',
+                confirmed_at=timezone.now()
+            )
+            
+            # Update booking
+            booking.status = BookingStatus.PICKUP_SCHEDULED
+            booking.pickup_date = pickup_data['requested_pickup_date']
+            booking.save()
+            
+            # Notifications are delivered from the outbox once this commits
+            queue_notification(NotificationKind.PICKUP_CONFIRMATION, booking, pickup_request)
         
         # Clear session
         del request.session['pickup_data']
         
-        # Send notifications (async with synchronous fallback if Redis unavailable)
-        from notifications.tasks import send_pickup_confirmation
-        from notifications.utils import send_notification_safe
-        send_notification_safe(send_pickup_confirmation, pickup_request.id)
-        
         return JsonResponse({
             'success': True,
             'booking_id': str(booking.booking_id),
@@ -483,54 +564,17 @@ def pickup_confirmed(request, booking_id):
 @csrf_exempt
 @require_http_methods(['POST'])
 def stripe_webhook(request):
-    """Handle Stripe webhook events"""
-    import json
-    from django.conf import settings
-    
+    """Store verified Stripe webhook events for bookings.webhooks to apply"""
     payload = request.body
     sig_header = request.META.get('HTTP_STRIPE_SIGNATURE', '')
     
     try:
-        event = stripe.Webhook.construct_event(
-            payload, sig_header, settings.STRIPE_WEBHOOK_SECRET
-        )
+        get_gateway().construct_event(payload, sig_header)
     except ValueError:
         return JsonResponse({'error': 'Invalid payload'}, status=400)
     except stripe.error.SignatureVerificationError:
         return JsonResponse({'error': 'Invalid signature'}, status=400)
     
-    # Handle the event
-    if event['type'] == 'charge.succeeded':
-        charge = event['data']['object']
-        
-        # Update booking with charge ID if it doesn't have one
-        try:
-            # Try to find booking by payment intent ID
-            payment_intent_id = charge.get('payment_intent')
-            if payment_intent_id:
-                booking = Booking.objects.get(stripe_payment_intent_id=payment_intent_id)
-                if not booking.stripe_charge_id:
-                    booking.stripe_charge_id = charge['id']
-                    booking.save()
-                    logger.info(f'Updated booking {booking.booking_id} with charge ID {charge["id"]}')
-        except Booking.DoesNotExist:
-            logger.warning(f'No booking found for payment intent {payment_intent_id}')
-        except Exception as e:
-            logger.error(f'Error updating booking with charge: {str(e)}')
-    
-    elif event['type'] == 'payment_intent.succeeded':
-        intent = event['data']['object']
-        logger.info(f'Payment intent succeeded: {intent["id"]}')
-    
-    elif event['type'] == 'payment_intent.payment_failed':
-        intent = event['data']['object']
-        logger.error(f'Payment intent failed: {intent["id"]}')
-        
-        try:
-            booking = Booking.objects.get(stripe_payment_intent_id=intent['id'])
-            booking.payment_status = 'failed'
-            booking.save()
-        except Booking.DoesNotExist:
-            pass
-    
+    # The signature covers the raw body, so store exactly what Stripe sent
+    record_event(json.loads(payload))
     return JsonResponse({'success': True})
@@ -0,0 +1,222 @@
+"""
+Stripe webhook inbox.
+
+The webhook view used to look up and save the booking while Stripe waited
+for the response, one unindexed query per event. Now it verifies the
+signature, appends the event to WebhookEvent and returns 200 at once.
+drain_inbox(), run every few seconds by Celery beat, applies pending events
+in batches:
+
+- rows are claimed with SELECT ... FOR UPDATE SKIP LOCKED, so several
+  workers can drain side by side
+- every payment intent in the batch is resolved to its booking with one
+  IN query on the indexed Booking.stripe_payment_intent_id
+- changed bookings are written with one bulk_update per set of changed
+  fields, so no booking gets a field written that its events did not change
+
+Handlers must be idempotent, as Stripe may deliver events out of order and
+`python manage.py replay_webhooks` re-applies stored events.
+
+Lag is recorded into bingo_rentals.metrics: webhooks.delivery_lag (Stripe
+created the event -> stored) and webhooks.processing_lag (stored -> applied).
+"""
+import logging
+from collections import defaultdict
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Min
+from django.utils import timezone
+
+from bingo_rentals import metrics
+from .finalization import finalize_booking
+from .models import Booking, BookingStatus, WebhookEvent
+
+logger = logging.getLogger(__name__)
+
+# Booking fields handlers read or change
+BOOKING_FIELDS = ('id', 'booking_id', 'stripe_payment_intent_id', 'stripe_charge_id', 'payment_status', 'status')
+
+HANDLERS = {}
+
+
+def handles(event_type):
+    """Register a handler(obj, booking) that returns the booking fields it changed"""
+    def register(func):
+        HANDLERS[event_type] = func
+        return func
+    return register
+
+
+def record_event(payload):
+    """
+    Append a verified event to the inbox.
+
+    Returns:
+        bool: False if the event was already stored (a redelivery)
+    """
+    created = payload.get('created')
+    event = WebhookEvent(
+        event_id=payload['id'],
+        event_type=payload.get('type', ''),
+        payload=payload,
+        created=datetime.fromtimestamp(created, tz=dt_timezone.utc) if created else None,
+    )
+    try:
+        with transaction.atomic():
+            event.save(force_insert=True)
+    except IntegrityError:
+        metrics.incr('webhooks.duplicates')
+        return False
+    if event.created:
+        metrics.observe('webhooks.delivery_lag', _ms(event.received_at - event.created))
+    metrics.incr('webhooks.received')
+    return True
+
+
+def intent_id_of(event):
+    """The payment intent an event is about, or '' if none"""
+    obj = event.payload.get('data', {}).get('object', {})
+    if obj.get('object') == 'payment_intent':
+        return obj.get('id') or ''
+    return obj.get('payment_intent') or ''
+
+
+def _finalize(booking, *args):
+    """finalize_booking(), then reload what it wrote into the batch's copy"""
+    finalize_booking(booking.pk, *args)
+    # Later events in the batch must see the new state, and no stale
+    # in-memory value may be written back over it
+    booking.refresh_from_db(fields=['status', 'payment_status'])
+
+
+@handles('charge.succeeded')
+def charge_succeeded(charge, booking):
+    if booking.stripe_charge_id:
+        return set()
+    booking.stripe_charge_id = charge['id']
+    logger.info(f'Updated booking {booking.booking_id} with charge ID {charge["id"]}')
+    return {'stripe_charge_id'}
+
+
+@handles('payment_intent.succeeded')
+def payment_succeeded(intent, booking):
+    logger.info(f'Payment intent succeeded: {intent["id"]}')
+    if booking.payment_status == 'pending':
+        _finalize(booking, 'succeeded', intent.get('latest_charge') or '')
+    return set()
+
+
+@handles('payment_intent.payment_failed')
+def payment_failed(intent, booking):
+    logger.error(f'Payment intent failed: {intent["id"]}')
+    # A failed attempt can arrive after the customer retried and paid
+    if booking.payment_status != 'pending':
+        return set()
+    if booking.status == BookingStatus.PENDING:
+        # Awaiting async finalization: give the held unit back
+        _finalize(booking, 'canceled')
+        return set()
+    booking.payment_status = 'failed'
+    return {'payment_status'}
+
+
+def apply_events(events):
+    """
+    Apply a batch of claimed events and mark them processed.
+
+    Returns:
+        int: number of events that failed and will be retried
+    """
+    intent_ids = {intent_id_of(event) for event in events} - {''}
+    bookings = {
+        booking.stripe_payment_intent_id: booking
+        for booking in Booking.objects.filter(stripe_payment_intent_id__in=intent_ids).only(*BOOKING_FIELDS)
+    }
+
+    changed = {}
+    failed = 0
+    now = timezone.now()
+    for event in events:
+        event.attempts += 1
+        handler = HANDLERS.get(event.event_type)
+        booking = bookings.get(intent_id_of(event))
+        try:
+            if handler and booking:
+                fields = handler(event.payload['data']['object'], booking)
+                if fields:
+                    changed.setdefault(booking.pk, (booking, set()))[1].update(fields)
+            elif handler:
+                metrics.incr('webhooks.unmatched')
+                logger.warning(f'No booking found for payment intent {intent_id_of(event)}')
+        except Exception as e:
+            logger.error(f'Error applying webhook event {event.event_id}: {str(e)}')
+            event.last_error = str(e)
+            metrics.incr('webhooks.errors')
+            if event.attempts < settings.WEBHOOK_MAX_ATTEMPTS:
+                failed += 1
+                continue
+        else:
+            event.last_error = ''
+        event.processed_at = now
+        metrics.observe('webhooks.processing_lag', _ms(now - event.received_at))
+
+    by_fields = defaultdict(list)
+    for booking, fields in changed.values():
+        by_fields[tuple(sorted(fields))].append(booking)
+    for fields, changed_bookings in by_fields.items():
+        Booking.objects.bulk_update(changed_bookings, fields)
+    WebhookEvent.objects.bulk_update(events, ['attempts', 'last_error', 'processed_at'])
+    metrics.incr('webhooks.processed', len(events) - failed)
+    return failed
+
+
+def drain_inbox(batch_size=None, max_batches=None):
+    """
+    Apply pending events, oldest first, one transaction per batch.
+
+    Events that raised stay pending and are retried on the next run until
+    WEBHOOK_MAX_ATTEMPTS, after which they are marked processed with
+    last_error set, for replay_webhooks --failed.
+
+    Returns:
+        int: number of events applied
+    """
+    batch_size = batch_size or settings.WEBHOOK_DRAIN_BATCH_SIZE
+    applied = 0
+    batches = 0
+    retry_later = set()
+    while max_batches is None or batches < max_batches:
+        with transaction.atomic(), metrics.timer('webhooks.batch'):
+            events = list(
+                WebhookEvent.objects
+                .filter(processed_at__isnull=True)
+                .exclude(pk__in=retry_later)
+                .select_for_update(skip_locked=True)
+                .order_by('received_at')[:batch_size]
+            )
+            if not events:
+                break
+            failed = apply_events(events)
+        retry_later.update(event.pk for event in events if event.processed_at is None)
+        applied += len(events) - failed
+        batches += 1
+        if len(events) < batch_size:
+            break
+    return applied
+
+
+def inbox_stats():
+    """Backlog of the inbox as seen by every process, for monitoring"""
+    pending = WebhookEvent.objects.filter(processed_at__isnull=True)
+    oldest = pending.aggregate(oldest=Min('received_at'))['oldest']
+    return {
+        'pending': pending.count(),
+        'oldest_pending_age_s': round((timezone.now() - oldest).total_seconds(), 1) if oldest else 0.0,
+        'failed': WebhookEvent.objects.exclude(last_error='').count(),
+    }
+
+
+def _ms(delta):
+    return max(delta.total_seconds() * 1000, 0.0)
@@ -0,0 +1,98 @@
+"""
+Keyset (cursor) pagination for the dashboard order list.
+
+manage_orders used to hand the template every booking ever placed, with all
+columns, so each visit got slower as orders accumulated. Offset pagination
+would only move the cost: OFFSET n still reads and discards n rows. Pages
+are now cut on (created_at, id), newest first: a page is the rows just past
+the cursor of the previous one, which the (-created_at, -id) indexes on
+Booking serve as a range scan of page_size + 1 rows however deep the page.
+
+Cursors are opaque urlsafe strings; one that cannot be decoded, or whose
+page has since been emptied, falls back to the first page.
+"""
+import base64
+import binascii
+from dataclasses import dataclass
+from datetime import datetime
+
+
+def encode_cursor(row):
+    """Opaque cursor pointing at row"""
+    raw = f'{row.created_at.isoformat()}|{row.pk}'
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(value):
+    """(created_at, pk) from a cursor, or None if it is not one of ours"""
+    if not value:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(value + '=' * (-len(value) % 4)).decode()
+        created_at, pk = raw.split('|')
+        created_at = datetime.fromisoformat(created_at)
+        pk = int(pk)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        return None
+    if created_at.tzinfo is None:
+        return None
+    return created_at, pk
+
+
+@dataclass
+class KeysetPage:
+    """One page of rows, newest first, and the cursors of its neighbours"""
+    rows: list
+    next_cursor: str = ''
+    previous_cursor: str = ''
+
+    @property
+    def has_next(self):
+        return bool(self.next_cursor)
+
+    @property
+    def has_previous(self):
+        return bool(self.previous_cursor)
+
+
+def _older(queryset, created_at, pk):
+    return queryset.filter(created_at__lte=created_at).exclude(created_at=created_at, pk__gte=pk)
+
+
+def _newer(queryset, created_at, pk):
+    return queryset.filter(created_at__gte=created_at).exclude(created_at=created_at, pk__lte=pk)
+
+
+def keyset_page(queryset, page_size, after=None, before=None):
+    """
+    The page of queryset just older than the after cursor, just newer than
+    the before cursor, or the newest page if neither is given.
+
+    queryset must not be sliced; its ordering is replaced by (created_at, id).
+    """
+    after, before = decode_cursor(after), decode_cursor(before)
+    if before:
+        rows = list(_newer(queryset, *before).order_by('created_at', 'pk')[:page_size + 1])
+        if rows:
+            more = len(rows) > page_size
+            rows = rows[:page_size][::-1]
+            return KeysetPage(
+                rows=rows,
+                next_cursor=encode_cursor(rows[-1]),
+                previous_cursor=encode_cursor(rows[0]) if more else '',
+            )
+    elif after:
+        rows = list(_older(queryset, *after).order_by('-created_at', '-pk')[:page_size + 1])
+        if rows:
+            more = len(rows) > page_size
+            rows = rows[:page_size]
+            return KeysetPage(
+                rows=rows,
+                next_cursor=encode_cursor(rows[-1]) if more else '',
+                previous_cursor=encode_cursor(rows[0]),
+            )
+
+    rows = list(queryset.order_by('-created_at', '-pk')[:page_size + 1])
+    more = len(rows) > page_size
+    rows = rows[:page_size]
+    return KeysetPage(rows=rows, next_cursor=encode_cursor(rows[-1]) if more else '')
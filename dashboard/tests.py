@@ -1,3 +1,96 @@
-from django.test import TestCase
+import base64
+import csv
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from bookings.forms import RENTAL_MONTH_CHOICES
+from bookings.models import Booking
+from bookings.tests import LOCAL_CACHE, PLAIN_STATIC, make_booking, make_product
+from products.models import DistanceBasedFee
+from .pagination import decode_cursor, encode_cursor, keyset_page
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class KeysetPaginationTests(TestCase):
+    def setUp(self):
+        product = make_product()
+        # bulk_create skips save() and its signals, so no reminders or computed total
+        bookings = Booking.objects.bulk_create([make_booking(product, total_amount=398) for _ in range(7)])
+        now = timezone.now().replace(microsecond=0)
+        # Three bookings share a timestamp and two more share another, so
+        # pages have to be cut inside runs of equal created_at
+        stamps = [now, now, now, now - timedelta(hours=1), now - timedelta(hours=1),
+                  now - timedelta(hours=2), now + timedelta(hours=1)]
+        for booking, created_at in zip(bookings, stamps):
+            Booking.objects.filter(pk=booking.pk).update(created_at=created_at)
+        self.queryset = Booking.objects.all()
+        self.newest_first = list(self.queryset.order_by('-created_at', '-pk').values_list('pk', flat=True))
+
+    def pks(self, page):
+        return [row.pk for row in page.rows]
+
+    def test_cursor_round_trip(self):
+        row = self.queryset.first()
+        self.assertEqual(decode_cursor(encode_cursor(row)), (row.created_at, row.pk))
+
+    def test_foreign_cursors_decode_to_none(self):
+        naive = base64.urlsafe_b64encode(b'2030-03-01T00:00:00|5').decode()
+        for value in ('', None, 'not a cursor!', base64.urlsafe_b64encode(b'x|y').decode(), naive):
+            self.assertIsNone(decode_cursor(value), value)
+
+    def test_walking_forward_and_back_visits_every_row_once(self):
+        pages = [keyset_page(self.queryset, 2)]
+        while pages[-1].has_next:
+            pages.append(keyset_page(self.queryset, 2, after=pages[-1].next_cursor))
+        self.assertEqual([pk for page in pages for pk in self.pks(page)], self.newest_first)
+        self.assertEqual([len(page.rows) for page in pages], [2, 2, 2, 1])
+        self.assertFalse(pages[0].has_previous)
+
+        back = [pages[-1]]
+        while back[-1].has_previous:
+            back.append(keyset_page(self.queryset, 2, before=back[-1].previous_cursor))
+        self.assertEqual([self.pks(page) for page in back[1:]], [self.pks(page) for page in pages[-2::-1]])
+
+    def test_cursor_past_the_last_row_falls_back_to_the_first_page(self):
+        oldest = self.queryset.order_by('created_at', 'pk').first()
+        page = keyset_page(self.queryset, 2, after=encode_cursor(oldest))
+        self.assertEqual(self.pks(page), self.newest_first[:2])
+
+
+@override_settings(CACHES=LOCAL_CACHE, STORAGES=PLAIN_STATIC)
+class PricingSettingsTests(TestCase):
+    def setUp(self):
+        self.staff = User.objects.create_user('staff', password='secret', is_staff=True)
+        self.client.force_login(self.staff)
+        DistanceBasedFee.objects.create(min_distance_km=0, max_distance_km=30, fee=100, description='Near')
+
+    def test_overlapping_tier_is_refused_with_a_message(self):
+        response = self.client.post(reverse('dashboard:pricing_settings'), {
+            'action': 'add_distance_fee',
+            'min_distance_km': 10,
+            'max_distance_km': 999,
+            'fee': '250.00',
+            'description': 'Far',
+        }, follow=True)
+        self.assertContains(response, 'overlaps 0-30 km')
+        self.assertEqual(DistanceBasedFee.objects.count(), 1)
+
+    def test_price_matrix_csv(self):
+        make_product(name='Pod', monthly_rate=199)
+        make_product(name='Retired Pod', is_active=False)
+        with self.captureOnCommitCallbacks(execute=True):
+            DistanceBasedFee.objects.filter(min_distance_km=0).update(fee=250)
+            DistanceBasedFee.objects.create(min_distance_km=30, max_distance_km=999, fee=300, description='Far')
+
+        response = self.client.get(reverse('dashboard:price_matrix'))
+        rows = list(csv.reader(response.content.decode().splitlines()))
+        self.assertEqual(rows[0], ['Product', 'Months', 'Distance (km)', 'Rental', 'Transport Fee', 'Total'])
+        self.assertEqual(len(rows), 1 + len(RENTAL_MONTH_CHOICES) * 2)
+        self.assertIn(['Pod', '1', '0-30', '199.00', '250.00', '449.00'], rows)
+        # 30 km is shared; the upper tier's own row still shows its own fee
+        self.assertIn(['Pod', '12', '30-999', '2388.00', '300.00', '2688.00'], rows)
 
-# Create your tests here.
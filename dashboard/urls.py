@@ -12,6 +12,8 @@ urlpatterns = [
     path('inventory/<int:product_id>/edit/', views.edit_product, name='edit_product'),
     path('inventory/<int:product_id>/delete/', views.delete_product, name='delete_product'),
     path('pricing/', views.pricing_settings, name='pricing_settings'),
+    path('pricing/matrix.csv', views.price_matrix, name='price_matrix'),
+    path('metrics/', views.metrics_snapshot, name='metrics'),
     path('blackouts/', views.manage_blackouts, name='manage_blackouts'),
     path('users/', views.manage_users, name='manage_users'),
     path('users/create/', views.create_user, name='create_user'),
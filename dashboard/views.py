@@ -5,6 +5,17 @@ from django.utils import timezone
 from datetime import timedelta
 from bookings.models import Booking, BookingStatus
 from products.models import Product, PricingSetting, BlackoutDate, DistanceBasedFee
+from products.availability import annotate_availability
+from products.fees import get_fee_table
+from products.pricing import quote_matrix
+from bookings.forms import RENTAL_MONTH_CHOICES
+from bookings.webhooks import inbox_stats
+from notifications.outbox import outbox_stats
+from django.http import HttpResponse, JsonResponse
+from bingo_rentals import metrics
+from .pagination import keyset_page
+import csv
+from django.core.exceptions import ValidationError
 from django.contrib import messages
 from django.contrib.auth.models import User
 from django.contrib.auth.forms import UserCreationForm, UserChangeForm
@@ -13,6 +24,9 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+# Orders per page in manage_orders
+ORDERS_PAGE_SIZE = 50
+
 
 # Custom decorator to require staff access
 def staff_required(view_func):
@@ -65,22 +79,9 @@ def dashboard_home(request):
     ).count()
 
     # Units available (total stock - active rentals)
-    products = Product.objects.annotate(
-        active_rentals=Count(
-            'bookings',
-            filter=Q(
-                bookings__status__in=[BookingStatus.CONFIRMED, BookingStatus.IN_PROGRESS],
-                bookings__drop_off_date__lte=today,
-                bookings__pickup_date__gte=today
-            ) | Q(
-                bookings__status__in=[BookingStatus.CONFIRMED, BookingStatus.IN_PROGRESS],
-                bookings__drop_off_date__lte=today,
-                bookings__pickup_date__isnull=True
-            )
-        )
-    )
+    products = annotate_availability(Product.objects.all(), today)
 
-    total_available = sum(p.stock_quantity - p.active_rentals for p in products)
+    total_available = sum(p.available_units for p in products)
 
     # Blackout dates coming up
     blackout_dates = BlackoutDate.objects.filter(
@@ -109,25 +110,49 @@ def dashboard_home(request):
 
 @staff_required
 def manage_orders(request):
-    """View and manage all orders"""
-    status_filter = request.GET.get('status', 'all')
-    date_filter = request.GET.get('date', 'all')
-
-    orders = Booking.objects.select_related('product').order_by('-created_at')
+    """View and manage all orders, one keyset page at a time"""
+    status_filter = request.GET.get('status') or 'all'
+    date_filter = request.GET.get('date_range') or 'all'
+
+    # Only the columns the table shows (see dashboard/pagination.py)
+    orders = Booking.objects.select_related('product').only(
+        'booking_id', 'customer_name', 'customer_email', 'drop_off_date',
+        'total_amount', 'status', 'created_at', 'product__name',
+    )
 
     # Apply filters
     if status_filter != 'all':
         orders = orders.filter(status=status_filter)
 
+    today = timezone.localdate()
     if date_filter == 'today':
-        orders = orders.filter(drop_off_date=timezone.now().date())
+        orders = orders.filter(drop_off_date=today)
     elif date_filter == 'week':
-        week_start = timezone.now().date()
-        week_end = week_start + timedelta(days=7)
-        orders = orders.filter(drop_off_date__range=[week_start, week_end])
+        orders = orders.filter(drop_off_date__range=[today, today + timedelta(days=7)])
+    elif date_filter == 'month':
+        month_start = today.replace(day=1)
+        next_month = (month_start + timedelta(days=32)).replace(day=1)
+        orders = orders.filter(drop_off_date__gte=month_start, drop_off_date__lt=next_month)
+
+    page = keyset_page(
+        orders, ORDERS_PAGE_SIZE,
+        after=request.GET.get('after'), before=request.GET.get('before'),
+    )
+
+    # Page links keep the filters and swap the cursor
+    def page_query(**cursor):
+        query = request.GET.copy()
+        query.pop('after', None)
+        query.pop('before', None)
+        query.update(cursor)
+        return query.urlencode()
 
     context = {
-        'orders': orders,
+        'bookings': page.rows,
+        'page': page,
+        'next_query': page_query(after=page.next_cursor) if page.has_next else '',
+        'previous_query': page_query(before=page.previous_cursor) if page.has_previous else '',
+        'first_query': page_query() if page.has_previous else '',
         'status_filter': status_filter,
         'date_filter': date_filter,
         'status_choices': BookingStatus.choices,
@@ -169,12 +194,7 @@ def order_detail(request, booking_id):
 @staff_required
 def manage_inventory(request):
     """Manage product inventory"""
-    products = Product.objects.annotate(
-        active_rentals=Count(
-            'bookings',
-            filter=Q(bookings__status__in=[BookingStatus.CONFIRMED, BookingStatus.IN_PROGRESS])
-        )
-    )
+    products = annotate_availability(Product.objects.all(), timezone.now().date())
 
     if request.method == 'POST':
         action = request.POST.get('action')
@@ -268,7 +288,7 @@ def delete_product(request, product_id):
 @staff_required
 def pricing_settings(request):
     """Update pricing settings and distance-based fees"""
-    pricing = PricingSetting.get_settings()
+    pricing = PricingSetting.get_settings(cached=False)
     distance_fees = DistanceBasedFee.objects.all().order_by('min_distance_km')
 
     if request.method == 'POST':
@@ -286,19 +306,27 @@ def pricing_settings(request):
             fee.fee = request.POST.get('fee')
             fee.description = request.POST.get('description')
             fee.is_active = request.POST.get('is_active') == 'on'
-            fee.save()
-            messages.success(request, f'Distance fee updated: {fee.description}')
+            try:
+                fee.full_clean()
+                fee.save()
+                messages.success(request, f'Distance fee updated: {fee.description}')
+            except ValidationError as e:
+                messages.error(request, f'Error updating distance fee: {e.messages[0]}')
         
         elif action == 'add_distance_fee':
             try:
-                DistanceBasedFee.objects.create(
-                    min_distance_km=request.POST.get('min_distance_km'),
-                    max_distance_km=request.POST.get('max_distance_km'),
+                fee = DistanceBasedFee(
+                    min_distance_km=int(request.POST.get('min_distance_km')),
+                    max_distance_km=int(request.POST.get('max_distance_km')),
                     fee=request.POST.get('fee'),
                     description=request.POST.get('description'),
                     is_active=True
                 )
+                fee.full_clean()
+                fee.save()
                 messages.success(request, 'New distance fee tier added')
+            except ValidationError as e:
+                messages.error(request, f'Error adding distance fee: {e.messages[0]}')
             except Exception as e:
                 messages.error(request, f'Error adding distance fee: {str(e)}')
         
@@ -312,6 +340,45 @@ def pricing_settings(request):
     return render(request, 'dashboard/pricing_settings.html', context)
 
 
+@staff_required
+def price_matrix(request):
+    """CSV of the customer price for every product, term and distance tier"""
+    fee_table = get_fee_table()
+    products = list(Product.objects.filter(is_active=True).only('id', 'name', 'monthly_rate'))
+    months_options = [months for months, _ in RENTAL_MONTH_CHOICES]
+    # Each tier's own fee: looking one up by distance would hand a shared
+    # boundary to the tier below
+    tier_fees = {
+        (min_km, max_km): fee
+        for min_km, max_km, fee in zip(fee_table.mins, fee_table.maxes, fee_table.fees)
+    }
+    quotes = quote_matrix(products, months_options, fees=tier_fees)
+
+    response = HttpResponse(content_type='text/csv')
+    response['Content-Disposition'] = 'attachment; filename="price-matrix.csv"'
+    writer = csv.writer(response)
+    writer.writerow(['Product', 'Months', 'Distance (km)', 'Rental', 'Transport Fee', 'Total'])
+    for product in products:
+        for months in months_options:
+            for min_km, max_km in tier_fees:
+                quote = quotes[(product.id, months, (min_km, max_km))]
+                writer.writerow([
+                    product.name, months, f'{min_km}-{max_km}',
+                    quote.monthly_cost, quote.transport_fee, quote.total,
+                ])
+    return response
+
+
+@staff_required
+def metrics_snapshot(request):
+    """Latency histograms and counters recorded by this server process"""
+    snapshot = metrics.snapshot(request.GET.get('prefix', ''))
+    # Shared across processes, unlike the in-process histograms
+    snapshot['webhook_inbox'] = inbox_stats()
+    snapshot['notification_outbox'] = outbox_stats()
+    return JsonResponse(snapshot)
+
+
 @staff_required
 def manage_blackouts(request):
     """Manage blackout dates"""
@@ -0,0 +1,173 @@
+"""
+Celery dispatch that fails fast when the broker is down.
+
+Notifications used to try apply_async on every call. With Redis
+down, kombu and the Redis result backend retried the connection for up to
+twenty seconds before giving up, all inside the payment response, and each
+fallback then started its own daemon thread.
+
+Dispatch now goes through a circuit breaker:
+
+- closed: tasks are published with short connect timeouts, no publish
+  retries and no result subscription, so a dead broker costs at most
+  CELERY_BROKER_CONNECTION_TIMEOUT
+- open: after a failure the broker is not tried at all for
+  NOTIFICATION_BREAKER_RESET_SECONDS; the open state is also written to the
+  cache, so other gunicorn workers skip the broker without paying for a
+  failure of their own
+- half-open: after that, one caller probes the broker with a real dispatch
+  and closes the breaker if it succeeds
+
+Outbox deliveries that cannot be queued run on a small thread pool in this
+process (outbox.nudge_delivery). The pool has a queue limit: beyond it the
+rows wait in the outbox rather than piling up threads.
+"""
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.cache import cache
+
+from bingo_rentals import metrics
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitBreaker:
+    """
+    Failure gate for a remote dependency, shared between processes via the cache.
+
+    Args:
+        name: cache key suffix and metrics name
+        reset_seconds: how long to stay open before letting a probe through
+        clock: returns the current time in seconds
+    """
+
+    def __init__(self, name, reset_seconds, clock=time.time):
+        self.name = name
+        self.reset_seconds = reset_seconds
+        self.clock = clock
+        self.state = CLOSED
+        self.opened_until = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def cache_key(self):
+        return f'breaker:{self.name}:open_until'
+
+    def _shared_open_until(self):
+        try:
+            return cache.get(self.cache_key) or 0.0
+        except Exception:
+            # The cache may live on the same Redis that just went away
+            return 0.0
+
+    def allow(self):
+        """True if the caller may try the dependency now"""
+        now = self.clock()
+        with self._lock:
+            if self.state == CLOSED:
+                shared = self._shared_open_until()
+                if shared <= now:
+                    return True
+                self.state, self.opened_until = OPEN, shared
+            if self.state == OPEN and now >= self.opened_until:
+                self.state = HALF_OPEN
+            if self.state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            recovered = self.state != CLOSED
+            self.state = CLOSED
+            self._probing = False
+        if recovered:
+            logger.info(f'{self.name} recovered, circuit closed')
+            try:
+                cache.delete(self.cache_key)
+            except Exception:
+                pass
+
+    def record_failure(self):
+        opened_until = self.clock() + self.reset_seconds
+        with self._lock:
+            self.state = OPEN
+            self.opened_until = opened_until
+            self._probing = False
+        metrics.incr(f'breaker.{self.name}.opened')
+        try:
+            cache.set(self.cache_key, opened_until, timeout=self.reset_seconds)
+        except Exception:
+            pass
+
+
+class BoundedExecutor:
+    """ThreadPoolExecutor that refuses work beyond a queue limit"""
+
+    def __init__(self, max_workers, queue_limit):
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='notify')
+        self._slots = threading.BoundedSemaphore(max_workers + queue_limit)
+
+    def submit(self, func, *args, **kwargs):
+        """Schedule func, or return None if the queue is full"""
+        if not self._slots.acquire(blocking=False):
+            return None
+        try:
+            future = self._pool.submit(func, *args, **kwargs)
+        except RuntimeError:
+            # Interpreter shutting down
+            self._slots.release()
+            return None
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+
+broker_breaker = CircuitBreaker('celery_broker', settings.NOTIFICATION_BREAKER_RESET_SECONDS)
+
+_fallback = None
+_fallback_lock = threading.Lock()
+
+
+def fallback_executor():
+    """The process-wide pool for notifications sent without Celery"""
+    global _fallback
+    if _fallback is None:
+        with _fallback_lock:
+            if _fallback is None:
+                _fallback = BoundedExecutor(
+                    settings.NOTIFICATION_FALLBACK_WORKERS,
+                    settings.NOTIFICATION_FALLBACK_QUEUE_LIMIT,
+                )
+    return _fallback
+
+
+def enqueue(task_func, args=(), kwargs=None):
+    """
+    Publish a task unless the broker is known to be down.
+
+    Returns:
+        bool: True if the task was handed to the broker
+    """
+    if not broker_breaker.allow():
+        metrics.incr('notifications.dispatch.skipped')
+        return False
+    try:
+        with metrics.timer('notifications.dispatch'):
+            # No retries and no result subscription: both retry for seconds
+            task_func.apply_async(args=args, kwargs=kwargs or {}, retry=False, ignore_result=True)
+    except Exception as e:
+        broker_breaker.record_failure()
+        logger.warning(f'Celery unavailable ({type(e).__name__}), circuit open for '
+                       f'{broker_breaker.reset_seconds}s')
+        return False
+    broker_breaker.record_success()
+    return True
@@ -0,0 +1,126 @@
+"""
+Batched email sending.
+
+send_email_notification used to call email.send() per message, which opens
+and closes an SMTP connection, and a TLS session with SendGrid, every time;
+a reminder sweep paid one handshake per booking. send_email_batch() sends a
+whole batch over one get_connection(), opening a new one every
+EMAIL_BATCH_SIZE messages to stay within the provider's per-connection
+limit, and reports which messages went out so the sent flags can be written
+back in one statement.
+
+A batch may be given a deadline after which no further message is started;
+the send under way is bounded by EMAIL_TIMEOUT, which applies to every SMTP
+socket operation, so a server that stops answering cannot hold the batch.
+"""
+import logging
+import time
+from smtplib import SMTPRecipientsRefused, SMTPResponseException
+
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+
+from bingo_rentals import metrics
+from .rendering import render, render_many
+
+logger = logging.getLogger(__name__)
+
+
+def _message(subject, to_email, text_content, html_content):
+    email = EmailMultiAlternatives(
+        subject=subject,
+        body=text_content,
+        from_email=settings.DEFAULT_FROM_EMAIL,
+        to=[to_email]
+    )
+    email.attach_alternative(html_content, "text/html")
+    return email
+
+
+def build_email(subject, to_email, template_name, context):
+    """Render the HTML and text versions of an email template into a message"""
+    return _message(subject, to_email, *render(template_name, context))
+
+
+def build_emails(template_name, recipients):
+    """
+    Render one email template for many recipients.
+
+    Args:
+        recipients: (subject, to_email, context) tuples
+
+    Returns:
+        list: one message per recipient, in order
+    """
+    recipients = list(recipients)
+    with metrics.timer('email.render_batch'):
+        rendered = render_many(template_name, [context for _, _, context in recipients])
+    return [
+        _message(subject, to_email, text, html)
+        for (subject, to_email, _), (text, html) in zip(recipients, rendered)
+    ]
+
+
+def _past(deadline):
+    return deadline is not None and time.monotonic() >= deadline
+
+
+def _send_chunk(messages, deadline=None):
+    results = []
+    connection = get_connection()
+    try:
+        connection.open()
+        for email in messages:
+            if _past(deadline):
+                logger.error(f'Email batch deadline passed, {len(messages) - len(results)} left unsent')
+                break
+            try:
+                with metrics.timer('email.send'):
+                    sent = bool(connection.send_messages([email]))
+            except Exception as e:
+                logger.error(f'Email sending failed to {", ".join(email.to)}: {str(e)}')
+                sent = False
+                if not isinstance(e, (SMTPRecipientsRefused, SMTPResponseException)):
+                    # The server may have dropped us; carry on over a fresh connection
+                    connection.close()
+                    connection.open()
+            if sent:
+                logger.info(f'Email sent to {", ".join(email.to)}: {email.subject}')
+            else:
+                metrics.incr('email.send.errors')
+            results.append(sent)
+    except Exception as e:
+        logger.error(f'Email connection failed: {str(e)}')
+    finally:
+        connection.close()
+    # Whatever a connection failure or the deadline left unsent counts as failed
+    unsent = len(messages) - len(results)
+    if unsent:
+        metrics.incr('email.send.errors', unsent)
+    return results + [False] * unsent
+
+
+def send_email_batch(messages, chunk_size=None, deadline=None):
+    """
+    Send many emails, reusing one connection per chunk.
+
+    Args:
+        messages: EmailMessage instances
+        chunk_size: messages per connection; defaults to EMAIL_BATCH_SIZE
+        deadline: time.monotonic() after which no further message is started
+
+    Returns:
+        list: one bool per message, in order
+    """
+    messages = list(messages)
+    chunk_size = chunk_size or settings.EMAIL_BATCH_SIZE
+    results = []
+    for start in range(0, len(messages), chunk_size):
+        chunk = messages[start:start + chunk_size]
+        if _past(deadline):
+            metrics.incr('email.send.errors', len(chunk))
+            results.extend([False] * len(chunk))
+            continue
+        with metrics.timer('email.batch'):
+            results.extend(_send_chunk(chunk, deadline))
+    return results
@@ -0,0 +1,74 @@
+"""
+Measure how fast reminder emails render, before and after the cached
+rendering pipeline (notifications/rendering.py):
+    python manage.py benchmark_email_rendering --messages 2000
+Bookings are built in memory, so no database is needed. Each round renders
+the text and HTML version of every message:
+- render_to_string: two loader lookups per message, model instances in the context
+- cached, per message: compiled templates and a plain-value context
+- cached, batch: the same through render_many(), as a reminder sweep does
+"""
+import time
+from datetime import date, timedelta
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.template.loader import render_to_string
+from django.test.utils import override_settings
+
+from bookings.models import Booking, PickupRequest
+from notifications.rendering import email_context, get_email_template, render, render_many
+from products.models import Product
+
+
+class Command(BaseCommand):
+    help = 'Benchmark email template rendering for a reminder sweep'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=1000)
+        parser.add_argument('--template', default='drop_off_reminder',
+                            help='Template under templates/emails/, without extension')
+
+    def handle(self, *args, **options):
+        name = options['template']
+        product = Product(name='Storage Pod', monthly_rate=Decimal('199.00'))
+        bookings = []
+        for i in range(options['messages']):
+            booking = Booking(
+                product=product,
+                customer_name=f'Customer {i}',
+                customer_email=f'customer{i}@example.com',
+                drop_off_date=date.today() + timedelta(days=1),
+                rental_months=2,
+                total_amount=Decimal('575.00'),
+                delivery_address=f'{i} Main St',
+                delivery_city='Toronto',
+                delivery_state='ON',
+                delivery_zip='M5V 1A1',
+            )
+            pickup = PickupRequest(booking=booking, requested_pickup_date=date.today() + timedelta(days=60))
+            booking.pickup_request = pickup
+            bookings.append((booking, pickup))
+
+        def legacy():
+            for booking, pickup in bookings:
+                context = {'booking': booking, 'site_name': 'Rental Services', 'pickup': pickup,
+                           'pickup_date': pickup.requested_pickup_date}
+                render_to_string(f'emails/{name}.html', context)
+                render_to_string(f'emails/{name}.txt', context)
+
+        with override_settings(DEBUG=False):
+            get_email_template(name)
+            self.report('render_to_string', len(bookings), legacy)
+            self.report('cached, per message', len(bookings), lambda: [
+                render(name, email_context(booking, pickup)) for booking, pickup in bookings
+            ])
+            self.report('cached, batch', len(bookings), lambda: render_many(
+                name, [email_context(booking, pickup) for booking, pickup in bookings]
+            ))
+
+    def report(self, label, count, run):
+        started = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - started
+        self.stdout.write(f'{label:<24} {count} messages in {elapsed:6.3f}s = {count / elapsed:9.0f} msg/s')
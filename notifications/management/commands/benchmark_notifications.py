@@ -0,0 +1,201 @@
+"""
+Push synthetic bookings through the notification pipelines offline and
+report throughput, latency and retries, to compare changes to notifications/
+run to run:
+    python manage.py benchmark_notifications --bookings 500 --smtp-latency-ms 40 \
+        --sms-latency-ms 80 --email-failure-rate 0.02 --sms-failure-rate 0.02
+
+Emails go to a run_fake_smtp sink and SMS to a run_fake_twilio stand-in,
+both started on background threads. The confirmation pipeline queues one
+confirmation per booking and drains the outbox; the reminder pipeline runs
+the chunked, leased reminder sweep over the same bookings. Failed channels
+are retried immediately, so a run ends when every notification is sent or
+has used up NOTIFICATION_MAX_ATTEMPTS. Only rows of the synthetic bookings
+are touched, and they are deleted at the end.
+
+Queued-to-completed percentiles are exact; the per-call ones come from
+bingo_rentals.metrics and are bucket upper bounds.
+"""
+import logging
+import math
+import threading
+import time
+from datetime import timedelta
+from unittest import mock
+
+from django.core.management.base import BaseCommand
+from django.db.models import Sum
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from bingo_rentals import metrics
+from bookings.models import Booking, BookingStatus, TaskLease
+from notifications import sms, tasks
+from notifications.management.commands import run_fake_smtp, run_fake_twilio
+from notifications.models import ChannelStatus, NotificationKind, NotificationOutbox
+from notifications.outbox import deliver_batch, queue_notifications
+from products.models import Product
+
+SWEEP_NAME = 'benchmark_reminders'
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    return values[max(0, math.ceil(fraction * len(values)) - 1)]
+
+
+class Command(BaseCommand):
+    help = 'Benchmark notification delivery against local SMTP and Twilio stand-ins'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--bookings', type=int, default=200)
+        parser.add_argument('--pipeline', choices=['confirmation', 'reminder', 'both'], default='both')
+        parser.add_argument('--workers', type=int, default=8, help='Concurrent SMS sends per batch')
+        parser.add_argument('--batch-size', type=int, default=50, help='Outbox rows per batch')
+        parser.add_argument('--smtp-latency-ms', type=float, default=30)
+        parser.add_argument('--sms-latency-ms', type=float, default=60)
+        parser.add_argument('--jitter-ms', type=float, default=20)
+        parser.add_argument('--email-failure-rate', type=float, default=0.0)
+        parser.add_argument('--sms-failure-rate', type=float, default=0.0)
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        # Per-request and per-message logging would dominate the run
+        logging.getLogger('twilio.http_client').setLevel(logging.WARNING)
+        logging.getLogger('notifications').setLevel(logging.CRITICAL)
+        smtp = run_fake_smtp.make_server(
+            port=0, latency_ms=options['smtp_latency_ms'], jitter_ms=options['jitter_ms'],
+            failure_rate=options['email_failure_rate'], seed=options['seed'],
+        )
+        twilio = run_fake_twilio.make_server(
+            port=0, latency_ms=options['sms_latency_ms'], jitter_ms=options['jitter_ms'],
+            failure_rate=options['sms_failure_rate'], seed=options['seed'],
+        )
+        for server in (smtp, twilio):
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        product = Product.objects.create(
+            name=f'Notification Bench {timezone.now():%H%M%S%f}',
+            category='storage_pod',
+            description='Synthetic product for the notification benchmark',
+            size_description='16ft',
+            monthly_rate=199,
+            stock_quantity=options['bookings'],
+            image='',
+            is_active=False,
+        )
+        tomorrow = timezone.localdate() + timedelta(days=1)
+        # bulk_create sends no post_save signals, so no reminders are scheduled
+        Booking.objects.bulk_create([
+            Booking(
+                product=product,
+                customer_name=f'Bench Customer {i}',
+                customer_email=f'bench{i}@example.com',
+                customer_phone=f'416555{i % 10000:04d}',
+                delivery_address=f'{i} Bench St',
+                delivery_city='Toronto',
+                delivery_state='ON',
+                delivery_zip='M5H2N2',
+                drop_off_date=tomorrow,
+                rental_months=2,
+                monthly_rate=199,
+                total_amount=648,
+                status=BookingStatus.CONFIRMED,
+                payment_status='paid',
+            )
+            for i in range(options['bookings'])
+        ], batch_size=500)
+
+        overrides = {
+            'EMAIL_BACKEND': 'django.core.mail.backends.smtp.EmailBackend',
+            'EMAIL_HOST': '127.0.0.1',
+            'EMAIL_PORT': smtp.server_address[1],
+            'EMAIL_USE_TLS': False,
+            'EMAIL_USE_SSL': False,
+            'EMAIL_HOST_USER': '',
+            'EMAIL_HOST_PASSWORD': '',
+            'TWILIO_ACCOUNT_SID': 'ACbenchmark',
+            'TWILIO_AUTH_TOKEN': 'benchmark',
+            'TWILIO_PHONE_NUMBER': '+15550000000',
+            'TWILIO_API_BASE': f'http://127.0.0.1:{twilio.server_port}',
+            'TWILIO_POOL_SIZE': options['workers'],
+            'TWILIO_SMS_PER_SECOND': 1e9,
+            'TWILIO_SMS_BURST': 1e6,
+            'NOTIFICATION_OUTBOX_WORKERS': options['workers'],
+            'NOTIFICATION_RETRY_BASE_SECONDS': 0,
+            'REMINDER_SWEEP_CHUNK_SIZE': options['batch_size'],
+        }
+        pipelines = ['confirmation', 'reminder'] if options['pipeline'] == 'both' else [options['pipeline']]
+        try:
+            # Sweep chunks are delivered here instead of by Celery workers
+            with override_settings(**overrides), mock.patch('notifications.tasks.enqueue', return_value=False):
+                sms.reset()
+                for pipeline in pipelines:
+                    self.run(pipeline, product, options, smtp, twilio)
+        finally:
+            sms.reset()
+            for server in (smtp, twilio):
+                server.shutdown()
+                server.server_close()
+            Booking.objects.filter(product=product).delete()
+            TaskLease.objects.filter(name=f'sweep.{SWEEP_NAME}').delete()
+            product.delete()
+
+    def drain(self, rows, batch_size):
+        """Deliver the benchmark's due rows until none are left"""
+        while True:
+            ids = list(rows.filter(next_attempt_at__lte=timezone.now()).values_list('pk', flat=True)[:batch_size])
+            if not ids:
+                return
+            deliver_batch(ids)
+
+    def run(self, pipeline, product, options, smtp, twilio):
+        kind = {
+            'confirmation': NotificationKind.BOOKING_CONFIRMATION,
+            'reminder': NotificationKind.DROP_OFF_REMINDER,
+        }[pipeline]
+        rows = NotificationOutbox.objects.filter(booking__product=product, kind=kind)
+        booking_ids = Booking.objects.filter(product=product).values_list('pk', flat=True)
+        for prefix in ('email.', 'sms.', 'outbox.'):
+            metrics.reset(prefix)
+        smtp_before = (smtp.RequestHandlerClass.connections, smtp.RequestHandlerClass.refused)
+        sms_before = twilio.RequestHandlerClass.accepted
+
+        started = time.perf_counter()
+        if pipeline == 'confirmation':
+            queue_notifications(kind, [(pk, None) for pk in booking_ids])
+        else:
+            tasks.sweep(SWEEP_NAME, kind, ((pk, None) for pk in booking_ids.iterator(chunk_size=options['batch_size'])))
+        self.drain(rows.filter(completed_at__isnull=True), options['batch_size'])
+        elapsed = time.perf_counter() - started
+
+        emails = rows.filter(email_status=ChannelStatus.SENT).count()
+        texts = rows.filter(sms_status=ChannelStatus.SENT).count()
+        failed = rows.filter(email_status=ChannelStatus.FAILED).count() + rows.filter(sms_status=ChannelStatus.FAILED).count()
+        attempts = rows.aggregate(total=Sum('attempts'))['total'] or 0
+        notifications = rows.count()
+        delivered_ms = sorted(
+            (completed - created).total_seconds() * 1000
+            for created, completed in rows.exclude(completed_at=None).values_list('created_at', 'completed_at')
+        )
+
+        self.stdout.write(self.style.MIGRATE_HEADING(f'{pipeline}: {notifications} notifications'))
+        self.stdout.write(f'  {emails} emails + {texts} SMS sent in {elapsed:.2f}s = '
+                          f'{(emails + texts) / elapsed:.1f} msg/s, {notifications / elapsed:.1f} notifications/s')
+        self.stdout.write(f'  retries={attempts - notifications} failed channels={failed} '
+                          f'smtp connections={smtp.RequestHandlerClass.connections - smtp_before[0]} '
+                          f'smtp refused={smtp.RequestHandlerClass.refused - smtp_before[1]} '
+                          f'sms accepted={twilio.RequestHandlerClass.accepted - sms_before}')
+        self.stdout.write(f"  {'latency (ms)':<26} {'count':>6} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8}")
+        self.stdout.write(
+            f"  {'queued -> completed':<26} {len(delivered_ms):>6} {percentile(delivered_ms, 0.50):>8.1f} "
+            f"{percentile(delivered_ms, 0.95):>8.1f} {percentile(delivered_ms, 0.99):>8.1f} "
+            f"{(delivered_ms[-1] if delivered_ms else 0.0):>8.1f}"
+        )
+        snapshot = metrics.snapshot()
+        for name in ('email.send', 'sms.send', 'email.batch', 'outbox.batch'):
+            hist = snapshot['histograms'].get(name)
+            if hist:
+                self.stdout.write(f"  {name:<26} {hist['count']:>6} {hist['p50_ms']:>8} "
+                                  f"{hist['p95_ms']:>8} {hist['p99_ms']:>8} {hist['max_ms']:>8}")
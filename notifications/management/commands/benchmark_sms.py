@@ -0,0 +1,67 @@
+"""
+Compare SMS throughput of a new Twilio client per message with the shared,
+pooled client, sequentially and in bulk, against a local Twilio stand-in:
+    python manage.py benchmark_sms --messages 200 --latency-ms 80 --workers 8
+The stand-in speaks plain HTTP, so the TLS handshakes a new client costs
+against api.twilio.com are not included; the real gap is larger.
+"""
+import logging
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+from twilio.rest import Client
+
+from notifications import sms
+from notifications.management.commands.run_fake_twilio import make_server
+
+
+class Command(BaseCommand):
+    help = 'Benchmark SMS sending against a local Twilio stand-in'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=100)
+        parser.add_argument('--latency-ms', type=float, default=50)
+        parser.add_argument('--jitter-ms', type=float, default=20)
+        parser.add_argument('--workers', type=int, default=8)
+        parser.add_argument('--rate', type=float, default=0,
+                            help='Messages per second for the rate limiter (default: unlimited)')
+
+    def handle(self, *args, **options):
+        logging.getLogger('twilio.http_client').setLevel(logging.WARNING)
+        server = make_server(port=0, latency_ms=options['latency_ms'], jitter_ms=options['jitter_ms'], seed=42)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        api_base = f'http://127.0.0.1:{server.server_port}'
+        rate = options['rate'] or 1e9
+        overrides = {
+            'TWILIO_ACCOUNT_SID': 'ACbenchmark',
+            'TWILIO_AUTH_TOKEN': 'benchmark',
+            'TWILIO_PHONE_NUMBER': '+15550000000',
+            'TWILIO_API_BASE': api_base,
+            'TWILIO_POOL_SIZE': options['workers'],
+            'TWILIO_SMS_PER_SECOND': rate,
+            'TWILIO_SMS_BURST': min(rate, 1e6),
+        }
+        messages = [(f'416555{i:04d}', f'Benchmark message {i}', '+1') for i in range(options['messages'])]
+        try:
+            with override_settings(**overrides):
+                sms.reset()
+                self.report('new client per message', messages, lambda: [
+                    sms.send_sms(*m, client=Client('ACbenchmark', 'benchmark',
+                                                   http_client=sms.PooledHttpClient(1, api_base=api_base)))
+                    for m in messages
+                ])
+                self.report('shared client', messages, lambda: [sms.send_sms(*m) for m in messages])
+                self.report(f"shared client, {options['workers']} threads", messages,
+                            lambda: sms.send_bulk_sms(messages, workers=options['workers']))
+        finally:
+            sms.reset()
+            server.shutdown()
+
+    def report(self, label, messages, run):
+        started = time.perf_counter()
+        results = run()
+        elapsed = time.perf_counter() - started
+        self.stdout.write(f"{label:<32} {sum(results):>5}/{len(messages)} sent in {elapsed:6.2f}s "
+                          f"= {len(messages) / elapsed:8.1f} msg/s")
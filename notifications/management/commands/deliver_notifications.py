@@ -0,0 +1,35 @@
+"""
+Deliver queued notifications without Celery.
+
+    python manage.py deliver_notifications            # drain what is due, then exit
+    python manage.py deliver_notifications --loop     # keep polling, e.g. under systemd
+
+Several instances can run side by side; rows are claimed with SKIP LOCKED.
+"""
+import time
+
+from django.core.management.base import BaseCommand
+
+from notifications.outbox import deliver_due, outbox_stats
+
+
+class Command(BaseCommand):
+    help = 'Deliver due notifications from the outbox'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true', help='Keep polling for due notifications')
+        parser.add_argument('--interval', type=float, default=2.0, help='Seconds between polls with --loop')
+        parser.add_argument('--batch-size', type=int, default=None)
+        parser.add_argument('--workers', type=int, default=None)
+
+    def handle(self, *args, **options):
+        while True:
+            attempted = deliver_due(batch_size=options['batch_size'], workers=options['workers'])
+            if attempted or not options['loop']:
+                stats = outbox_stats()
+                self.stdout.write(f"attempted={attempted} pending={stats['pending']} "
+                                  f"due={stats['due']} failed={stats['failed']}")
+            if not options['loop']:
+                return
+            if not attempted:
+                time.sleep(options['interval'])
@@ -0,0 +1,119 @@
+"""
+Serve an SMTP sink with injected latency and failures.
+
+Accepts mail from Django's SMTP backend without delivering it, so email
+sending can be load-tested offline:
+    python manage.py run_fake_smtp --port 2525 --latency-ms 40 --failure-rate 0.02
+    EMAIL_BACKEND=django.core.mail.backends.smtp.EmailBackend EMAIL_HOST=127.0.0.1 \
+        EMAIL_PORT=2525 EMAIL_USE_TLS=False python manage.py deliver_notifications
+Each message waits latency-ms (plus jitter) after its data, then is accepted
+or, at failure-rate, refused with a temporary 451 error. STARTTLS and AUTH
+are not offered, so the sender must not ask for them.
+"""
+import random
+import socketserver
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+
+
+class FakeSMTPHandler(socketserver.StreamRequestHandler):
+    disable_nagle_algorithm = True
+    latency_ms = 0
+    jitter_ms = 0
+    failure_rate = 0.0
+    rng = random.Random()
+    lock = threading.Lock()
+    connections = 0
+    accepted = 0
+    refused = 0
+
+    def reply(self, line):
+        self.wfile.write(f'{line}\r\n'.encode())
+
+    def handle(self):
+        cls = type(self)
+        with cls.lock:
+            cls.connections += 1
+        self.reply('220 fake-smtp ready')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line[:4].upper()
+            if command == b'EHLO':
+                self.reply('250-fake-smtp')
+                self.reply('250 8BITMIME')
+            elif command == b'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                while self.rfile.readline() not in (b'.\r\n', b''):
+                    pass
+                self.finish_message()
+            elif command == b'QUIT':
+                self.reply('221 Bye')
+                return
+            elif command in (b'HELO', b'MAIL', b'RCPT', b'RSET', b'NOOP'):
+                self.reply('250 OK')
+            else:
+                self.reply('502 Command not implemented')
+
+    def finish_message(self):
+        cls = type(self)
+        with cls.lock:
+            delay = cls.latency_ms + cls.rng.uniform(0, cls.jitter_ms)
+            fail = cls.rng.random() < cls.failure_rate
+        if delay:
+            time.sleep(delay / 1000)
+        with cls.lock:
+            if fail:
+                cls.refused += 1
+            else:
+                cls.accepted += 1
+        self.reply('451 Injected failure, try again later' if fail else '250 OK queued')
+
+
+def make_server(host='127.0.0.1', port=2525, latency_ms=0, jitter_ms=0, failure_rate=0.0, seed=None):
+    """Threading SMTP sink; the handler class counts connections, accepted and refused"""
+    handler = type('Handler', (FakeSMTPHandler,), {
+        'latency_ms': latency_ms,
+        'jitter_ms': jitter_ms,
+        'failure_rate': failure_rate,
+        'rng': random.Random(seed),
+        'lock': threading.Lock(),
+        'connections': 0,
+        'accepted': 0,
+        'refused': 0,
+    })
+    server = socketserver.ThreadingTCPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+class Command(BaseCommand):
+    help = 'Run a local SMTP sink with injected latency and failures'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=2525)
+        parser.add_argument('--latency-ms', type=float, default=0)
+        parser.add_argument('--jitter-ms', type=float, default=0)
+        parser.add_argument('--failure-rate', type=float, default=0.0)
+        parser.add_argument('--seed', type=int, default=None)
+
+    def handle(self, *args, **options):
+        server = make_server(
+            options['host'], options['port'],
+            latency_ms=options['latency_ms'],
+            jitter_ms=options['jitter_ms'],
+            failure_rate=options['failure_rate'],
+            seed=options['seed'],
+        )
+        self.stdout.write(f"Fake SMTP listening on {options['host']}:{options['port']} "
+                          f"(latency {options['latency_ms']}ms, failure rate {options['failure_rate']})")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
@@ -0,0 +1,121 @@
+"""
+Serve a stand-in for Twilio's Messages API with injected latency and failures.
+
+Lets the real twilio client be load-tested offline:
+    python manage.py run_fake_twilio --port 12112 --latency-ms 80 --failure-rate 0.01
+    TWILIO_API_BASE=http://127.0.0.1:12112 python manage.py deliver_notifications
+Only message creation is implemented; every accepted message is counted.
+"""
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+from django.core.management.base import BaseCommand
+
+MESSAGES_URL = re.compile(r'^/2010-04-01/Accounts/(?P<sid>[^/]*)/Messages\.json$')
+
+
+class FakeTwilioHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes; without this, Nagle plus the
+    # client's delayed ACK stalls every reused connection by ~40ms
+    disable_nagle_algorithm = True
+    latency_ms = 0
+    jitter_ms = 0
+    failure_rate = 0.0
+    rng = random.Random()
+    ids = itertools.count(1)
+    lock = threading.Lock()
+    accepted = 0
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        params = {key: values[-1] for key, values in parse_qs(self.rfile.read(length).decode()).items()}
+        match = MESSAGES_URL.match(self.path)
+        if not match:
+            return self._reply(404, {'code': 20404, 'message': 'The requested resource was not found', 'status': 404})
+
+        cls = type(self)
+        with cls.lock:
+            delay = cls.latency_ms + cls.rng.uniform(0, cls.jitter_ms)
+            fail = cls.rng.random() < cls.failure_rate
+        if delay:
+            time.sleep(delay / 1000)
+        if fail:
+            return self._reply(500, {'code': 20500, 'message': 'Injected failure', 'status': 500})
+
+        with cls.lock:
+            number = next(cls.ids)
+            cls.accepted += 1
+        self._reply(201, {
+            'sid': f'SM{number:032x}',
+            'account_sid': match['sid'],
+            'to': params.get('To', ''),
+            'from': params.get('From', ''),
+            'body': params.get('Body', ''),
+            'status': 'queued',
+            'num_segments': '1',
+            'direction': 'outbound-api',
+            'api_version': '2010-04-01',
+        })
+
+
+def make_server(host='127.0.0.1', port=12112, latency_ms=0, jitter_ms=0, failure_rate=0.0, seed=None):
+    """ThreadingHTTPServer answering Twilio message creation; handler class counts accepted"""
+    handler = type('Handler', (FakeTwilioHandler,), {
+        'latency_ms': latency_ms,
+        'jitter_ms': jitter_ms,
+        'failure_rate': failure_rate,
+        'rng': random.Random(seed),
+        'ids': itertools.count(1),
+        'lock': threading.Lock(),
+        'accepted': 0,
+    })
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+class Command(BaseCommand):
+    help = 'Run a local Twilio Messages API stand-in with injected latency and failures'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=12112)
+        parser.add_argument('--latency-ms', type=float, default=0)
+        parser.add_argument('--jitter-ms', type=float, default=0)
+        parser.add_argument('--failure-rate', type=float, default=0.0)
+        parser.add_argument('--seed', type=int, default=None)
+
+    def handle(self, *args, **options):
+        server = make_server(
+            options['host'], options['port'],
+            latency_ms=options['latency_ms'],
+            jitter_ms=options['jitter_ms'],
+            failure_rate=options['failure_rate'],
+            seed=options['seed'],
+        )
+        self.stdout.write(f"Fake Twilio listening on http://{options['host']}:{options['port']} "
+                          f"(latency {options['latency_ms']}ms, failure rate {options['failure_rate']})")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
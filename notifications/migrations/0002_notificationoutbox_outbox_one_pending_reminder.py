@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 02:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bookings', '0009_tasklease'),
+        ('notifications', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name='notificationoutbox',
+            constraint=models.UniqueConstraint(condition=models.Q(('completed_at__isnull', True), ('kind__in', ['drop_off_reminder', 'pickup_reminder'])), fields=('kind', 'booking'), name='outbox_one_pending_reminder'),
+        ),
+    ]
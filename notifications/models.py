@@ -1,3 +1,74 @@
 from django.db import models
+from django.utils import timezone
 
-# Create your models here.
+
+class NotificationKind(models.TextChoices):
+    BOOKING_CONFIRMATION = 'booking_confirmation', 'Booking Confirmation'
+    DROP_OFF_REMINDER = 'drop_off_reminder', 'Drop-off Reminder'
+    PICKUP_CONFIRMATION = 'pickup_confirmation', 'Pickup Confirmation'
+    PICKUP_REMINDER = 'pickup_reminder', 'Pickup Reminder'
+
+
+class ChannelStatus(models.TextChoices):
+    PENDING = 'pending', 'Pending'
+    SENT = 'sent', 'Sent'
+    FAILED = 'failed', 'Failed'
+    SKIPPED = 'skipped', 'Skipped'
+
+
+class NotificationOutbox(models.Model):
+    """
+    A customer notification waiting to be delivered.
+
+    Rows are written in the same transaction as the booking or pickup they
+    are about, and delivered by notifications.outbox with retries, so a
+    notification is sent at least once even if the process dies first.
+    """
+    kind = models.CharField(max_length=30, choices=NotificationKind.choices)
+    booking = models.ForeignKey(
+        'bookings.Booking',
+        on_delete=models.CASCADE,
+        related_name='notifications'
+    )
+    pickup_request = models.ForeignKey(
+        'bookings.PickupRequest',
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+        related_name='notifications'
+    )
+    
+    # Delivery state per channel
+    email_status = models.CharField(max_length=10, choices=ChannelStatus.choices, default=ChannelStatus.PENDING)
+    sms_status = models.CharField(max_length=10, choices=ChannelStatus.choices, default=ChannelStatus.PENDING)
+    attempts = models.IntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    
+    created_at = models.DateTimeField(auto_now_add=True)
+    completed_at = models.DateTimeField(null=True, blank=True)
+    
+    class Meta:
+        ordering = ['next_attempt_at']
+        indexes = [
+            models.Index(
+                fields=['next_attempt_at'],
+                condition=models.Q(completed_at__isnull=True),
+                name='outbox_due_idx',
+            ),
+        ]
+        constraints = [
+            # At most one reminder of each kind waiting per booking, however
+            # many sweeps or signals try to queue one
+            models.UniqueConstraint(
+                fields=['kind', 'booking'],
+                condition=models.Q(
+                    completed_at__isnull=True,
+                    kind__in=[NotificationKind.DROP_OFF_REMINDER, NotificationKind.PICKUP_REMINDER],
+                ),
+                name='outbox_one_pending_reminder',
+            ),
+        ]
+    
+    def __str__(self):
+        return f"{self.get_kind_display()} for {self.booking_id}"
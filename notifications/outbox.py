@@ -0,0 +1,440 @@
+"""
+Transactional notification outbox.
+
+Views used to send notifications with .delay() or from daemon threads after
+the booking was saved, so a crash or a broker outage lost them and nothing
+limited how many were sent at once. Now:
+
+- queue_notification() writes a NotificationOutbox row inside the caller's
+  transaction, so the notification exists if and only if the booking or
+  pickup does; after commit it nudges the delivery task, through the broker
+  circuit breaker, so a healthy broker delivers within moments and a dead
+  one hands the batch to the in-process fallback pool
+- deliver_due() claims due rows in batches with SELECT ... FOR UPDATE SKIP
+  LOCKED, leases them by pushing next_attempt_at forward, and sends the
+  batch's emails over one SMTP connection while its SMS go out at the same
+  time through send_bulk_sms; each channel has a deadline, so a hung SMTP
+  server or Twilio cannot hold the worker past its lease
+- each channel's result is recorded on the row; failed channels are retried
+  with exponential backoff up to NOTIFICATION_MAX_ATTEMPTS, and a worker
+  that dies mid-batch only delays its rows until the lease runs out
+
+Delivery is at least once: a crash between sending and recording the result
+sends that channel again.
+"""
+import logging
+import random
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Count, Exists, OuterRef, Q
+from django.utils import timezone
+
+from bingo_rentals import metrics
+from products.availability import active_statuses
+from .models import ChannelStatus, NotificationKind, NotificationOutbox
+from .email import build_emails, send_email_batch
+from .rendering import email_context
+from .sms import send_bulk_sms
+
+logger = logging.getLogger(__name__)
+
+# Claimed rows are left alone by other workers for this long
+LEASE_SECONDS = 300
+MAX_BACKOFF_SECONDS = 3600
+
+REMINDER_KINDS = (NotificationKind.DROP_OFF_REMINDER, NotificationKind.PICKUP_REMINDER)
+
+
+@dataclass(frozen=True)
+class Message:
+    """
+    What one kind of notification says and which flags it sets.
+
+    subject and sms are format strings over booking, pickup and address;
+    flags are 'booking.<field>' or 'pickup.<field>'.
+    """
+    subject: str
+    template: str
+    sms: str = ''
+    email_flag: str = ''
+    sms_flag: str = ''
+
+
+MESSAGES = {
+    NotificationKind.BOOKING_CONFIRMATION: Message(
+        subject='Booking Confirmed - {booking.booking_id}',
+        template='booking_confirmation',
+        sms='Your rental is confirmed! Delivery on {booking.drop_off_date:%b %d}. Booking ID: {booking.booking_id}',
+        email_flag='booking.confirmation_email_sent',
+        sms_flag='booking.confirmation_sms_sent',
+    ),
+    NotificationKind.DROP_OFF_REMINDER: Message(
+        subject='Delivery on {booking.drop_off_date:%b %d} - {booking.product.name}',
+        template='drop_off_reminder',
+        sms=(
+            'Reminder: Your {booking.product.name} will be delivered on {booking.drop_off_date:%b %d} '
+            'at {booking.delivery_address}'
+        ),
+        email_flag='booking.drop_off_reminder_sent',
+    ),
+    NotificationKind.PICKUP_CONFIRMATION: Message(
+        subject='Pickup Scheduled - {booking.booking_id}',
+        template='pickup_confirmation',
+        sms="Pickup scheduled for {pickup.requested_pickup_date:%b %d}. We'll collect your {booking.product.name}.",
+        email_flag='pickup.pickup_email_sent',
+        sms_flag='pickup.pickup_sms_sent',
+    ),
+    NotificationKind.PICKUP_REMINDER: Message(
+        subject='Pickup Reminder - {booking.booking_id}',
+        template='pickup_reminder',
+        sms='Reminder: Pickup scheduled for {pickup.requested_pickup_date:%b %d} at {address}',
+        email_flag='pickup.pickup_email_sent',
+    ),
+}
+
+
+def queue_notification(kind, booking, pickup_request=None, nudge=True, at=None):
+    """
+    Add a notification to the outbox in the current transaction.
+
+    nudge asks a Celery worker to deliver it once the transaction commits;
+    at schedules it for later instead, e.g. a reminder.
+
+    Returns:
+        NotificationOutbox: the queued row
+    """
+    message = MESSAGES[kind]
+    row = NotificationOutbox.objects.create(
+        kind=kind,
+        booking=booking,
+        pickup_request=pickup_request,
+        sms_status=ChannelStatus.PENDING if message.sms else ChannelStatus.SKIPPED,
+        next_attempt_at=at or timezone.now(),
+    )
+    metrics.incr(f'outbox.queued.{kind}')
+    if nudge and at is None:
+        transaction.on_commit(nudge_delivery)
+    return row
+
+
+def queue_notifications(kind, targets):
+    """
+    Add one notification per (booking_id, pickup_request_id) pair to the outbox.
+
+    For sweeps; the rows are written with one INSERT and nobody is nudged,
+    the caller delivers them. A reminder that is already waiting for a
+    booking is not queued twice (outbox_one_pending_reminder).
+
+    Returns:
+        list: primary keys of the rows now waiting for these targets
+    """
+    targets = list(targets)
+    if not targets:
+        return []
+    sms_status = ChannelStatus.PENDING if MESSAGES[kind].sms else ChannelStatus.SKIPPED
+    NotificationOutbox.objects.bulk_create([
+        NotificationOutbox(kind=kind, booking_id=booking_id, pickup_request_id=pickup_id, sms_status=sms_status)
+        for booking_id, pickup_id in targets
+    ], ignore_conflicts=kind in REMINDER_KINDS)
+    ids = list(NotificationOutbox.objects.filter(
+        kind=kind, booking_id__in=[booking_id for booking_id, _ in targets], completed_at__isnull=True,
+    ).values_list('pk', flat=True))
+    metrics.incr(f'outbox.queued.{kind}', len(ids))
+    return ids
+
+
+def awaiting(kind, target='booking'):
+    """Filter for bookings (or pickups) that already have this kind queued and not done"""
+    return Exists(NotificationOutbox.objects.filter(
+        kind=kind, completed_at__isnull=True, **{target: OuterRef('pk')}
+    ))
+
+
+def nudge_delivery():
+    """
+    Ask a Celery worker to deliver now.
+
+    While the broker is down one batch is delivered on the in-process
+    fallback pool instead. When that pool is full the rows simply wait in
+    the outbox for the next delivery run.
+    """
+    from .dispatch import enqueue, fallback_executor
+    from .tasks import deliver_notification_outbox
+    if enqueue(deliver_notification_outbox):
+        return
+    if fallback_executor().submit(_deliver_in_process) is None:
+        metrics.incr('notifications.fallback.dropped')
+        logger.warning('Fallback delivery pool full, notifications stay in the outbox')
+    else:
+        metrics.incr('notifications.fallback.queued')
+
+
+def _deliver_in_process():
+    try:
+        deliver_due(max_batches=1)
+    except Exception as e:
+        logger.error(f'Fallback outbox delivery failed: {str(e)}')
+    finally:
+        # Pool threads open their own connection; do not leave it behind
+        connection.close()
+
+
+def _format(template, row):
+    booking = row.booking
+    pickup = row.pickup_request
+    address = (pickup and pickup.pickup_address) or booking.delivery_address
+    return template.format(booking=booking, pickup=pickup, address=address)
+
+
+def send_emails(rows, deadline=None):
+    """
+    Send the pending emails of many rows over one connection per chunk,
+    rendering each template once for all rows that use it.
+
+    Args:
+        deadline: time.monotonic() after which no further email is started
+
+    Returns:
+        list: per row, {} or {'email': (sent, error)}
+    """
+    results = [{} for _ in rows]
+    by_template = defaultdict(list)
+    for i, row in enumerate(rows):
+        if row.email_status != ChannelStatus.PENDING:
+            continue
+        try:
+            message = MESSAGES[row.kind]
+            recipient = (
+                _format(message.subject, row),
+                row.booking.customer_email,
+                email_context(row.booking, row.pickup_request),
+            )
+            by_template[message.template].append((i, recipient))
+        except Exception as e:
+            logger.error(f'Error rendering notification {row.pk}: {str(e)}')
+            results[i]['email'] = (False, str(e))
+
+    batch = []
+    for template, items in by_template.items():
+        try:
+            emails = build_emails(template, [recipient for _, recipient in items])
+        except Exception as e:
+            logger.error(f'Error rendering {template} for {len(items)} notifications: {str(e)}')
+            for i, _ in items:
+                results[i]['email'] = (False, str(e))
+            continue
+        batch.extend((i, email) for (i, _), email in zip(items, emails))
+
+    if batch:
+        with metrics.timer('outbox.email'):
+            sent = send_email_batch([email for _, email in batch], deadline=deadline)
+        for (i, _), ok in zip(batch, sent):
+            results[i]['email'] = (ok, '' if ok else 'email not sent')
+    return results
+
+
+def send_sms_batch(rows, pool=None, deadline=None):
+    """
+    Send the pending SMS of many rows through send_bulk_sms.
+
+    Args:
+        pool: executor to send on; send_bulk_sms makes its own by default
+        deadline: time.monotonic() after which no further SMS is started
+
+    Returns:
+        list: per row, {} or {'sms': (sent, error)}
+    """
+    results = [{} for _ in rows]
+    pending = []
+    for i, row in enumerate(rows):
+        if row.sms_status != ChannelStatus.PENDING:
+            continue
+        try:
+            message = _format(MESSAGES[row.kind].sms, row)
+            pending.append((i, (row.booking.customer_phone, message, row.booking.country_code)))
+        except Exception as e:
+            logger.error(f'Error rendering notification {row.pk}: {str(e)}')
+            results[i]['sms'] = (False, str(e))
+
+    if pending:
+        with metrics.timer('outbox.sms'):
+            sent = send_bulk_sms([message for _, message in pending], pool=pool, deadline=deadline)
+        for (i, _), ok in zip(pending, sent):
+            results[i]['sms'] = (ok, '' if ok else 'sms not sent')
+    return results
+
+
+def _on_pool(func, *args):
+    try:
+        return func(*args)
+    finally:
+        # Templates may have queried; don't leak the pool thread's connection
+        connection.close()
+
+
+def backoff(attempts):
+    """Seconds to wait before attempt number attempts + 1"""
+    delay = min(settings.NOTIFICATION_RETRY_BASE_SECONDS * 2 ** (attempts - 1), MAX_BACKOFF_SECONDS)
+    return delay * random.uniform(0.9, 1.1)
+
+
+def record_results(rows, results):
+    """Write per-channel outcomes, retry schedules and the sent flags"""
+    now = timezone.now()
+    flags = defaultdict(set)
+    for row, outcome in zip(rows, results):
+        errors = []
+        for channel, (sent, error) in outcome.items():
+            if sent:
+                setattr(row, f'{channel}_status', ChannelStatus.SENT)
+                flag = getattr(MESSAGES[row.kind], f'{channel}_flag')
+                if flag:
+                    target, field = flag.split('.')
+                    target_id = row.booking_id if target == 'booking' else row.pickup_request_id
+                    flags[(target, field)].add(target_id)
+            else:
+                errors.append(f'{channel}: {error}')
+            metrics.incr(f'outbox.{channel}.{"sent" if sent else "failed"}')
+        row.attempts += 1
+        row.last_error = '; '.join(errors)
+        if not errors:
+            row.completed_at = now
+        elif row.attempts >= settings.NOTIFICATION_MAX_ATTEMPTS:
+            for channel in ('email', 'sms'):
+                if getattr(row, f'{channel}_status') == ChannelStatus.PENDING:
+                    setattr(row, f'{channel}_status', ChannelStatus.FAILED)
+            row.completed_at = now
+            logger.error(f'Giving up on notification {row.pk} after {row.attempts} attempts: {row.last_error}')
+        else:
+            row.next_attempt_at = now + timedelta(seconds=backoff(row.attempts))
+
+    # One UPDATE per target and set of flags, e.g. both confirmation flags
+    # of a booking are set together
+    fields_of = defaultdict(set)
+    for (target, field), ids in flags.items():
+        for target_id in ids:
+            fields_of[(target, target_id)].add(field)
+    updates = defaultdict(list)
+    for (target, target_id), fields in fields_of.items():
+        updates[(target, frozenset(fields))].append(target_id)
+
+    from bookings.models import Booking, PickupRequest
+    targets = {'booking': Booking, 'pickup': PickupRequest}
+    with transaction.atomic():
+        NotificationOutbox.objects.bulk_update(
+            rows, ['email_status', 'sms_status', 'attempts', 'last_error', 'next_attempt_at', 'completed_at']
+        )
+        for (target, fields), ids in updates.items():
+            targets[target].objects.filter(pk__in=ids).update(**{field: True for field in fields})
+
+
+def claim_due(batch_size, ids=None):
+    """Lease up to batch_size due rows, or only those of ids, to this worker"""
+    now = timezone.now()
+    due = NotificationOutbox.objects.filter(completed_at__isnull=True, next_attempt_at__lte=now)
+    if ids is not None:
+        due = due.filter(pk__in=ids)
+    with transaction.atomic():
+        rows = list(
+            due
+            .select_related('booking__product', 'pickup_request')
+            .select_for_update(skip_locked=True, of=('self',))
+            .order_by('next_attempt_at')[:batch_size]
+        )
+        if rows:
+            NotificationOutbox.objects.filter(pk__in=[row.pk for row in rows]).update(
+                next_attempt_at=now + timedelta(seconds=LEASE_SECONDS)
+            )
+    for row in rows:
+        if row.pickup_request:
+            # Templates reach the pickup through the booking too
+            row.booking.pickup_request = row.pickup_request
+    return rows
+
+
+def skip_stale(rows):
+    """Mark reminders for bookings that are no longer active as skipped"""
+    for row in rows:
+        if row.kind in REMINDER_KINDS and row.booking.status not in active_statuses():
+            for channel in ('email', 'sms'):
+                if getattr(row, f'{channel}_status') == ChannelStatus.PENDING:
+                    setattr(row, f'{channel}_status', ChannelStatus.SKIPPED)
+            metrics.incr(f'outbox.skipped.{row.kind}')
+
+
+def deliver(rows, pool):
+    """
+    Send claimed rows and record the outcomes.
+
+    The batch's emails go out over one SMTP connection on a pool thread
+    while its SMS are sent on the rest of the pool. Neither channel starts
+    a send later than NOTIFICATION_<CHANNEL>_TIMEOUT_SECONDS into the batch;
+    what is left is recorded as failed and retried. A send already under
+    way is cut off by EMAIL_TIMEOUT or TWILIO_TIMEOUT_SECONDS.
+    """
+    skip_stale(rows)
+    started = time.monotonic()
+    with metrics.timer('outbox.batch'):
+        emails = pool.submit(
+            _on_pool, send_emails, rows, started + settings.NOTIFICATION_EMAIL_TIMEOUT_SECONDS
+        )
+        sms_results = send_sms_batch(rows, pool, started + settings.NOTIFICATION_SMS_TIMEOUT_SECONDS)
+        results = emails.result()
+        for outcome, sms in zip(results, sms_results):
+            outcome.update(sms)
+        record_results(rows, results)
+
+
+def deliver_due(batch_size=None, workers=None, max_batches=None):
+    """
+    Deliver due notifications until none are left.
+
+    Returns:
+        int: number of rows attempted
+    """
+    batch_size = batch_size or settings.NOTIFICATION_OUTBOX_BATCH_SIZE
+    workers = workers or settings.NOTIFICATION_OUTBOX_WORKERS
+    attempted = 0
+    batches = 0
+    # One more thread for the batch's emails
+    with ThreadPoolExecutor(max_workers=workers + 1, thread_name_prefix='outbox') as pool:
+        while max_batches is None or batches < max_batches:
+            rows = claim_due(batch_size)
+            if not rows:
+                break
+            deliver(rows, pool)
+            attempted += len(rows)
+            batches += 1
+    return attempted
+
+
+def deliver_batch(ids, workers=None):
+    """
+    Deliver the given rows, e.g. one chunk of a reminder sweep.
+
+    Rows another worker has claimed or already delivered are skipped.
+
+    Returns:
+        int: number of rows attempted
+    """
+    rows = claim_due(len(ids), ids)
+    if rows:
+        workers = min(workers or settings.NOTIFICATION_OUTBOX_WORKERS, len(rows))
+        with ThreadPoolExecutor(max_workers=workers + 1, thread_name_prefix='outbox') as pool:
+            deliver(rows, pool)
+    return len(rows)
+
+
+def outbox_stats():
+    """Backlog of the outbox as seen by every process, for monitoring"""
+    return NotificationOutbox.objects.aggregate(
+        pending=Count('pk', filter=Q(completed_at__isnull=True)),
+        due=Count('pk', filter=Q(completed_at__isnull=True, next_attempt_at__lte=timezone.now())),
+        failed=Count('pk', filter=Q(email_status=ChannelStatus.FAILED) | Q(sms_status=ChannelStatus.FAILED)),
+    )
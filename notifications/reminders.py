@@ -0,0 +1,102 @@
+"""
+Per-booking reminder scheduling.
+
+Reminders used to come only from the daily 9:00 sweeps: one burst a day, and
+a booking confirmed after the sweep for a delivery the next morning got no
+reminder at all. Now the reminder is queued in the outbox as soon as the
+booking is confirmed or the pickup requested, with next_attempt_at set to
+REMINDER_SEND_TIME in REMINDER_TIME_ZONE, REMINDER_DAYS_BEFORE days ahead of
+the date; the outbox delivery loop sends it when it falls due.
+
+The signals in notifications/signals.py call sync_booking() and
+sync_pickup() on every save, which move a pending reminder when the date
+changes and cancel it when the booking stops being active. The daily sweeps
+remain as a reconciliation pass for rows changed with queryset update(),
+which sends no signals, and the outbox skips reminders whose booking is no
+longer active when they come due.
+"""
+from datetime import datetime, time, timedelta
+from zoneinfo import ZoneInfo
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from bingo_rentals import metrics
+from products.availability import active_statuses
+from .models import ChannelStatus, NotificationKind, NotificationOutbox
+from .outbox import queue_notification
+
+
+def fire_at(day):
+    """
+    When the reminder for something happening on day should go out.
+
+    Returns:
+        datetime: the scheduled time, now if that has passed but day is
+        still ahead, or None if it is too late to remind
+    """
+    tz = ZoneInfo(settings.REMINDER_TIME_ZONE)
+    scheduled = datetime.combine(
+        day - timedelta(days=settings.REMINDER_DAYS_BEFORE),
+        time.fromisoformat(settings.REMINDER_SEND_TIME),
+        tzinfo=tz,
+    )
+    now = timezone.now()
+    if scheduled > now:
+        return scheduled
+    return now if day > now.astimezone(tz).date() else None
+
+
+def cancel(pending):
+    """Complete pending reminder rows without sending them"""
+    cancelled = pending.update(
+        email_status=ChannelStatus.SKIPPED,
+        sms_status=ChannelStatus.SKIPPED,
+        completed_at=timezone.now(),
+    )
+    if cancelled:
+        metrics.incr('reminders.cancelled', cancelled)
+    return cancelled
+
+
+def schedule(kind, booking, pickup_request=None, day=None):
+    """
+    Make the pending reminder of kind fire for day: queue it, move it, or
+    cancel it if day is None or too close.
+    """
+    pending = NotificationOutbox.objects.filter(kind=kind, booking=booking, completed_at__isnull=True)
+    at = fire_at(day) if day else None
+    if at is None:
+        cancel(pending)
+        return
+    # Rows already being retried keep their backoff schedule
+    if pending.filter(attempts=0).update(next_attempt_at=at):
+        metrics.incr('reminders.rescheduled')
+    elif not pending.exists():
+        try:
+            with transaction.atomic():
+                queue_notification(kind, booking, pickup_request, at=at)
+            metrics.incr('reminders.scheduled')
+        except IntegrityError:
+            # A concurrent save or sweep queued it first (outbox_one_pending_reminder)
+            pass
+
+
+def sync_booking(booking):
+    """Schedule, move or cancel the reminders of a booking after it changed"""
+    active = booking.status in active_statuses()
+    remind = active and not booking.drop_off_reminder_sent
+    schedule(NotificationKind.DROP_OFF_REMINDER, booking, day=booking.drop_off_date if remind else None)
+    if not active:
+        cancel(NotificationOutbox.objects.filter(
+            kind=NotificationKind.PICKUP_REMINDER, booking=booking, completed_at__isnull=True
+        ))
+
+
+def sync_pickup(pickup_request):
+    """Schedule or move the reminder of a pickup after it changed"""
+    day = pickup_request._meta.get_field('requested_pickup_date').to_python(
+        pickup_request.requested_pickup_date
+    )
+    schedule(NotificationKind.PICKUP_REMINDER, pickup_request.booking, pickup_request, day=day)
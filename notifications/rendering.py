@@ -0,0 +1,100 @@
+"""
+Email template rendering.
+
+Every email used two render_to_string calls, each looking its template up
+through the loader chain, and the context held model instances, so each
+{{ booking.x }} first tried booking['x'], caught the TypeError and fell back
+to getattr. Now:
+
+- each .txt/.html pair under templates/emails/ is loaded and compiled once
+  per process (reloaded on every use under DEBUG, so edits show up)
+- email_context() precomputes what the templates use into plain dicts, so
+  rendering takes the dictionary fast path and can never query the database
+- render_many() renders one template for many recipients through a single
+  Context, e.g. for a reminder sweep
+"""
+from dataclasses import dataclass
+from functools import lru_cache
+
+from django.conf import settings
+from django.template import Context, engines
+
+SITE_NAME = 'Rental Services'
+
+
+@dataclass(frozen=True)
+class EmailTemplate:
+    """The compiled text and HTML versions of one email"""
+    text: object
+    html: object
+
+
+def _load(name):
+    engine = engines['django'].engine
+    return EmailTemplate(
+        text=engine.get_template(f'emails/{name}.txt'),
+        html=engine.get_template(f'emails/{name}.html'),
+    )
+
+
+_load_cached = lru_cache(maxsize=None)(_load)
+
+
+def get_email_template(name):
+    """The compiled template pair for templates/emails/<name>.txt and .html"""
+    return _load(name) if settings.DEBUG else _load_cached(name)
+
+
+def render_many(name, contexts):
+    """
+    Render one email template for many recipients.
+
+    Args:
+        name: template name under templates/emails/, without extension
+        contexts: one dict per recipient
+
+    Returns:
+        list: (text, html) per context, in order
+    """
+    template = get_email_template(name)
+    context = Context(autoescape=template.html.engine.autoescape)
+    rendered = []
+    for values in contexts:
+        with context.push(values):
+            rendered.append((template.text.render(context), template.html.render(context)))
+    return rendered
+
+
+def render(name, context):
+    """(text, html) of one email"""
+    return render_many(name, [context])[0]
+
+
+def email_context(booking, pickup=None):
+    """
+    Everything the email templates read, as plain values.
+
+    booking must have its product loaded (select_related) to avoid a query.
+    """
+    booking_values = {
+        'booking_id': booking.booking_id,
+        'customer_name': booking.customer_name,
+        'product': {'name': booking.product.name},
+        'drop_off_date': booking.drop_off_date,
+        'rental_months': booking.rental_months,
+        'total_amount': booking.total_amount,
+        'delivery_address': booking.delivery_address,
+        'delivery_city': booking.delivery_city,
+        'delivery_state': booking.delivery_state,
+        'delivery_zip': booking.delivery_zip,
+    }
+    context = {'booking': booking_values, 'site_name': SITE_NAME}
+    if pickup:
+        pickup_values = {
+            'pickup_notes': pickup.pickup_notes,
+            'requested_pickup_date': pickup.requested_pickup_date,
+        }
+        booking_values['pickup_request'] = pickup_values
+        context['pickup'] = pickup_values
+        context['pickup_date'] = pickup.requested_pickup_date
+    return context
@@ -0,0 +1,22 @@
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from bookings.models import Booking, PickupRequest
+from .reminders import sync_booking, sync_pickup
+
+BOOKING_REMINDER_FIELDS = {'status', 'drop_off_date', 'drop_off_reminder_sent'}
+
+
+@receiver(post_save, sender=Booking)
+def booking_saved(sender, instance, raw=False, update_fields=None, **kwargs):
+    """Keep the booking's reminders in step with its status and dates"""
+    if raw or (update_fields is not None and not BOOKING_REMINDER_FIELDS & set(update_fields)):
+        return
+    sync_booking(instance)
+
+
+@receiver(post_save, sender=PickupRequest)
+def pickup_saved(sender, instance, raw=False, update_fields=None, **kwargs):
+    """Schedule the pickup reminder when a pickup is requested or moved"""
+    if raw or (update_fields is not None and 'requested_pickup_date' not in update_fields):
+        return
+    sync_pickup(instance)
@@ -0,0 +1,203 @@
+"""
+Twilio SMS sending with a shared, keep-alive client.
+
+send_sms_notification used to build a twilio.rest.Client per message, and
+with it a new requests Session, TCP connection and TLS handshake. Now:
+
+- get_twilio_client() returns one Client per process whose HTTP session
+  keeps up to TWILIO_POOL_SIZE connections alive, so concurrent senders
+  reuse warm connections
+- every send first takes a token from a TokenBucket refilled at
+  TWILIO_SMS_PER_SECOND, the throughput of our Twilio sender, so bursts are
+  smoothed out here instead of being queued or rejected by Twilio; the
+  bucket is per process, so divide the account rate between processes
+  that send
+- send_bulk_sms() sends many messages on a thread pool; the outbox sends
+  every batch's SMS through it
+
+TWILIO_API_BASE points the client at a stand-in such as run_fake_twilio for
+offline load tests, like STRIPE_API_BASE does for payments.
+"""
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from twilio.http.http_client import TwilioHttpClient
+from twilio.rest import Client
+
+from bingo_rentals import metrics
+
+logger = logging.getLogger(__name__)
+
+TWILIO_API = 'https://api.twilio.com'
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket.
+
+    Args:
+        rate: tokens added per second
+        capacity: most tokens that can accumulate, i.e. the largest burst
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, timeout=None):
+        """
+        Take one token, waiting for it if needed.
+
+        Returns:
+            bool: False if no token became available within timeout
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                wait = (1 - self._tokens) / self.rate
+            if deadline is not None and now + wait > deadline:
+                return False
+            time.sleep(wait)
+
+
+class PooledHttpClient(TwilioHttpClient):
+    """TwilioHttpClient with a sized keep-alive pool and an optional API base"""
+
+    def __init__(self, pool_size, api_base='', timeout=None):
+        super().__init__(pool_connections=True, timeout=timeout)
+        self.api_base = api_base.rstrip('/')
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def request(self, method, url, *args, **kwargs):
+        if self.api_base and url.startswith(TWILIO_API):
+            url = self.api_base + url[len(TWILIO_API):]
+        return super().request(method, url, *args, **kwargs)
+
+
+def build_client():
+    """A Twilio client as configured in settings"""
+    return Client(
+        settings.TWILIO_ACCOUNT_SID,
+        settings.TWILIO_AUTH_TOKEN,
+        http_client=PooledHttpClient(
+            settings.TWILIO_POOL_SIZE,
+            api_base=settings.TWILIO_API_BASE,
+            timeout=settings.TWILIO_TIMEOUT_SECONDS,
+        ),
+    )
+
+
+_client = None
+_limiter = None
+_lock = threading.Lock()
+
+
+def get_twilio_client():
+    """The process-wide Twilio client"""
+    global _client
+    if _client is None:
+        with _lock:
+            if _client is None:
+                _client = build_client()
+    return _client
+
+
+def get_sms_limiter():
+    """The process-wide SMS rate limiter"""
+    global _limiter
+    if _limiter is None:
+        with _lock:
+            if _limiter is None:
+                _limiter = TokenBucket(settings.TWILIO_SMS_PER_SECOND, settings.TWILIO_SMS_BURST)
+    return _limiter
+
+
+def reset():
+    """Forget the shared client and limiter, e.g. after changing settings"""
+    global _client, _limiter
+    with _lock:
+        _client = _limiter = None
+
+
+def format_phone(to_phone, country_code='+1'):
+    # Remove formatting chars, then combine country code + phone number
+    cleaned_phone = to_phone.replace("-", "").replace("(", "").replace(")", "").replace(" ", "")
+    return f'{country_code}{cleaned_phone}'
+
+
+def send_sms(to_phone, message, country_code='+1', client=None, deadline=None):
+    """
+    Send one SMS through the shared client, within the rate limit.
+
+    Args:
+        deadline: time.monotonic() after which the send is no longer started
+
+    Returns:
+        bool: True if Twilio accepted the message
+    """
+    full_phone = format_phone(to_phone, country_code)
+    wait = settings.TWILIO_RATE_LIMIT_WAIT_SECONDS
+    if deadline is not None:
+        wait = max(0, min(wait, deadline - time.monotonic()))
+    if not get_sms_limiter().acquire(timeout=wait):
+        metrics.incr('sms.rate_limited')
+        logger.error(f'SMS to {full_phone} not sent: rate limit wait exceeded')
+        return False
+    try:
+        with metrics.timer('sms.send'):
+            message_obj = (client or get_twilio_client()).messages.create(
+                body=message,
+                from_=settings.TWILIO_PHONE_NUMBER,
+                to=full_phone
+            )
+        logger.info(f'SMS sent to {full_phone}: {message_obj.sid}')
+        return True
+    except Exception as e:
+        metrics.incr('sms.send.errors')
+        logger.error(f'SMS sending failed to {to_phone}: {str(e)}')
+        return False
+
+
+def send_bulk_sms(messages, workers=None, pool=None, deadline=None):
+    """
+    Send many SMS concurrently.
+
+    Args:
+        messages: iterable of (to_phone, message, country_code)
+        workers: concurrent sends; defaults to TWILIO_POOL_SIZE
+        pool: executor to send on instead of a new one of workers threads
+        deadline: time.monotonic() after which no further send is started
+
+    Returns:
+        list: one bool per message, in order
+    """
+    messages = list(messages)
+    if not messages:
+        return []
+
+    def send(m):
+        return send_sms(*m, deadline=deadline)
+
+    if pool is not None:
+        return list(pool.map(send, messages))
+    workers = min(workers or settings.TWILIO_POOL_SIZE, len(messages))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='sms') as pool:
+        return list(pool.map(send, messages))
@@ -1,180 +1,101 @@
+from bookings import leases
 from bookings.models import Booking, PickupRequest
-from .utils import send_email_notification, send_sms_notification
+from bingo_rentals import metrics
+from .dispatch import enqueue
+from .models import NotificationKind
+from .outbox import awaiting, deliver_batch, deliver_due, queue_notifications
 from celery import shared_task
+from django.conf import settings
+from django.db import transaction
 from datetime import datetime, timedelta
+from itertools import islice
 import logging
+import time
 
 logger = logging.getLogger(__name__)
 
 
 @shared_task
-def send_booking_confirmation(booking_id):
-    """Send booking confirmation email and SMS"""
+def deliver_notification_outbox():
+    """
+    Deliver due notifications from the outbox.
+
+    Not a @singleton: claim_due() takes rows with SKIP LOCKED and leases
+    them for LEASE_SECONDS, longer than a batch may take to send, so
+    overlapping runs (and the nudged ones) deliver disjoint rows.
+    """
     try:
-        booking = Booking.objects.select_related('product').get(id=booking_id)
-        
-        # Email notification
-        context = {
-            'booking': booking,
-            'site_name': 'Rental Services',
-        }
-        
-        email_sent = send_email_notification(
-            subject=f'Booking Confirmed - {booking.booking_id}',
-            to_email=booking.customer_email,
-            template_name='booking_confirmation',
-            context=context
-        )
-        
-        if email_sent:
-            booking.confirmation_email_sent = True
-        
-        # SMS notification
-        sms_message = f"Your rental is confirmed! Delivery on {booking.drop_off_date.strftime('%b %d')}. Booking ID: {booking.booking_id}"
-        
-        sms_sent = send_sms_notification(
-            to_phone=booking.customer_phone,
-            message=sms_message,
-            country_code=booking.country_code
-        )
-        
-        if sms_sent:
-            booking.confirmation_sms_sent = True
-        
-        booking.save()
-        
+        attempted = deliver_due()
+        if attempted:
+            logger.info(f'Delivered {attempted} queued notifications')
     except Exception as e:
-        logger.error(f'Error sending booking confirmation for {booking_id}: {str(e)}')
+        logger.error(f'Error delivering notification outbox: {str(e)}')
 
 
 @shared_task
-def send_drop_off_reminder(booking_id):
-    """Send reminder 1 day before drop-off"""
+def deliver_notification_batch(outbox_ids):
+    """Deliver one chunk of a reminder sweep"""
     try:
-        booking = Booking.objects.select_related('product').get(id=booking_id)
-        
-        context = {
-            'booking': booking,
-            'site_name': 'Rental Services',
-        }
-        
-        email_sent = send_email_notification(
-            subject=f'Delivery Tomorrow - {booking.product.name}',
-            to_email=booking.customer_email,
-            template_name='drop_off_reminder',
-            context=context
-        )
-        
-        if email_sent:
-            booking.drop_off_reminder_sent = True
-        
-        sms_message = f"Reminder: Your {booking.product.name} will be delivered tomorrow at {booking.delivery_address}"
-        
-        sms_sent = send_sms_notification(
-            to_phone=booking.customer_phone,
-            message=sms_message,
-            country_code=booking.country_code
-        )
-        
-        booking.save()
-        
+        deliver_batch(outbox_ids)
     except Exception as e:
-        logger.error(f'Error sending drop-off reminder for {booking_id}: {str(e)}')
+        logger.error(f'Error delivering notification batch of {len(outbox_ids)}: {str(e)}')
 
 
-@shared_task
-def send_pickup_confirmation(pickup_request_id):
-    """Send pickup confirmation"""
-    try:
-        pickup = PickupRequest.objects.select_related('booking__product').get(id=pickup_request_id)
-        booking = pickup.booking
-        
-        context = {
-            'booking': booking,
-            'pickup': pickup,
-            'site_name': 'Rental Services',
-        }
-        
-        email_sent = send_email_notification(
-            subject=f'Pickup Scheduled - {booking.booking_id}',
-            to_email=booking.customer_email,
-            template_name='pickup_confirmation',
-            context=context
-        )
-        
-        if email_sent:
-            pickup.pickup_email_sent = True
-        
-        sms_message = f"Pickup scheduled for {pickup.requested_pickup_date.strftime('%b %d')}. We'll collect your {booking.product.name}."
-        
-        sms_sent = send_sms_notification(
-            to_phone=booking.customer_phone,
-            message=sms_message,
-            country_code=booking.country_code
-        )
-        
-        if sms_sent:
-            pickup.pickup_sms_sent = True
-        
-        pickup.save()
-        
-    except Exception as e:
-        logger.error(f'Error sending pickup confirmation for {pickup_request_id}: {str(e)}')
+def sweep(name, kind, targets):
+    """
+    Queue kind for each (booking_id, pickup_request_id) pair, streamed in
+    chunks of REMINDER_SWEEP_CHUNK_SIZE, and hand every chunk to one
+    deliver_notification_batch task.
 
+    Only one sweep of a name runs in the cluster at a time; every chunk is
+    committed under its fenced lease (bookings/leases.py), and targets is
+    not read at all if another sweep holds it.
 
-@shared_task
-def send_pickup_reminder(pickup_request_id):
-    """Send reminder 1 day before pickup"""
-    try:
-        pickup = PickupRequest.objects.select_related('booking__product').get(id=pickup_request_id)
-        booking = pickup.booking
-        
-        context = {
-            'booking': booking,
-            'pickup': pickup,
-            'site_name': 'Rental Services',
-        }
-        
-        email_sent = send_email_notification(
-            subject=f'Pickup Reminder - {booking.booking_id}',
-            to_email=booking.customer_email,
-            template_name='pickup_reminder',
-            context=context
-        )
-        
-        if email_sent:
-            pickup.pickup_email_sent = True
-        
-        sms_message = f"Reminder: Pickup scheduled for tomorrow at {pickup.pickup_address or booking.delivery_address}"
-        
-        sms_sent = send_sms_notification(
-            to_phone=booking.customer_phone,
-            message=sms_message,
-            country_code=booking.country_code
-        )
-        
-        pickup.save()
-        
-    except Exception as e:
-        logger.error(f'Error sending pickup reminder for {pickup_request_id}: {str(e)}')
+    Returns:
+        int: number of notifications queued, or None if skipped
+    """
+    chunk_size = settings.REMINDER_SWEEP_CHUNK_SIZE
+    with leases.held(f'sweep.{name}') as lease:
+        if lease is None:
+            logger.info(f'Sweep {name} skipped: already running elsewhere')
+            return None
+        queued = 0
+        started = time.perf_counter()
+        with metrics.timer(f'sweep.{name}'):
+            while chunk := list(islice(targets, chunk_size)):
+                try:
+                    with transaction.atomic():
+                        lease.fence()
+                        ids = queue_notifications(kind, chunk)
+                except leases.LeaseLost as e:
+                    logger.error(f'Sweep {name} stopped after {queued}: {str(e)}')
+                    break
+                queued += len(ids)
+                if not enqueue(deliver_notification_batch, (ids,)):
+                    # Broker unavailable: deliver here rather than wait for beat
+                    deliver_batch(ids)
+    elapsed = time.perf_counter() - started
+    metrics.incr(f'sweep.{name}.items', queued)
+    metrics.gauge(f'sweep.{name}.items_per_s', round(queued / elapsed, 1) if elapsed else 0.0)
+    logger.info(f'Sweep {name}: queued {queued} in {elapsed:.2f}s')
+    return queued
 
 
 @shared_task
 def send_daily_drop_off_reminders():
-    """Send drop-off reminders for all bookings with delivery tomorrow"""
+    """Queue drop-off reminders for tomorrow's deliveries that have none scheduled"""
     try:
         tomorrow = datetime.now().date() + timedelta(days=1)
         
-        # Get all bookings with drop-off date tomorrow that haven't had reminder sent
-        bookings = Booking.objects.filter(
+        # Stream the ids of bookings with drop-off date tomorrow that haven't had reminder sent
+        booking_ids = Booking.objects.filter(
             drop_off_date=tomorrow,
             drop_off_reminder_sent=False
-        )
+        ).exclude(
+            awaiting(NotificationKind.DROP_OFF_REMINDER)
+        ).values_list('pk', flat=True).iterator(chunk_size=settings.REMINDER_SWEEP_CHUNK_SIZE)
         
-        logger.info(f"Sending drop-off reminders to {bookings.count()} bookings")
-        
-        for booking in bookings:
-            send_drop_off_reminder.delay(booking.id)
+        sweep('drop_off_reminders', NotificationKind.DROP_OFF_REMINDER, ((pk, None) for pk in booking_ids))
             
     except Exception as e:
         logger.error(f'Error in send_daily_drop_off_reminders: {str(e)}')
@@ -182,20 +103,19 @@ def send_daily_drop_off_reminders():
 
 @shared_task
 def send_daily_pickup_reminders():
-    """Send pickup reminders for all pickups with date tomorrow"""
+    """Queue pickup reminders for tomorrow's pickups that have none scheduled"""
     try:
         tomorrow = datetime.now().date() + timedelta(days=1)
         
-        # Get all pickups with requested_pickup_date tomorrow that haven't had reminder sent
+        # Stream the ids of pickups with requested_pickup_date tomorrow that haven't had reminder sent
         pickups = PickupRequest.objects.filter(
             requested_pickup_date=tomorrow,
             pickup_email_sent=False
-        )
-        
-        logger.info(f"Sending pickup reminders to {pickups.count()} pickups")
+        ).exclude(
+            awaiting(NotificationKind.PICKUP_REMINDER, 'pickup_request')
+        ).values_list('booking_id', 'pk').iterator(chunk_size=settings.REMINDER_SWEEP_CHUNK_SIZE)
         
-        for pickup in pickups:
-            send_pickup_reminder.delay(pickup.id)
+        sweep('pickup_reminders', NotificationKind.PICKUP_REMINDER, pickups)
             
     except Exception as e:
         logger.error(f'Error in send_daily_pickup_reminders: {str(e)}')
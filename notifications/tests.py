@@ -1,3 +1,459 @@
-from django.test import TestCase
+import socket
+import threading
+import time
+from datetime import date, datetime, timedelta
+from zoneinfo import ZoneInfo
+from smtplib import SMTPRecipientsRefused, SMTPServerDisconnected
+
+from django.core import mail
+from django.core.mail import EmailMessage
+from django.core.mail.backends.base import BaseEmailBackend
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.template.loader import render_to_string
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+
+from bookings import leases
+from bookings.models import Booking, BookingStatus, PickupRequest, TaskLease
+from bookings.tests import DROP_OFF, LOCAL_CACHE, make_booking, make_product
+from . import sms
+from .dispatch import CLOSED, HALF_OPEN, OPEN, BoundedExecutor, CircuitBreaker, broker_breaker
+from .email import send_email_batch
+from .management.commands.run_fake_twilio import make_server
+from .models import ChannelStatus, NotificationKind, NotificationOutbox
+from .outbox import MESSAGES, REMINDER_KINDS, _format, deliver_due, queue_notification, queue_notifications
+from .reminders import fire_at, schedule
+from .rendering import SITE_NAME, email_context, render, render_many
+from .tasks import sweep
+
+TWILIO = {
+    'TWILIO_ACCOUNT_SID': 'ACtest',
+    'TWILIO_AUTH_TOKEN': 'test',
+    'TWILIO_PHONE_NUMBER': '+15550000000',
+    'TWILIO_SMS_PER_SECOND': 1000,
+    'TWILIO_SMS_BURST': 1000,
+}
+
+
+def start_fake_twilio(test):
+    """Serve the Twilio API locally for one test; returns the request handler class"""
+    server = make_server(port=0)
+    handler = server.RequestHandlerClass
+    handler.accepted = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    test.addCleanup(server.server_close)
+    test.addCleanup(server.shutdown)
+    overrides = override_settings(TWILIO_API_BASE=f'http://127.0.0.1:{server.server_port}')
+    overrides.enable()
+    test.addCleanup(overrides.disable)
+    sms.reset()
+    test.addCleanup(sms.reset)
+    return handler
+
+
+@override_settings(CACHES=LOCAL_CACHE, **TWILIO)
+class OutboxDeliveryTests(TestCase):
+    def setUp(self):
+        self.twilio = start_fake_twilio(self)
+        self.product = make_product()
+
+    def confirm(self):
+        booking = make_booking(self.product)
+        booking.save()
+        return booking, queue_notification(NotificationKind.BOOKING_CONFIRMATION, booking, nudge=False)
+
+    def test_sends_both_channels_and_sets_the_flags(self):
+        booking, row = self.confirm()
+        self.assertEqual(deliver_due(), 1)
+
+        row.refresh_from_db()
+        self.assertIsNotNone(row.completed_at)
+        self.assertEqual((row.email_status, row.sms_status), (ChannelStatus.SENT, ChannelStatus.SENT))
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(self.twilio.accepted, 1)
+        booking.refresh_from_db()
+        self.assertTrue(booking.confirmation_email_sent)
+        self.assertTrue(booking.confirmation_sms_sent)
+
+    @override_settings(TWILIO_SMS_PER_SECOND=0.01, TWILIO_SMS_BURST=1, NOTIFICATION_SMS_TIMEOUT_SECONDS=0.2)
+    def test_sms_past_the_deadline_are_retried(self):
+        rows = [self.confirm()[1] for _ in range(3)]
+        started = time.monotonic()
+        deliver_due()
+        self.assertLess(time.monotonic() - started, 5)
+
+        statuses = [NotificationOutbox.objects.get(pk=row.pk) for row in rows]
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertEqual(self.twilio.accepted, 1)
+        waiting = [row for row in statuses if row.sms_status == ChannelStatus.PENDING]
+        self.assertEqual(len(waiting), 2)
+        for row in waiting:
+            self.assertIsNone(row.completed_at)
+            self.assertGreater(row.next_attempt_at, timezone.now())
+
+    def test_hung_smtp_server_does_not_hold_the_batch(self):
+        # Accepts connections into its backlog and never sends a greeting
+        silent = socket.socket()
+        silent.bind(('127.0.0.1', 0))
+        silent.listen(8)
+        self.addCleanup(silent.close)
+        _, row = self.confirm()
+        with override_settings(
+            EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend',
+            EMAIL_HOST='127.0.0.1',
+            EMAIL_PORT=silent.getsockname()[1],
+            EMAIL_USE_TLS=False,
+            EMAIL_TIMEOUT=0.3,
+        ):
+            started = time.monotonic()
+            deliver_due()
+            self.assertLess(time.monotonic() - started, 5)
+
+        row.refresh_from_db()
+        self.assertEqual((row.email_status, row.sms_status), (ChannelStatus.PENDING, ChannelStatus.SENT))
+        self.assertEqual(row.attempts, 1)
+        self.assertIsNone(row.completed_at)
+
+
+REMINDER_AT = {'REMINDER_TIME_ZONE': 'America/Toronto', 'REMINDER_SEND_TIME': '09:00', 'REMINDER_DAYS_BEFORE': 2}
+
+
+@override_settings(CACHES=LOCAL_CACHE, **REMINDER_AT)
+class ReminderScheduleTests(TestCase):
+    def setUp(self):
+        self.product = make_product()
+        self.booking = make_booking(self.product)
+        self.booking.save()
+
+    def pending(self, kind=NotificationKind.DROP_OFF_REMINDER):
+        return NotificationOutbox.objects.filter(kind=kind, booking=self.booking, completed_at__isnull=True)
+
+    def test_fire_at(self):
+        toronto = ZoneInfo('America/Toronto')
+        self.assertEqual(fire_at(DROP_OFF), datetime(2030, 2, 27, 9, tzinfo=toronto))
+        today = timezone.now().astimezone(toronto).date()
+        # Inside the lead time the reminder goes out at once; on the day it is too late
+        started = timezone.now()
+        self.assertGreaterEqual(fire_at(today + timedelta(days=1)), started)
+        self.assertLessEqual(fire_at(today + timedelta(days=1)), timezone.now())
+        self.assertIsNone(fire_at(today))
+        self.assertIsNone(fire_at(today - timedelta(days=1)))
+
+    def test_confirmed_booking_gets_a_reminder(self):
+        reminder = self.pending().get()
+        self.assertEqual(reminder.next_attempt_at, fire_at(DROP_OFF))
+        self.assertEqual(reminder.attempts, 0)
+
+    def test_reminder_moves_with_the_drop_off_date(self):
+        reminder = self.pending().get()
+        self.booking.drop_off_date = DROP_OFF + timedelta(days=5)
+        self.booking.save()
+        self.assertEqual(self.pending().get().pk, reminder.pk)
+        self.assertEqual(self.pending().get().next_attempt_at, fire_at(DROP_OFF + timedelta(days=5)))
+
+    def test_retried_reminder_keeps_its_backoff(self):
+        retry_at = timezone.now() + timedelta(minutes=10)
+        self.pending().update(attempts=1, next_attempt_at=retry_at)
+        self.booking.drop_off_date = DROP_OFF + timedelta(days=5)
+        self.booking.save()
+        self.assertEqual(self.pending().get().next_attempt_at, retry_at)
+
+    def test_unrelated_update_fields_leave_the_reminder_alone(self):
+        self.pending().update(next_attempt_at=timezone.now())
+        self.booking.drop_off_date = DROP_OFF + timedelta(days=5)
+        self.booking.save(update_fields=['customer_name'])
+        self.assertLess(self.pending().get().next_attempt_at, fire_at(DROP_OFF))
+
+    def test_cancelling_the_booking_skips_its_reminders(self):
+        PickupRequest.objects.create(booking=self.booking, requested_pickup_date=date(2030, 5, 1))
+        self.assertTrue(self.pending(NotificationKind.PICKUP_REMINDER).exists())
+        self.booking.status = BookingStatus.CANCELLED
+        self.booking.save()
+
+        self.assertFalse(self.pending().exists())
+        self.assertFalse(self.pending(NotificationKind.PICKUP_REMINDER).exists())
+        reminders = NotificationOutbox.objects.filter(booking=self.booking, kind__in=REMINDER_KINDS)
+        self.assertEqual(reminders.count(), 2)
+        for reminder in reminders:
+            self.assertEqual((reminder.email_status, reminder.sms_status), (ChannelStatus.SKIPPED, ChannelStatus.SKIPPED))
+
+    def test_pickup_reminder_follows_the_requested_date(self):
+        pickup = PickupRequest.objects.create(booking=self.booking, requested_pickup_date=date(2030, 5, 1))
+        reminder = self.pending(NotificationKind.PICKUP_REMINDER).get()
+        self.assertEqual(reminder.pickup_request, pickup)
+        self.assertEqual(reminder.next_attempt_at, fire_at(date(2030, 5, 1)))
+
+        pickup.requested_pickup_date = '2030-05-08'
+        pickup.save()
+        self.assertEqual(self.pending(NotificationKind.PICKUP_REMINDER).get().next_attempt_at, fire_at(date(2030, 5, 8)))
+
+    def test_one_pending_reminder_per_booking(self):
+        kind = NotificationKind.DROP_OFF_REMINDER
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            queue_notification(kind, self.booking, at=fire_at(DROP_OFF))
+        schedule(kind, self.booking, day=DROP_OFF)
+        ids = queue_notifications(kind, [(self.booking.pk, None)])
+        self.assertEqual(ids, [self.pending().get().pk])
+
+        # Once it has gone out, the next one can be queued
+        self.pending().update(completed_at=timezone.now())
+        schedule(kind, self.booking, day=DROP_OFF + timedelta(days=5))
+        self.assertEqual(NotificationOutbox.objects.filter(kind=kind, booking=self.booking).count(), 2)
+
+
+@override_settings(CACHES=LOCAL_CACHE, **REMINDER_AT)
+class ReminderTextTests(TestCase):
+    def setUp(self):
+        product = make_product(name='Pod')
+        self.booking = make_booking(product)
+        self.booking.save()
+        self.pickup = PickupRequest.objects.create(
+            booking=self.booking, requested_pickup_date=date(2030, 5, 8), pickup_address='2 Side St',
+        )
+
+    def reminder(self, kind):
+        return NotificationOutbox.objects.select_related('booking__product', 'pickup_request').get(
+            kind=kind, booking=self.booking,
+        )
+
+    def test_texts_name_the_date_not_tomorrow(self):
+        drop_off = self.reminder(NotificationKind.DROP_OFF_REMINDER)
+        pickup = self.reminder(NotificationKind.PICKUP_REMINDER)
+        self.assertEqual(
+            _format(MESSAGES[drop_off.kind].sms, drop_off),
+            'Reminder: Your Pod will be delivered on Mar 01 at 1 Test St',
+        )
+        self.assertEqual(_format(MESSAGES[drop_off.kind].subject, drop_off), 'Delivery on Mar 01 - Pod')
+        self.assertEqual(_format(MESSAGES[pickup.kind].sms, pickup), 'Reminder: Pickup scheduled for May 08 at 2 Side St')
+
+        for name, row, day in (
+            ('drop_off_reminder', drop_off, 'Friday, March 01, 2030'),
+            ('pickup_reminder', pickup, 'Wednesday, May 08, 2030'),
+        ):
+            with self.subTest(template=name):
+                for body in render(name, email_context(row.booking, row.pickup_request)):
+                    self.assertIn(day, body)
+                    self.assertNotIn('tomorrow', body.lower())
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class CircuitBreakerTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.clock = FakeClock()
+        self.breaker = CircuitBreaker('test_broker', reset_seconds=30, clock=self.clock)
+
+    def test_open_half_open_closed(self):
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, OPEN)
+        self.clock.now += 29
+        self.assertFalse(self.breaker.allow())
+
+        # Past the reset one caller probes; the rest keep skipping
+        self.clock.now += 1
+        self.assertTrue(self.breaker.allow())
+        self.assertEqual(self.breaker.state, HALF_OPEN)
+        self.assertFalse(self.breaker.allow())
+
+        # A failed probe opens it for another full period
+        self.breaker.record_failure()
+        self.clock.now += 29
+        self.assertFalse(self.breaker.allow())
+        self.clock.now += 1
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_success()
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.assertTrue(self.breaker.allow())
+        self.assertTrue(self.breaker.allow())
+
+    def test_open_state_is_shared_through_the_cache(self):
+        other_process = CircuitBreaker('test_broker', reset_seconds=30, clock=self.clock)
+        self.breaker.record_failure()
+        self.assertFalse(other_process.allow())
+        self.assertEqual(other_process.state, OPEN)
+
+        self.clock.now += 30
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_success()
+        # The recovery clears the shared entry; the other copy, already
+        # open, closes through its own probe
+        self.assertIsNone(cache.get(self.breaker.cache_key))
+        self.assertTrue(other_process.allow())
+
+
+class BoundedExecutorTests(SimpleTestCase):
+    def test_runs_at_most_max_workers_and_rejects_past_the_queue(self):
+        executor = BoundedExecutor(max_workers=2, queue_limit=2)
+        release = threading.Event()
+        lock = threading.Lock()
+        running, peak = [0], [0]
+
+        def task():
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+            release.wait(5)
+            with lock:
+                running[0] -= 1
+
+        futures = [executor.submit(task) for _ in range(4)]
+        self.assertNotIn(None, futures)
+        self.assertIsNone(executor.submit(task))
+
+        release.set()
+        for future in futures:
+            future.result(timeout=5)
+        self.assertEqual(peak[0], 2)
+        # Slots come back as tasks finish
+        deadline = time.monotonic() + 5
+        while (future := executor.submit(task)) is None and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertIsNotNone(future)
+        future.result(timeout=5)
+
+
+class RecordingBackend(BaseEmailBackend):
+    """
+    Email backend that counts connections and fails on purpose: addresses
+    starting with 'refused' are rejected by the server, ones starting with
+    'drop' lose the connection.
+    """
+    opened = 0
+    sent = []
+
+    def open(self):
+        RecordingBackend.opened += 1
+        return True
+
+    def send_messages(self, messages):
+        for email in messages:
+            if email.to[0].startswith('refused'):
+                raise SMTPRecipientsRefused({email.to[0]: (550, b'No such user')})
+            if email.to[0].startswith('drop'):
+                raise SMTPServerDisconnected('Connection unexpectedly closed')
+            RecordingBackend.sent.append(email.to[0])
+        return len(messages)
+
+
+@override_settings(EMAIL_BACKEND='notifications.tests.RecordingBackend')
+class EmailBatchTests(SimpleTestCase):
+    def setUp(self):
+        RecordingBackend.opened = 0
+        RecordingBackend.sent = []
+
+    def messages(self, *recipients):
+        return [EmailMessage('Subject', 'Body', 'from@example.com', [to]) for to in recipients]
+
+    def test_one_connection_per_chunk(self):
+        results = send_email_batch(self.messages(*(f'a{i}@example.com' for i in range(5))), chunk_size=2)
+        self.assertEqual(results, [True] * 5)
+        self.assertEqual(RecordingBackend.opened, 3)
+
+    def test_failures_are_reported_per_message(self):
+        emails = self.messages('a@example.com', 'refused@example.com', 'b@example.com', 'drop@example.com',
+                               'c@example.com')
+        self.assertEqual(send_email_batch(emails, chunk_size=5), [True, False, True, False, True])
+        self.assertEqual(RecordingBackend.sent, ['a@example.com', 'b@example.com', 'c@example.com'])
+        # A refused recipient keeps the connection, a dropped one is reopened
+        self.assertEqual(RecordingBackend.opened, 2)
+
+    def test_nothing_starts_after_the_deadline(self):
+        results = send_email_batch(self.messages('a@example.com', 'b@example.com'), deadline=time.monotonic())
+        self.assertEqual(results, [False, False])
+        self.assertEqual(RecordingBackend.opened, 0)
+
+
+@override_settings(CACHES=LOCAL_CACHE, REMINDER_SWEEP_CHUNK_SIZE=2, **TWILIO)
+class SweepTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.twilio = start_fake_twilio(self)
+        # Broker known to be down: chunks are delivered in this process
+        broker_breaker.record_failure()
+        self.addCleanup(broker_breaker.record_success)
+        product = make_product(stock_quantity=10)
+        self.bookings = []
+        for _ in range(6):
+            booking = make_booking(product)
+            booking.save()
+            self.bookings.append(booking)
+
+    def targets(self, take_over_after=None):
+        for index, booking in enumerate(self.bookings):
+            if index == take_over_after:
+                # The lease ran out and another worker took it
+                TaskLease.objects.filter(name='sweep.test').update(expires_at=timezone.now())
+                self.assertIsNotNone(leases.acquire('sweep.test'))
+            yield booking.pk, None
+
+    def swept(self):
+        return NotificationOutbox.objects.filter(kind=NotificationKind.BOOKING_CONFIRMATION)
+
+    def test_sweeps_every_target_in_chunks(self):
+        self.assertEqual(sweep('test', NotificationKind.BOOKING_CONFIRMATION, self.targets()), 6)
+        self.assertEqual(self.swept().count(), 6)
+        self.assertEqual((len(mail.outbox), self.twilio.accepted), (6, 6))
+
+    def test_stops_at_the_first_chunk_after_the_lease_is_lost(self):
+        self.assertEqual(sweep('test', NotificationKind.BOOKING_CONFIRMATION, self.targets(take_over_after=2)), 2)
+        self.assertEqual(self.swept().count(), 2)
+        self.assertEqual((len(mail.outbox), self.twilio.accepted), (2, 2))
+        # The new holder keeps its lease; the old one did not release it
+        self.assertGreater(TaskLease.objects.get(name='sweep.test').expires_at, timezone.now())
+
+    def test_skipped_while_another_sweep_runs(self):
+        self.assertIsNotNone(leases.acquire('sweep.test'))
+        self.assertIsNone(sweep('test', NotificationKind.BOOKING_CONFIRMATION, self.targets()))
+        self.assertFalse(self.swept().exists())
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class RenderingTests(TestCase):
+    def setUp(self):
+        product = make_product(name='Pod <16ft> & "Co"')
+        self.booking = make_booking(product, customer_name="O'Brien <b>", delivery_address='1 A & B St')
+        self.booking.save()
+        self.pickup = PickupRequest.objects.create(
+            booking=self.booking,
+            requested_pickup_date=date(2030, 5, 1),
+            pickup_address='2 Side St',
+            pickup_notes='Gate code <1234>',
+        )
+        self.booking = Booking.objects.select_related('product').get(pk=self.booking.pk)
+
+    def test_render_many_matches_render_to_string_with_the_models(self):
+        for name, pickup in (
+            ('booking_confirmation', None),
+            ('drop_off_reminder', None),
+            ('pickup_confirmation', self.pickup),
+            ('pickup_reminder', self.pickup),
+        ):
+            with self.subTest(template=name):
+                # The context the emails were rendered from before, plus the
+                # pickup_date that pickup_reminder always asked for
+                models = {'booking': self.booking, 'site_name': SITE_NAME}
+                if pickup:
+                    models.update(pickup=pickup, pickup_date=pickup.requested_pickup_date)
+                expected = (
+                    render_to_string(f'emails/{name}.txt', models),
+                    render_to_string(f'emails/{name}.html', models),
+                )
+                self.assertEqual(render(name, email_context(self.booking, pickup)), expected)
+
+    def test_recipients_do_not_leak_into_each_other(self):
+        contexts = [email_context(self.booking, self.pickup), email_context(self.booking)]
+        rendered = render_many('pickup_reminder', contexts)
+        self.assertEqual(rendered, [render('pickup_reminder', context) for context in contexts])
+        self.assertIn('Gate code', rendered[0][0])
+        self.assertNotIn('Gate code', rendered[1][0])
 
-# Create your tests here.
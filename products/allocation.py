@@ -0,0 +1,295 @@
+"""
+Best-fit allocation of bookings to physical rental units.
+
+Each unit keeps its busy intervals sorted by first day. To place a booking
+we binary-search every unit for the free gap that contains the rental and
+pick the unit whose gap leaves the least idle time either side (best fit).
+Units with nothing booked before or after the rental are only used when no
+tighter gap exists, so idle gaps stay small and long free runs stay whole
+for long rentals.
+
+Allocator works purely in memory. allocate_booking() runs it for a single
+booking inside Booking.save(), while the ledger days of the rental are
+locked, so it does not load the fleet: units busy during the rental are
+excluded in SQL, and only the bookings ending or starting within
+FIT_WINDOW_DAYS of it on the remaining units are loaded as candidates. A
+unit without such a neighbour is fetched only when no candidate fits. The
+cost of a save therefore depends on the free units booked close to its
+dates, not on the size of the fleet or its history.
+"""
+from bisect import bisect_left, bisect_right
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import Q
+
+# Idle days charged for a side with no booking, more than any real gap
+OPEN_SIDE = 10 ** 6
+
+# Bookings further than this from a rental do not affect where it goes on
+# save; a gap wider than the window ranks like an open side
+FIT_WINDOW_DAYS = 30
+
+
+class UnitSchedule:
+    """Sorted, non-overlapping busy intervals of one unit (day ordinals, inclusive)"""
+
+    def __init__(self, unit_id):
+        self.unit_id = unit_id
+        self.starts = []
+        self.ends = []
+        self.booking_ids = []
+
+    def fit(self, first, last):
+        """
+        Idle days left around [first, last] if it fits in a free gap, else None.
+
+        A side with nothing booked counts as OPEN_SIDE days, so lower is
+        always a tighter fit.
+        """
+        index = bisect_right(self.starts, last)
+        if index and self.ends[index - 1] >= first:
+            return None
+        idle = first - self.ends[index - 1] - 1 if index else OPEN_SIDE
+        idle += self.starts[index] - last - 1 if index < len(self.starts) else OPEN_SIDE
+        return idle
+
+    def add(self, first, last, booking_id):
+        index = bisect_left(self.starts, first)
+        self.starts.insert(index, first)
+        self.ends.insert(index, last)
+        self.booking_ids.insert(index, booking_id)
+
+    def remove(self, booking_id):
+        index = self.booking_ids.index(booking_id)
+        del self.starts[index], self.ends[index], self.booking_ids[index]
+
+
+class Allocator:
+    """
+    In-memory best-fit allocator over a fleet of units.
+
+    Args:
+        unit_ids: units that may be assigned
+        assignments: iterable of (booking_id, unit_id, first_day, last_day)
+            already placed
+    """
+
+    def __init__(self, unit_ids, assignments=()):
+        self.schedules = {unit_id: UnitSchedule(unit_id) for unit_id in unit_ids}
+        # Units with nothing booked: only used when no booked unit has a gap
+        self.idle_units = dict.fromkeys(self.schedules)
+        self.unit_of = {}
+        for booking_id, unit_id, first_day, last_day in assignments:
+            if unit_id in self.schedules:
+                self._place(booking_id, unit_id, first_day.toordinal(), last_day.toordinal())
+
+    def _place(self, booking_id, unit_id, first, last):
+        self.schedules[unit_id].add(first, last, booking_id)
+        self.idle_units.pop(unit_id, None)
+        self.unit_of[booking_id] = unit_id
+
+    def best_unit(self, first_day, last_day):
+        """Unit with the tightest free gap around the interval, or None"""
+        first, last = first_day.toordinal(), last_day.toordinal()
+        best_unit, best_idle = None, None
+        # Inlined UnitSchedule.fit(): this loop runs once per unit per booking
+        for unit_id, schedule in self.schedules.items():
+            starts = schedule.starts
+            if not starts:
+                continue
+            index = bisect_right(starts, last)
+            if index:
+                if schedule.ends[index - 1] >= first:
+                    continue
+                idle = first - schedule.ends[index - 1] - 1
+                # Nothing booked after: one open side ranks below any closed gap
+                idle += starts[index] - last - 1 if index < len(starts) else OPEN_SIDE
+            else:
+                idle = starts[0] - last - 1 + OPEN_SIDE
+            if best_idle is None or idle < best_idle:
+                best_unit, best_idle = unit_id, idle
+                if idle == 0:
+                    break
+        if best_unit is None and self.idle_units:
+            best_unit = next(iter(self.idle_units))
+        return best_unit
+
+    def release(self, booking_id):
+        """Free the unit a booking was using"""
+        unit_id = self.unit_of.pop(booking_id, None)
+        if unit_id is not None:
+            schedule = self.schedules[unit_id]
+            schedule.remove(booking_id)
+            if not schedule.starts:
+                self.idle_units[unit_id] = None
+
+    def assign(self, booking_id, first_day, last_day, current_unit=None):
+        """
+        Place (or re-place) a booking, keeping its current unit if it still fits.
+
+        Args:
+            current_unit: unit the booking holds when it is not loaded
+                into this allocator
+
+        Returns:
+            unit id, or None if every unit is busy for part of the interval
+        """
+        first, last = first_day.toordinal(), last_day.toordinal()
+        current = self.unit_of.get(booking_id, current_unit)
+        self.release(booking_id)
+        if current in self.schedules and self.schedules[current].fit(first, last) is not None:
+            unit_id = current
+        else:
+            unit_id = self.best_unit(first_day, last_day)
+        if unit_id is not None:
+            self._place(booking_id, unit_id, first, last)
+        return unit_id
+
+    def idle_gaps(self):
+        """Lengths of every idle gap between two bookings on the same unit"""
+        return [
+            start - end - 1
+            for schedule in self.schedules.values()
+            for end, start in zip(schedule.ends, schedule.starts[1:])
+        ]
+
+
+def load_allocator(product_id, from_day, exclude_booking_id=None):
+    """Allocator for a product's usable units with their bookings from from_day on"""
+    from bookings.models import Booking
+    from .availability import active_statuses
+    from .models import RentalUnit, UnitCondition
+
+    unit_ids = list(
+        RentalUnit.objects.filter(product_id=product_id)
+        .exclude(condition=UnitCondition.RETIRED)
+        .values_list('id', flat=True)
+    )
+    assignments = Booking.objects.filter(
+        rental_unit_id__in=unit_ids,
+        status__in=active_statuses(),
+        expected_end_date__gte=from_day,
+    ).exclude(pk=exclude_booking_id).values_list(
+        'pk', 'rental_unit_id', 'drop_off_date', 'expected_end_date'
+    )
+    return Allocator(unit_ids, assignments)
+
+
+def _active_assigned(product_id, booking_id=None):
+    """Active bookings of a product that hold a unit, other than booking_id"""
+    from bookings.models import Booking
+    from .availability import active_statuses
+
+    return Booking.objects.filter(
+        product_id=product_id,
+        status__in=active_statuses(),
+        rental_unit__isnull=False,
+    ).exclude(pk=booking_id).order_by()
+
+
+def _usable_units(product_id, first_day, last_day, booking_id=None):
+    """Units of a product that are not retired and free for the whole interval"""
+    from .models import RentalUnit, UnitCondition
+
+    # Served by booking_overlap_idx (product, status, drop_off_date, expected_end_date)
+    busy = _active_assigned(product_id, booking_id).filter(
+        drop_off_date__lte=last_day, expected_end_date__gte=first_day
+    ).values('rental_unit_id')
+    return RentalUnit.objects.filter(product_id=product_id).exclude(
+        condition=UnitCondition.RETIRED
+    ).exclude(pk__in=busy)
+
+
+def load_candidates(product_id, first_day, last_day, booking_id=None):
+    """
+    Allocator over the units free for the interval that have a booking
+    ending or starting within FIT_WINDOW_DAYS of it, holding only those
+    neighbouring bookings.
+    """
+    window = timedelta(days=FIT_WINDOW_DAYS)
+    day = timedelta(days=1)
+    neighbours = list(
+        _active_assigned(product_id, booking_id).filter(
+            Q(expected_end_date__range=(first_day - window, first_day - day))
+            | Q(drop_off_date__range=(last_day + day, last_day + window)),
+            rental_unit__in=_usable_units(product_id, first_day, last_day, booking_id),
+        ).values_list('pk', 'rental_unit_id', 'drop_off_date', 'expected_end_date')
+    )
+    return Allocator(
+        dict.fromkeys(unit_id for _, unit_id, _, _ in neighbours),
+        neighbours,
+    )
+
+
+def allocate_booking(booking):
+    """
+    Assign, keep, move or free the booking's unit after its interval changed.
+
+    Cancelled or completed bookings give their unit back. Extended or moved
+    bookings keep their unit when it is still free, otherwise they move to
+    the best-fitting free unit. Bookings of products without tracked units
+    hold none, so a booking moved onto one gives its old unit back.
+    Must run inside the transaction that saves the booking, after the
+    ledger has been updated.
+
+    Returns:
+        unit id or None
+    """
+    from bookings.models import Booking
+    from .models import RentalUnit
+
+    interval = booking.occupancy_interval()
+    unit_id = None
+    if interval and RentalUnit.objects.filter(product_id=interval[0]).exists():
+        product_id, first_day, last_day = interval
+        # move_interval() has already row-locked this interval's ledger days,
+        # so any booking that could compete for the same unit is waiting on us
+        usable = _usable_units(product_id, first_day, last_day, booking.pk)
+        if booking.rental_unit_id and usable.filter(pk=booking.rental_unit_id).exists():
+            unit_id = booking.rental_unit_id
+        else:
+            unit_id = load_candidates(product_id, first_day, last_day, booking.pk).best_unit(
+                first_day, last_day
+            )
+            if unit_id is None:
+                unit_id = usable.order_by('pk').values_list('pk', flat=True).first()
+
+    if unit_id != booking.rental_unit_id:
+        booking.rental_unit_id = unit_id
+        Booking.objects.filter(pk=booking.pk).update(rental_unit_id=unit_id)
+    return unit_id
+
+
+def allocate_unassigned(product_id, from_day):
+    """
+    Assign every active, unassigned booking of a product in one pass.
+
+    Longest rentals are placed first, which keeps best fit close to optimal.
+
+    Returns:
+        tuple: (assigned count, bookings left without a unit)
+    """
+    from bookings.models import Booking
+    from .availability import active_statuses
+
+    with transaction.atomic():
+        allocator = load_allocator(product_id, from_day)
+        pending = list(
+            Booking.objects.filter(
+                product_id=product_id,
+                rental_unit__isnull=True,
+                status__in=active_statuses(),
+                expected_end_date__gte=from_day,
+            ).only('pk', 'drop_off_date', 'expected_end_date')
+        )
+        pending.sort(key=lambda b: (b.drop_off_date - b.expected_end_date, b.drop_off_date))
+
+        assigned, unplaced = [], []
+        for booking in pending:
+            booking.rental_unit_id = allocator.assign(
+                booking.pk, booking.drop_off_date, booking.expected_end_date
+            )
+            (assigned if booking.rental_unit_id else unplaced).append(booking)
+        Booking.objects.bulk_update(assigned, ['rental_unit'], batch_size=1000)
+    return len(assigned), unplaced
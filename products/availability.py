@@ -0,0 +1,250 @@
+"""
+Range-based availability engine.
+
+Answers "how many units are free on each day of this window" for one or many
+products with a single query per call, instead of one COUNT query per product
+per date. Day counts are read from the occupancy ledger (see ledger.py), which
+is built from booking intervals with occupancy_from_intervals().
+"""
+import calendar
+import math
+from datetime import date, timedelta
+
+from django.core.cache import cache
+from django.db.models import Exists, F, FilteredRelation, Max, OuterRef, Q, Value
+from django.db.models.functions import Coalesce
+
+from .cache import cache_timeout, versioned_key
+
+# Day states shown on the drop-off calendar
+DAY_AVAILABLE = 'available'
+DAY_LOW = 'low'
+DAY_SOLD_OUT = 'sold_out'
+DAY_BLACKOUT = 'blackout'
+
+# A day is "low" once this share of stock or less is left
+LOW_STOCK_RATIO = 0.2
+
+# Month grids are invalidated by version bumps; this only bounds memory
+# (capped by cache_timeout() when bumps cannot reach other processes)
+MONTH_GRID_TIMEOUT = 60 * 60
+
+
+def availability_version(product_id):
+    """Version name bumped whenever a product's availability changes"""
+    return f'availability:{product_id}'
+
+
+# Bumped when a change affects every product (global blackouts, rebuilds)
+ALL_AVAILABILITY_VERSION = 'availability:all'
+
+
+def active_statuses():
+    """Booking statuses that keep a unit out of the depot"""
+    from bookings.models import BookingStatus
+    return [
+        BookingStatus.CONFIRMED,
+        BookingStatus.IN_PROGRESS,
+        BookingStatus.PICKUP_SCHEDULED,
+    ]
+
+
+def add_months(start_date, months):
+    """Add calendar months to a date, clamping to the end of shorter months"""
+    month_index = start_date.month - 1 + months
+    year = start_date.year + month_index // 12
+    month = month_index % 12 + 1
+    day = min(start_date.day, calendar.monthrange(year, month)[1])
+    return start_date.replace(year=year, month=month, day=day)
+
+
+def rental_end_date(drop_off_date, pickup_date, rental_months):
+    """Last day a unit is out: the pickup date, or the end of the paid term"""
+    if pickup_date:
+        return pickup_date
+    return add_months(drop_off_date, rental_months)
+
+
+def daterange(start_date, end_date):
+    """Every date from start_date to end_date inclusive"""
+    for offset in range((end_date - start_date).days + 1):
+        yield start_date + timedelta(days=offset)
+
+
+def occupancy_from_intervals(intervals, start_date, end_date):
+    """
+    Count overlapping intervals for every day of the window.
+
+    Uses a difference array (+1 on the first day, -1 after the last day)
+    followed by a prefix sum, so the cost is O(intervals + days) no matter
+    how long each rental is.
+
+    Args:
+        intervals: iterable of (first_day, last_day) date pairs, inclusive
+        start_date, end_date: the window, inclusive
+
+    Returns:
+        list: occupied units per day, index 0 == start_date
+    """
+    days = (end_date - start_date).days + 1
+    if days <= 0:
+        return []
+
+    diff = [0] * (days + 1)
+    for first_day, last_day in intervals:
+        if last_day < start_date or first_day > end_date:
+            continue
+        begin = max((first_day - start_date).days, 0)
+        end = min((last_day - start_date).days, days - 1)
+        diff[begin] += 1
+        diff[end + 1] -= 1
+
+    occupancy = []
+    running = 0
+    for delta in diff[:days]:
+        running += delta
+        occupancy.append(running)
+    return occupancy
+
+
+def get_availability_for_products(products, start_date, end_date):
+    """
+    Remaining stock per day for several products at once.
+
+    Returns:
+        dict: {product_id: {date: units_remaining}}
+    """
+    from .ledger import read_ledger
+
+    products = list(products)
+    booked_units = read_ledger([p.id for p in products], start_date, end_date)
+    dates = list(daterange(start_date, end_date))
+
+    availability = {}
+    for product in products:
+        availability[product.id] = {
+            day: product.stock_quantity - booked
+            for day, booked in zip(dates, booked_units[product.id])
+        }
+    return availability
+
+
+def get_availability(product, start_date, end_date):
+    """
+    Remaining stock for every day of a window for one product.
+
+    Returns:
+        dict: {date: units_remaining}
+    """
+    return get_availability_for_products([product], start_date, end_date)[product.id]
+
+
+def annotate_availability(products, day):
+    """
+    Attach today's figures to each product for dashboard tables.
+
+    Sets ``active_rentals`` and ``available_units`` on every product and
+    returns the products as a list.
+    """
+    products = list(products)
+    availability = get_availability_for_products(products, day, day)
+    for product in products:
+        product.available_units = availability[product.id][day]
+        product.active_rentals = product.stock_quantity - product.available_units
+    return products
+
+
+def get_month_grid(product, year, month):
+    """
+    State of every day of a month for the drop-off calendar.
+
+    Reads the ledger and the blackout dates once each.
+
+    Returns:
+        dict: {'YYYY-MM-DD': 'available' | 'low' | 'sold_out' | 'blackout'}
+    """
+    from .models import BlackoutDate
+
+    first_day = date(year, month, 1)
+    last_day = date(year, month, calendar.monthrange(year, month)[1])
+    availability = get_availability(product, first_day, last_day)
+    blackouts = set(
+        BlackoutDate.objects.filter(
+            Q(product=product) | Q(product__isnull=True),
+            date__range=(first_day, last_day),
+        ).values_list('date', flat=True)
+    )
+    low_threshold = max(1, math.ceil(product.stock_quantity * LOW_STOCK_RATIO))
+
+    grid = {}
+    for day, remaining in availability.items():
+        if day in blackouts:
+            state = DAY_BLACKOUT
+        elif remaining <= 0:
+            state = DAY_SOLD_OUT
+        elif remaining <= low_threshold:
+            state = DAY_LOW
+        else:
+            state = DAY_AVAILABLE
+        grid[day.isoformat()] = state
+    return grid
+
+
+def get_cached_month_grid(product, year, month):
+    """get_month_grid() cached per (product, month) until availability changes"""
+    try:
+        key = versioned_key(
+            f'availability:month:{product.id}:{year}-{month:02d}',
+            availability_version(product.id),
+            ALL_AVAILABILITY_VERSION,
+        )
+        grid = cache.get(key)
+    except Exception:
+        # The cache may live on a Redis that just went away
+        return get_month_grid(product, year, month)
+    if grid is None:
+        grid = get_month_grid(product, year, month)
+        try:
+            cache.set(key, grid, cache_timeout(MONTH_GRID_TIMEOUT))
+        except Exception:
+            pass
+    return grid
+
+
+def search_available_products(products, drop_off_date, rental_months):
+    """
+    Which products can be delivered on drop_off_date for the whole term.
+
+    Answered with one grouped query: each product is joined only to its
+    ledger rows inside the rental window (the window is part of the JOIN
+    condition), and the busiest day is taken with MAX.
+
+    Args:
+        products: Product queryset to search
+        drop_off_date: requested delivery date
+        rental_months: requested term
+
+    Returns:
+        QuerySet: products annotated with ``units_free`` (free units on the
+        busiest day of the window) and ``blacked_out`` (drop-off date is a
+        blackout date)
+    """
+    from .models import BlackoutDate
+
+    end_date = rental_end_date(drop_off_date, None, rental_months)
+    blackouts = BlackoutDate.objects.filter(
+        Q(product=OuterRef('pk')) | Q(product__isnull=True),
+        date=drop_off_date,
+    )
+    return products.annotate(
+        occupancy_window=FilteredRelation(
+            'day_occupancy',
+            condition=Q(day_occupancy__day__range=(drop_off_date, end_date)),
+        ),
+    ).annotate(
+        peak_units=Coalesce(
+            Max(F('occupancy_window__booked_units') + F('occupancy_window__held_units')), Value(0)
+        ),
+        units_free=F('stock_quantity') - F('peak_units'),
+        blacked_out=Exists(blackouts),
+    )
@@ -0,0 +1,137 @@
+"""
+Version stamps for cached data.
+
+Instead of deleting every cached entry that depends on some data, callers
+build their cache keys from a version number stored in the shared cache and
+bump that number when the data changes. Old entries simply stop being read
+and age out. With Redis as the default cache this invalidates every
+gunicorn and Celery process at once.
+
+A bump only reaches other processes through a shared cache. With the
+per-process memory cache, or while Redis is unreachable, anything kept
+under a version is kept at most LOCAL_CACHE_MAX_AGE_SECONDS instead, so
+an edit still shows up everywhere within seconds.
+"""
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+logger = logging.getLogger(__name__)
+
+VERSION_KEY = 'version:{}'
+
+# Backends that live inside one process and cannot carry a version bump
+LOCAL_BACKENDS = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+
+def cache_is_shared():
+    """True if the default cache is seen by every process"""
+    return settings.CACHES['default']['BACKEND'] not in LOCAL_BACKENDS
+
+
+def cache_timeout(timeout):
+    """Timeout for an entry invalidated by version bumps, capped when they cannot reach other processes"""
+    if cache_is_shared():
+        return timeout
+    return min(timeout, settings.LOCAL_CACHE_MAX_AGE_SECONDS)
+
+
+def _fresh_version():
+    # Millisecond timestamps never repeat a version after a cache flush
+    return int(time.time() * 1000)
+
+
+def get_version(name):
+    """Current version number for a named piece of data"""
+    key = VERSION_KEY.format(name)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, _fresh_version(), timeout=None)
+        version = cache.get(key)
+    return version
+
+
+def get_versions(*names):
+    """Current version numbers for several names with one cache round trip"""
+    keys = [VERSION_KEY.format(name) for name in names]
+    found = cache.get_many(keys)
+    return tuple(
+        found[key] if key in found else get_version(name)
+        for name, key in zip(names, keys)
+    )
+
+
+def bump_version(name):
+    """Invalidate everything cached under the current version of a name"""
+    key = VERSION_KEY.format(name)
+    try:
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, _fresh_version(), timeout=None)
+    except Exception as e:
+        # The change is already committed; local copies catch up on their max age
+        logger.error(f'Could not bump cache version {name}: {e}')
+
+
+def bump_version_on_commit(name):
+    """Bump a version once the current transaction commits"""
+    transaction.on_commit(lambda: bump_version(name))
+
+
+def versioned_key(key, *names):
+    """Cache key that changes whenever any of the named versions is bumped"""
+    versions = '.'.join(str(version) for version in get_versions(*names))
+    return f'{key}:v{versions}'
+
+
+class LocalCopy:
+    """
+    A value kept in process memory and reloaded when its version is bumped.
+
+    Each read costs one shared-cache lookup of the version instead of the
+    database queries behind the value. When the cache is not shared or
+    cannot be reached, the value is also reloaded once it is older than
+    LOCAL_CACHE_MAX_AGE_SECONDS. Treat the value as read-only: every thread
+    in the process shares it.
+    """
+
+    def __init__(self, name, loader):
+        self.name = name
+        self.loader = loader
+        self._loaded = (None, float('-inf'), None)
+        self._lock = threading.Lock()
+
+    def _current_version(self):
+        try:
+            return get_version(self.name)
+        except Exception:
+            # The cache may live on a Redis that just went away
+            return None
+
+    def _is_fresh(self, version, loaded_version, loaded_at):
+        if version is not None and version != loaded_version:
+            return False
+        if version is not None and cache_is_shared():
+            return True
+        # A bump made by another process may not have reached us
+        return time.monotonic() - loaded_at < settings.LOCAL_CACHE_MAX_AGE_SECONDS
+
+    def get(self):
+        version = self._current_version()
+        loaded_version, loaded_at, value = self._loaded
+        if self._is_fresh(version, loaded_version, loaded_at):
+            return value
+        with self._lock:
+            loaded_version, loaded_at, value = self._loaded
+            if not self._is_fresh(version, loaded_version, loaded_at):
+                value = self.loader()
+                self._loaded = (version, time.monotonic(), value)
+        return value
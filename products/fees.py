@@ -0,0 +1,120 @@
+"""
+Distance fee tiers as an immutable in-memory lookup table.
+
+Every checkout step needs the transport fee for a distance. Rather than
+querying DistanceBasedFee each time, the active tiers are loaded once per
+process into a FeeTable and resolved with binary search. The table is
+stamped with a shared-cache version that the DistanceBasedFee signals bump,
+so an edit on the pricing settings page reaches every gunicorn and Celery
+process on its next lookup.
+
+Tiers are validated when they are saved (DistanceBasedFee.clean()).
+A bad tier that reached the database anyway is logged when the table loads,
+and checkout keeps quoting from the rows as they are.
+"""
+import logging
+from bisect import bisect_right
+from decimal import Decimal
+
+from django.core.exceptions import ValidationError
+
+from .cache import LocalCopy
+
+logger = logging.getLogger(__name__)
+
+FEE_TABLE_VERSION = 'distance_fees'
+
+# Charged when no active tier covers the distance
+DEFAULT_DISTANCE_FEE = Decimal('250.00')
+
+
+def validate_tiers(tiers):
+    """
+    Check that tiers cover distances from 0 km without overlaps or gaps.
+
+    Tiers are (min_km, max_km, fee) with inclusive bounds. Neighbouring tiers
+    may share a boundary (0-30, 30-100), which belongs to the lower tier, or
+    meet on the next kilometre (0-30, 31-100).
+
+    Raises:
+        ValidationError: describing the first bad range
+    """
+    previous = None
+    for min_km, max_km, _ in sorted(tiers):
+        if min_km > max_km:
+            raise ValidationError(f'Tier {min_km}-{max_km} km ends before it starts.')
+        if previous is None:
+            if min_km != 0:
+                raise ValidationError(f'Distance tiers must start at 0 km, not {min_km} km.')
+        elif min_km < previous[1]:
+            raise ValidationError(
+                f'Tier {min_km}-{max_km} km overlaps {previous[0]}-{previous[1]} km.'
+            )
+        elif min_km > previous[1] + 1:
+            raise ValidationError(
+                f'No tier covers {previous[1] + 1}-{min_km - 1} km.'
+            )
+        previous = (min_km, max_km)
+
+
+class FeeTable:
+    """Sorted distance tiers with the fallback fee"""
+    __slots__ = ('mins', 'maxes', 'fees', 'fallback')
+
+    def __init__(self, tiers, fallback=DEFAULT_DISTANCE_FEE):
+        tiers = sorted(tiers)
+        self.mins = tuple(min_km for min_km, _, _ in tiers)
+        self.maxes = tuple(max_km for _, max_km, _ in tiers)
+        self.fees = tuple(Decimal(fee) for _, _, fee in tiers)
+        self.fallback = fallback
+
+    def __len__(self):
+        return len(self.fees)
+
+    def fee_for(self, distance_km):
+        """
+        Fee for a distance; the first tier's fee when the distance is unknown.
+
+        Returns:
+            Decimal
+        """
+        if not self.fees:
+            return self.fallback
+        if distance_km is None:
+            return self.fees[0]
+        index = bisect_right(self.mins, distance_km) - 1
+        # A shared boundary belongs to the lower tier
+        if index > 0 and distance_km <= self.maxes[index - 1]:
+            index -= 1
+        if index < 0 or distance_km > self.maxes[index]:
+            return self.fallback
+        return self.fees[index]
+
+
+def load_fee_table():
+    """
+    Build a FeeTable from the active DistanceBasedFee rows.
+
+    Invalid tiers are logged rather than raised, so one bad row cannot take
+    down every checkout page; distances in a gap get the fallback fee.
+    """
+    from .models import DistanceBasedFee
+
+    tiers = list(
+        DistanceBasedFee.objects.filter(is_active=True).values_list(
+            'min_distance_km', 'max_distance_km', 'fee'
+        )
+    )
+    try:
+        validate_tiers(tiers)
+    except ValidationError as e:
+        logger.error(f'Active distance fee tiers are invalid, quoting from them as they are: {e.messages[0]}')
+    return FeeTable(tiers)
+
+
+_fee_table = LocalCopy(FEE_TABLE_VERSION, load_fee_table)
+
+
+def get_fee_table():
+    """The current FeeTable, reloaded only after its version was bumped"""
+    return _fee_table.get()
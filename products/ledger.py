@@ -0,0 +1,274 @@
+"""
+Per-product daily occupancy ledger.
+
+ProductDayOccupancy holds one row per (product, day) with the number of units
+booked out that day and the number held by customers who are still paying.
+Booking.save() and the reservation code keep it current inside the same
+transaction, so availability checks become indexed lookups instead of scans
+of the bookings table. rebuild_ledger() recomputes it from bookings and
+holds and corrects it under the same day locks the writers take.
+"""
+from collections import Counter, defaultdict
+from itertools import accumulate
+
+from django.db import transaction
+from django.db.models import F
+
+from .availability import (
+    active_statuses,
+    availability_version,
+    daterange,
+    occupancy_from_intervals,
+)
+from .cache import bump_version_on_commit
+from .models import ProductDayOccupancy
+
+LEDGER_FIELDS = ('booked_units', 'held_units')
+
+
+def ensure_days(product_id, first_day, last_day):
+    """Create any missing ledger rows for the interval"""
+    ProductDayOccupancy.objects.bulk_create(
+        [
+            ProductDayOccupancy(product_id=product_id, day=day)
+            for day in daterange(first_day, last_day)
+        ],
+        ignore_conflicts=True,
+    )
+
+
+def lock_days(product_id, first_day, last_day):
+    """
+    Lock the ledger rows of an interval until the transaction ends.
+
+    Rows are locked in day order so overlapping requests cannot deadlock.
+
+    Returns:
+        list: the locked ProductDayOccupancy rows
+    """
+    ensure_days(product_id, first_day, last_day)
+    return list(
+        ProductDayOccupancy.objects.select_for_update().filter(
+            product_id=product_id,
+            day__range=(first_day, last_day),
+        ).order_by('day')
+    )
+
+
+def apply_interval(product_id, first_day, last_day, delta, field='booked_units'):
+    """Add delta units to a ledger column for every day from first_day to last_day"""
+    # A bare UPDATE locks rows in whatever order it scans them; take the
+    # locks in day order first so concurrent writers cannot deadlock
+    lock_days(product_id, first_day, last_day)
+    ProductDayOccupancy.objects.filter(
+        product_id=product_id,
+        day__range=(first_day, last_day),
+    ).update(**{field: F(field) + delta})
+    bump_version_on_commit(availability_version(product_id))
+
+
+def move_interval(previous, current):
+    """
+    Move one booked unit from the previous interval to the current one.
+
+    Both arguments are (product_id, first_day, last_day) tuples or None when
+    the booking does not hold a unit. Must run inside the transaction that
+    saves the booking.
+    """
+    move_intervals([(previous, current)])
+
+
+def move_intervals(moves):
+    """
+    Apply many (previous, current) moves, e.g. those of a bulk write.
+
+    Moves are netted per product and products are written in id order. A
+    product with one or two changed intervals has them applied in first_day
+    order: any day an interval locks that an earlier one did not is later
+    than every day locked before it, so all writers take the row locks in
+    one (product_id, day) order and cannot deadlock, even when a booking
+    moves to another product. More intervals lock the product's whole span
+    once, in day order, and write each day's net change in one statement.
+    """
+    changes = defaultdict(Counter)
+    for previous, current in moves:
+        if previous == current:
+            continue
+        for interval, delta in ((previous, -1), (current, 1)):
+            if interval:
+                product_id, first_day, last_day = interval
+                changes[product_id][first_day, last_day] += delta
+
+    for product_id in sorted(changes):
+        intervals = sorted((days, delta) for days, delta in changes[product_id].items() if delta)
+        if len(intervals) > 2:
+            _apply_intervals(product_id, intervals)
+            continue
+        for (first_day, last_day), delta in intervals:
+            apply_interval(product_id, first_day, last_day, delta=delta)
+
+
+def _apply_intervals(product_id, intervals):
+    """Add ((first_day, last_day), delta) intervals to one product's booked units"""
+    first_day = intervals[0][0][0]
+    last_day = max(last for (_, last), _ in intervals)
+    deltas = [0] * ((last_day - first_day).days + 2)
+    for (start, end), delta in intervals:
+        deltas[(start - first_day).days] += delta
+        deltas[(end - first_day).days + 1] -= delta
+
+    changed = []
+    for row, delta in zip(lock_days(product_id, first_day, last_day), accumulate(deltas)):
+        if delta:
+            row.booked_units += delta
+            changed.append(row)
+    ProductDayOccupancy.objects.bulk_update(changed, ['booked_units'], batch_size=1000)
+    bump_version_on_commit(availability_version(product_id))
+
+
+def read_ledger(product_ids, start_date, end_date):
+    """
+    Booked plus held units per day straight from the ledger.
+
+    Returns:
+        dict: {product_id: list of units out, index 0 == start_date}
+    """
+    days = (end_date - start_date).days + 1
+    occupied = {product_id: [0] * days for product_id in product_ids}
+    rows = ProductDayOccupancy.objects.filter(
+        product_id__in=product_ids,
+        day__range=(start_date, end_date),
+    ).values_list('product_id', 'day', 'booked_units', 'held_units')
+    for product_id, day, booked_units, held_units in rows:
+        occupied[product_id][(day - start_date).days] = booked_units + held_units
+    return occupied
+
+
+def _count_intervals(rows):
+    """Turn (product_id, first_day, last_day) rows into {product_id: {day: count}}"""
+    intervals = defaultdict(list)
+    for product_id, first_day, last_day in rows:
+        if last_day >= first_day:
+            intervals[product_id].append((first_day, last_day))
+
+    counts = {}
+    for product_id, product_intervals in intervals.items():
+        start_date = min(first_day for first_day, _ in product_intervals)
+        end_date = max(last_day for _, last_day in product_intervals)
+        occupancy = occupancy_from_intervals(product_intervals, start_date, end_date)
+        counts[product_id] = {
+            day: units
+            for day, units in zip(daterange(start_date, end_date), occupancy)
+            if units
+        }
+    return counts
+
+
+def compute_occupancy(product_ids=None):
+    """
+    Recompute every product's daily occupancy from bookings and holds.
+
+    Expired holds still count until the sweeper releases them, exactly as
+    they do in the stored ledger.
+
+    Returns:
+        dict: {product_id: {day: (booked_units, held_units)}} with empty days omitted
+    """
+    from bookings.models import Booking, StockHold
+
+    bookings = Booking.objects.filter(status__in=active_statuses())
+    holds = StockHold.objects.all()
+    if product_ids is not None:
+        bookings = bookings.filter(product_id__in=product_ids)
+        holds = holds.filter(product_id__in=product_ids)
+
+    booked = _count_intervals(
+        bookings.values_list('product_id', 'drop_off_date', 'expected_end_date').iterator(
+            chunk_size=2000
+        )
+    )
+    held = _count_intervals(holds.values_list('product_id', 'drop_off_date', 'end_date'))
+
+    occupancy = {}
+    for product_id in set(booked) | set(held):
+        booked_days = booked.get(product_id, {})
+        held_days = held.get(product_id, {})
+        occupancy[product_id] = {
+            day: (booked_days.get(day, 0), held_days.get(day, 0))
+            for day in set(booked_days) | set(held_days)
+        }
+    return occupancy
+
+
+def _rebuild_product(product_id, first_day, last_day):
+    """Correct one product's ledger rows from first_day to last_day"""
+    # Once the days are locked, a booking or hold touching them has either
+    # committed its ledger change, and is counted below, or is waiting to
+    # apply it on top of the corrected rows
+    rows = lock_days(product_id, first_day, last_day)
+    expected = compute_occupancy([product_id]).get(product_id, {})
+    drift, changed = [], []
+    for row in rows:
+        ledger_units = (row.booked_units, row.held_units)
+        expected_units = expected.get(row.day, (0, 0))
+        if ledger_units != expected_units:
+            drift.append((product_id, row.day, ledger_units, expected_units))
+            row.booked_units, row.held_units = expected_units
+            changed.append(row)
+    if changed:
+        ProductDayOccupancy.objects.bulk_update(changed, LEDGER_FIELDS)
+        bump_version_on_commit(availability_version(product_id))
+    return drift
+
+
+def rebuild_ledger(product_ids=None, dry_run=False, batch_size=2000):
+    """
+    Recompute the ledger from bookings and holds and report drift.
+
+    Safe to run while customers book: a first unlocked pass finds the days
+    that drifted, then each drifting product is recounted and corrected with
+    those days locked, one transaction per product.
+
+    Args:
+        product_ids: limit to these products (all products when None)
+        dry_run: only report drift, leave the ledger untouched
+        batch_size: rows per query chunk
+
+    Returns:
+        list: (product_id, day, ledger_units, expected_units) for every day
+        on which the stored ledger disagreed; units are (booked, held) pairs
+    """
+    expected = compute_occupancy(product_ids)
+
+    stored_rows = ProductDayOccupancy.objects.exclude(booked_units=0, held_units=0)
+    if product_ids is not None:
+        stored_rows = stored_rows.filter(product_id__in=product_ids)
+    stored = defaultdict(dict)
+    for product_id, day, booked_units, held_units in stored_rows.values_list(
+        'product_id', 'day', *LEDGER_FIELDS
+    ).iterator(chunk_size=batch_size):
+        stored[product_id][day] = (booked_units, held_units)
+
+    drift = []
+    for product_id in set(expected) | set(stored):
+        expected_days = expected.get(product_id, {})
+        stored_days = stored.get(product_id, {})
+        for day in sorted(set(expected_days) | set(stored_days)):
+            ledger_units = stored_days.get(day, (0, 0))
+            expected_units = expected_days.get(day, (0, 0))
+            if ledger_units != expected_units:
+                drift.append((product_id, day, ledger_units, expected_units))
+
+    if dry_run:
+        return drift
+
+    drifted_days = defaultdict(list)
+    for product_id, day, _, _ in drift:
+        drifted_days[product_id].append(day)
+    fixed = []
+    for product_id in sorted(drifted_days):
+        with transaction.atomic():
+            fixed.extend(_rebuild_product(
+                product_id, min(drifted_days[product_id]), max(drifted_days[product_id])
+            ))
+    return fixed
@@ -0,0 +1,33 @@
+"""
+Assign physical units to active bookings that do not have one yet.
+
+Run after adding units to a product that already has bookings:
+    python manage.py allocate_units --product standard-pod
+"""
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from products.allocation import allocate_unassigned
+from products.models import Product
+
+
+class Command(BaseCommand):
+    help = 'Best-fit allocate rental units to unassigned active bookings'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--product', action='append', default=[],
+                            help='Product slug (repeatable); defaults to every product with units')
+
+    def handle(self, *args, **options):
+        products = Product.objects.filter(units__isnull=False).distinct()
+        if options['product']:
+            products = products.filter(slug__in=options['product'])
+
+        today = timezone.now().date()
+        for product in products:
+            assigned, unplaced = allocate_unassigned(product.id, today)
+            self.stdout.write(f'{product.name}: assigned {assigned}, without a unit {len(unplaced)}')
+            for booking in unplaced[:10]:
+                self.stdout.write(self.style.WARNING(
+                    f'  booking {booking.pk} {booking.drop_off_date} to {booking.expected_end_date}'
+                ))
@@ -0,0 +1,197 @@
+"""
+Benchmark the best-fit unit allocator at fleet scale.
+
+Run: python manage.py benchmark_allocation --units 5000 --bookings 20000
+Works purely in memory, so no database rows are created. Best fit is
+compared with first fit on throughput, bookings left unplaced and the idle
+gaps left between rentals on the same unit.
+
+With --save, the real path is measured instead: an inactive product gets
+--units units and --bookings assigned bookings in the database, then
+--saves new bookings go through Booking.save(), which locks the ledger
+days and allocates a unit. The allocator load it does under those locks is
+timed both for the candidate units around each rental (what save uses) and
+for the whole fleet. Everything created is deleted at the end.
+"""
+import random
+import statistics
+import time
+from datetime import date, timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from bookings.models import Booking, BookingStatus
+from products.allocation import Allocator, load_allocator, load_candidates
+from products.availability import rental_end_date
+from products.models import Product, RentalUnit
+
+
+class FirstFitAllocator(Allocator):
+    """Baseline: the first unit with room, ignoring how well it fits"""
+
+    def best_unit(self, first_day, last_day):
+        first, last = first_day.toordinal(), last_day.toordinal()
+        for unit_id, schedule in self.schedules.items():
+            if schedule.fit(first, last) is not None:
+                return unit_id
+        return None
+
+
+class Command(BaseCommand):
+    help = 'Benchmark best-fit unit allocation against first fit'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--units', type=int, default=5000)
+        parser.add_argument('--bookings', type=int, default=20000)
+        parser.add_argument('--horizon', type=int, default=365,
+                            help='Spread drop-off dates over this many days')
+        parser.add_argument('--changes', type=int, default=5000,
+                            help='Extensions and cancellations replayed after allocation')
+        parser.add_argument('--save', action='store_true',
+                            help='Measure Booking.save() against database rows instead')
+        parser.add_argument('--saves', type=int, default=200,
+                            help='Bookings saved one by one with --save')
+
+    def handle(self, *args, **options):
+        if options['save']:
+            self.benchmark_save(options)
+            return
+        rng = random.Random(42)
+        start = date(2025, 1, 1)
+        requests = []
+        for booking_id in range(options['bookings']):
+            drop_off = start + timedelta(days=rng.randrange(options['horizon']))
+            months = rng.choice([1, 1, 2, 3, 6, 12])
+            requests.append((booking_id, drop_off, rental_end_date(drop_off, None, months)))
+        changes = [
+            (rng.randrange(options['bookings']), rng.random() < 0.5)
+            for _ in range(options['changes'])
+        ]
+
+        self.stdout.write(f"{options['units']} units, {options['bookings']} bookings, "
+                          f"{options['changes']} extensions/cancellations")
+        self.stdout.write(f"{'strategy':<10} {'alloc/s':>10} {'unplaced':>9} {'gaps':>7} "
+                          f"{'mean gap':>9} {'median':>7} {'change/s':>10}")
+        for name, allocator_class in (('best fit', Allocator), ('first fit', FirstFitAllocator)):
+            self._run(name, allocator_class, options['units'], requests, changes)
+
+    def _run(self, name, allocator_class, units, requests, changes):
+        allocator = allocator_class(range(units))
+        started = time.perf_counter()
+        unplaced = sum(
+            1 for booking_id, first_day, last_day in requests
+            if allocator.assign(booking_id, first_day, last_day) is None
+        )
+        alloc_rate = len(requests) / (time.perf_counter() - started)
+        gaps = allocator.idle_gaps()
+
+        started = time.perf_counter()
+        for booking_id, cancel in changes:
+            if booking_id not in allocator.unit_of:
+                continue
+            if cancel:
+                allocator.release(booking_id)
+            else:
+                _, first_day, last_day = requests[booking_id]
+                allocator.assign(booking_id, first_day, last_day + timedelta(days=30))
+        change_rate = len(changes) / (time.perf_counter() - started)
+
+        self.stdout.write(
+            f'{name:<10} {alloc_rate:>10.0f} {unplaced:>9} {len(gaps):>7} '
+            f'{statistics.fmean(gaps) if gaps else 0:>9.1f} '
+            f'{statistics.median(gaps) if gaps else 0:>7} {change_rate:>10.0f}'
+        )
+
+    def benchmark_save(self, options):
+        rng = random.Random(42)
+        start = timezone.localdate() + timedelta(days=30)
+        product = Product.objects.create(
+            name=f'Allocation Bench {timezone.now():%H%M%S%f}',
+            category='storage_pod',
+            description='Synthetic product for the allocation benchmark',
+            size_description='16ft',
+            monthly_rate=199,
+            stock_quantity=options['units'],
+            image='',
+            is_active=False,
+        )
+        try:
+            units = RentalUnit.objects.bulk_create([
+                RentalUnit(serial_number=f'BENCH-{product.id}-{i}', product=product)
+                for i in range(options['units'])
+            ], batch_size=2000)
+            unit_ids = [unit.pk for unit in units]
+
+            # Existing bookings, placed in memory and written in bulk
+            allocator = Allocator(unit_ids)
+            existing = []
+            for i in range(options['bookings']):
+                drop_off = start + timedelta(days=rng.randrange(options['horizon']))
+                last_day = rental_end_date(drop_off, None, rng.choice([1, 1, 2, 3, 6, 12]))
+                unit_id = allocator.assign(i, drop_off, last_day)
+                if unit_id is not None:
+                    existing.append(self._booking(product, drop_off, last_day, unit_id=unit_id))
+            Booking.objects.bulk_create(existing, batch_size=2000)
+            # Plan with real row counts, as autovacuum would after a load like this
+            with connection.cursor() as cursor:
+                cursor.execute(f'ANALYZE {Booking._meta.db_table}, {RentalUnit._meta.db_table}')
+            self.stdout.write(f"{options['units']} units, {len(existing)} existing bookings, "
+                              f"{options['saves']} saves through Booking.save()")
+
+            requests = []
+            for _ in range(options['saves']):
+                drop_off = start + timedelta(days=rng.randrange(options['horizon']))
+                requests.append((drop_off, rental_end_date(drop_off, None, rng.choice([1, 2, 3]))))
+
+            for label, load in (
+                ('candidates', lambda first, last: load_candidates(product.id, first, last)),
+                ('fleet load', lambda first, last: load_allocator(product.id, first)),
+            ):
+                started = time.perf_counter()
+                for first_day, last_day in requests:
+                    load(first_day, last_day)
+                elapsed = time.perf_counter() - started
+                self.stdout.write(f'{label:<14} {elapsed / len(requests) * 1000:8.2f} ms/booking')
+
+            timings, queries, placed = [], 0, 0
+            for first_day, last_day in requests:
+                booking = self._booking(product, first_day, last_day)
+                started = time.perf_counter()
+                with CaptureQueriesContext(connection) as captured, transaction.atomic():
+                    booking.save()
+                timings.append((time.perf_counter() - started) * 1000)
+                queries += len(captured)
+                placed += booking.rental_unit_id is not None
+            timings.sort()
+            self.stdout.write(
+                f"{'Booking.save':<14} {statistics.fmean(timings):8.2f} ms/booking "
+                f'(p50 {timings[len(timings) // 2]:.2f}, max {timings[-1]:.2f}), '
+                f'{queries / len(requests):.1f} queries, {placed}/{len(requests)} placed'
+            )
+        finally:
+            Booking.objects.filter(product=product).delete()
+            product.delete()
+
+    def _booking(self, product, drop_off, last_day, unit_id=None):
+        return Booking(
+            product=product,
+            rental_unit_id=unit_id,
+            customer_name='Allocation Bench',
+            customer_email='bench@example.com',
+            customer_phone='4165550000',
+            delivery_address='1 Bench St',
+            delivery_city='Toronto',
+            delivery_state='ON',
+            delivery_zip='M5H2N2',
+            drop_off_date=drop_off,
+            pickup_date=last_day,
+            expected_end_date=last_day,
+            rental_months=1,
+            monthly_rate=199,
+            total_amount=199,
+            status=BookingStatus.CONFIRMED,
+            payment_status='paid',
+        )
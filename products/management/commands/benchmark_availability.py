@@ -0,0 +1,122 @@
+"""
+Benchmark ledger-backed availability lookups against the per-date COUNT loop.
+
+Run: python manage.py benchmark_availability
+All synthetic data is created inside a transaction that is rolled back.
+"""
+import random
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from bookings.models import Booking, BookingStatus
+from products.availability import daterange, get_availability
+from products.models import Product
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Benchmark availability lookups as the window and booking count grow'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--bookings', type=int, nargs='+', default=[100, 1000, 10000])
+        parser.add_argument('--windows', type=int, nargs='+', default=[30, 60, 180, 365])
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--skip-legacy', action='store_true',
+                            help='Only time the engine, not the per-date loop')
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                self.run(options)
+                raise Rollback
+        except Rollback:
+            pass
+
+    def run(self, options):
+        product = Product.objects.create(
+            name='Benchmark Pod',
+            category='storage_pod',
+            description='Synthetic product for benchmarking',
+            size_description='16ft',
+            monthly_rate=199,
+            stock_quantity=10 ** 6,
+            image='',
+        )
+        today = timezone.now().date()
+        created = 0
+
+        self.stdout.write(f"{'bookings':>9} {'window':>7} {'engine ms':>10} {'queries':>8} "
+                          f"{'legacy ms':>10} {'queries':>8}")
+        for booking_count in sorted(options['bookings']):
+            self._create_bookings(product, today, booking_count - created)
+            created = booking_count
+
+            for window in options['windows']:
+                end_date = today + timedelta(days=window - 1)
+                engine_ms, engine_queries = self._time(
+                    options['repeat'], lambda: get_availability(product, today, end_date)
+                )
+                if options['skip_legacy']:
+                    legacy = f"{'-':>10} {'-':>8}"
+                else:
+                    legacy_ms, legacy_queries = self._time(
+                        options['repeat'], lambda: self._legacy(product, today, end_date)
+                    )
+                    legacy = f'{legacy_ms:>10.2f} {legacy_queries:>8}'
+                self.stdout.write(f'{booking_count:>9} {window:>7} {engine_ms:>10.2f} '
+                                  f'{engine_queries:>8} {legacy}')
+
+    def _create_bookings(self, product, today, count):
+        rng = random.Random(count)
+        statuses = [BookingStatus.CONFIRMED, BookingStatus.IN_PROGRESS, BookingStatus.COMPLETED]
+        batch = []
+        for _ in range(count):
+            drop_off = today + timedelta(days=rng.randint(-200, 365))
+            months = rng.randint(1, 6)
+            pickup = drop_off + timedelta(days=30 * months) if rng.random() < 0.7 else None
+            batch.append(Booking(
+                product=product,
+                customer_name='Bench',
+                customer_email='bench@example.com',
+                customer_phone='4165550123',
+                delivery_address='1 Bench St',
+                delivery_city='Toronto',
+                delivery_state='ON',
+                delivery_zip='M5H2N2',
+                drop_off_date=drop_off,
+                pickup_date=pickup,
+                rental_months=months,
+                monthly_rate=199,
+                total_amount=199 * months,
+                status=rng.choice(statuses),
+            ))
+        Booking.objects.bulk_create(batch, batch_size=1000)
+
+    def _legacy(self, product, start_date, end_date):
+        """The old approach: one COUNT query per date"""
+        return {
+            day: product.stock_quantity - Booking.objects.filter(
+                product=product,
+                status__in=[BookingStatus.CONFIRMED, BookingStatus.IN_PROGRESS],
+                drop_off_date__lte=day,
+                pickup_date__gte=day,
+            ).count()
+            for day in daterange(start_date, end_date)
+        }
+
+    def _time(self, repeat, func):
+        with CaptureQueriesContext(connection) as queries:
+            func()
+        started = time.perf_counter()
+        for _ in range(repeat):
+            func()
+        elapsed_ms = (time.perf_counter() - started) * 1000 / repeat
+        return elapsed_ms, len(queries)
@@ -0,0 +1,117 @@
+"""
+Benchmark the multi-product availability search used by booking_home.
+
+Run: python manage.py benchmark_product_search --products 500 --bookings 100000
+All synthetic data is created inside a transaction that is rolled back.
+"""
+import random
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from bookings.models import Booking, BookingStatus
+from products.availability import (
+    get_availability,
+    rental_end_date,
+    search_available_products,
+)
+from products.models import Product
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the grouped availability search across many products'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=500)
+        parser.add_argument('--bookings', type=int, default=100000)
+        parser.add_argument('--months', type=int, nargs='+', default=[1, 3, 12])
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                self.run(options)
+                raise Rollback
+        except Rollback:
+            pass
+
+    def run(self, options):
+        rng = random.Random(42)
+        today = timezone.now().date()
+
+        started = time.perf_counter()
+        products = Product.objects.bulk_create([
+            Product(
+                name=f'Search Bench {index}',
+                slug=f'search-bench-{index}',
+                category='storage_pod',
+                description='Synthetic product for benchmarking',
+                size_description='16ft',
+                monthly_rate=199,
+                stock_quantity=rng.randint(20, 120),
+                image='',
+            )
+            for index in range(options['products'])
+        ])
+        statuses = [BookingStatus.CONFIRMED, BookingStatus.IN_PROGRESS, BookingStatus.COMPLETED]
+        batch = []
+        for _ in range(options['bookings']):
+            drop_off = today + timedelta(days=rng.randint(-120, 240))
+            batch.append(Booking(
+                product=rng.choice(products),
+                customer_name='Bench',
+                customer_email='bench@example.com',
+                customer_phone='4165550123',
+                delivery_address='1 Bench St',
+                delivery_city='Toronto',
+                delivery_state='ON',
+                delivery_zip='M5H2N2',
+                drop_off_date=drop_off,
+                rental_months=rng.randint(1, 4),
+                monthly_rate=199,
+                total_amount=199,
+                status=rng.choice(statuses),
+            ))
+        Booking.objects.bulk_create(batch, batch_size=5000)
+        self.stdout.write(f"Seeded {options['products']} products, {options['bookings']} bookings "
+                          f"in {time.perf_counter() - started:.1f}s")
+
+        product_ids = [product.id for product in products]
+        drop_off = today + timedelta(days=30)
+        self.stdout.write(f"{'months':>7} {'search ms':>10} {'queries':>8} {'available':>10} "
+                          f"{'per-product ms':>15} {'queries':>8}")
+        for months in options['months']:
+            def search():
+                return list(search_available_products(
+                    Product.objects.filter(id__in=product_ids), drop_off, months
+                ))
+
+            def per_product():
+                end_date = rental_end_date(drop_off, None, months)
+                return [
+                    product for product in Product.objects.filter(id__in=product_ids)
+                    if min(get_availability(product, drop_off, end_date).values()) > 0
+                ]
+
+            search_ms, search_queries, results = self._time(options['repeat'], search)
+            loop_ms, loop_queries, _ = self._time(1, per_product)
+            available = sum(1 for product in results if product.units_free > 0)
+            self.stdout.write(f'{months:>7} {search_ms:>10.1f} {search_queries:>8} {available:>10} '
+                              f'{loop_ms:>15.1f} {loop_queries:>8}')
+
+    def _time(self, repeat, func):
+        with CaptureQueriesContext(connection) as queries:
+            result = func()
+        started = time.perf_counter()
+        for _ in range(repeat):
+            func()
+        elapsed_ms = (time.perf_counter() - started) * 1000 / repeat
+        return elapsed_ms, len(queries), result
@@ -0,0 +1,41 @@
+"""
+Recompute the ProductDayOccupancy ledger from bookings and report drift.
+
+Run: python manage.py rebuild_occupancy_ledger [--verify] [--product ID ...]
+"""
+import time
+
+from django.core.management.base import BaseCommand
+
+from products.ledger import rebuild_ledger
+
+
+class Command(BaseCommand):
+    help = 'Rebuild (or with --verify, only check) the daily occupancy ledger'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--verify', action='store_true',
+                            help='Report drift without writing the ledger')
+        parser.add_argument('--product', type=int, nargs='+', dest='product_ids',
+                            help='Limit to these product IDs')
+        parser.add_argument('--show', type=int, default=20,
+                            help='How many drifted days to print')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        drift = rebuild_ledger(options['product_ids'], dry_run=options['verify'])
+        elapsed = time.perf_counter() - started
+
+        for product_id, day, ledger_units, expected_units in drift[:options['show']]:
+            self.stdout.write(
+                f'  product {product_id} {day}: ledger={ledger_units} bookings={expected_units}'
+            )
+        if len(drift) > options['show']:
+            self.stdout.write(f'  ... and {len(drift) - options["show"]} more')
+
+        action = 'Verified' if options['verify'] else 'Rebuilt'
+        message = f'{action} ledger in {elapsed:.2f}s: {len(drift)} drifted day(s)'
+        if drift and options['verify']:
+            self.stdout.write(self.style.WARNING(message))
+        else:
+            self.stdout.write(self.style.SUCCESS(message))
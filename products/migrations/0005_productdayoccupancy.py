@@ -0,0 +1,102 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:56
+
+import calendar
+from datetime import timedelta
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+# Frozen copies of the products.availability helpers as they were when this
+# migration was written, so later changes to them cannot alter it
+
+def add_months(start_date, months):
+    month_index = start_date.month - 1 + months
+    year = start_date.year + month_index // 12
+    month = month_index % 12 + 1
+    day = min(start_date.day, calendar.monthrange(year, month)[1])
+    return start_date.replace(year=year, month=month, day=day)
+
+
+def rental_end_date(drop_off_date, pickup_date, rental_months):
+    if pickup_date:
+        return pickup_date
+    return add_months(drop_off_date, rental_months)
+
+
+def daterange(start_date, end_date):
+    for offset in range((end_date - start_date).days + 1):
+        yield start_date + timedelta(days=offset)
+
+
+def occupancy_from_intervals(intervals, start_date, end_date):
+    days = (end_date - start_date).days + 1
+    if days <= 0:
+        return []
+
+    diff = [0] * (days + 1)
+    for first_day, last_day in intervals:
+        if last_day < start_date or first_day > end_date:
+            continue
+        begin = max((first_day - start_date).days, 0)
+        end = min((last_day - start_date).days, days - 1)
+        diff[begin] += 1
+        diff[end + 1] -= 1
+
+    occupancy = []
+    running = 0
+    for delta in diff[:days]:
+        running += delta
+        occupancy.append(running)
+    return occupancy
+
+
+def build_ledger(apps, schema_editor):
+    Booking = apps.get_model('bookings', 'Booking')
+    ProductDayOccupancy = apps.get_model('products', 'ProductDayOccupancy')
+
+    intervals = {}
+    for product_id, drop_off_date, pickup_date, rental_months in Booking.objects.filter(
+        status__in=['confirmed', 'in_progress', 'pickup_scheduled']
+    ).values_list('product_id', 'drop_off_date', 'pickup_date', 'rental_months'):
+        last_day = rental_end_date(drop_off_date, pickup_date, rental_months)
+        if last_day >= drop_off_date:
+            intervals.setdefault(product_id, []).append((drop_off_date, last_day))
+
+    rows = []
+    for product_id, product_intervals in intervals.items():
+        start_date = min(first_day for first_day, _ in product_intervals)
+        end_date = max(last_day for _, last_day in product_intervals)
+        counts = occupancy_from_intervals(product_intervals, start_date, end_date)
+        rows.extend(
+            ProductDayOccupancy(product_id=product_id, day=day, booked_units=booked)
+            for day, booked in zip(daterange(start_date, end_date), counts)
+            if booked
+        )
+    ProductDayOccupancy.objects.bulk_create(rows, batch_size=2000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0004_distancebasedfee'),
+        ('bookings', '0004_booking_delivery_distance_km'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductDayOccupancy',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('booked_units', models.IntegerField(default=0)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='day_occupancy', to='products.product')),
+            ],
+            options={
+                'verbose_name': 'Product Day Occupancy',
+                'verbose_name_plural': 'Product Day Occupancy',
+                'constraints': [models.UniqueConstraint(fields=('product', 'day'), name='unique_product_day_occupancy')],
+            },
+        ),
+        migrations.RunPython(build_ledger, migrations.RunPython.noop),
+    ]
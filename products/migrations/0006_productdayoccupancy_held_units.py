@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0005_productdayoccupancy'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='productdayoccupancy',
+            name='held_units',
+            field=models.IntegerField(default=0, help_text='Units reserved by checkouts that have not paid yet'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-17 02:06
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0006_productdayoccupancy_held_units'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RentalUnit',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('serial_number', models.CharField(max_length=50, unique=True)),
+                ('depot', models.CharField(blank=True, max_length=100)),
+                ('condition', models.CharField(choices=[('good', 'Good'), ('needs_repair', 'Needs Repair'), ('retired', 'Retired')], default='good', help_text='Retired units are never assigned to new bookings', max_length=20)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='units', to='products.product')),
+            ],
+            options={
+                'ordering': ['product', 'serial_number'],
+            },
+        ),
+    ]
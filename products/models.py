@@ -2,6 +2,7 @@ from django.db import models
 from django.core.validators import MinValueValidator
 from django.utils.text import slugify
 from cloudinary.models import CloudinaryField
+from .cache import LocalCopy
 
 
 class ProductCategory(models.TextChoices):
@@ -56,14 +57,67 @@ class Product(models.Model):
     
     def get_available_quantity(self, date):
         """Calculate available quantity for a specific date"""
-        from bookings.models import Booking
-        booked = Booking.objects.filter(
-            product=self,
-            status__in=['confirmed', 'in_progress'],
-            drop_off_date__lte=date,
-            pickup_date__gte=date
-        ).count()
-        return self.stock_quantity - booked
+        from .availability import get_availability
+        return get_availability(self, date, date)[date]
+
+
+class ProductDayOccupancy(models.Model):
+    """Units of a product out on a given day, maintained from Booking and StockHold"""
+    product = models.ForeignKey(
+        Product,
+        on_delete=models.CASCADE,
+        related_name='day_occupancy'
+    )
+    day = models.DateField()
+    booked_units = models.IntegerField(default=0)
+    held_units = models.IntegerField(
+        default=0,
+        help_text="Units reserved by checkouts that have not paid yet"
+    )
+    
+    class Meta:
+        verbose_name = "Product Day Occupancy"
+        verbose_name_plural = "Product Day Occupancy"
+        constraints = [
+            models.UniqueConstraint(
+                fields=['product', 'day'],
+                name='unique_product_day_occupancy'
+            )
+        ]
+    
+    def __str__(self):
+        return f"{self.product_id} on {self.day}: {self.booked_units} booked, {self.held_units} held"
+
+
+class UnitCondition(models.TextChoices):
+    GOOD = 'good', 'Good'
+    NEEDS_REPAIR = 'needs_repair', 'Needs Repair'
+    RETIRED = 'retired', 'Retired'
+
+
+class RentalUnit(models.Model):
+    """A physical pod or bin of a product, assigned to bookings by products.allocation"""
+    serial_number = models.CharField(max_length=50, unique=True)
+    product = models.ForeignKey(
+        Product,
+        on_delete=models.CASCADE,
+        related_name='units'
+    )
+    depot = models.CharField(max_length=100, blank=True)
+    condition = models.CharField(
+        max_length=20,
+        choices=UnitCondition.choices,
+        default=UnitCondition.GOOD,
+        help_text="Retired units are never assigned to new bookings"
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        ordering = ['product', 'serial_number']
+    
+    def __str__(self):
+        return f"{self.serial_number} ({self.product.name})"
 
 
 class PricingSetting(models.Model):
@@ -101,10 +155,24 @@ class PricingSetting(models.Model):
         return f"Transport Fee: ${self.transport_fee}"
     
     @classmethod
-    def get_settings(cls):
-        """Get or create pricing settings"""
-        obj, created = cls.objects.get_or_create(pk=1)
-        return obj
+    def get_settings(cls, cached=True):
+        """
+        Get or create pricing settings.
+
+        The cached copy is shared by the whole process and must not be
+        modified; pass cached=False to load a row for editing.
+        """
+        if not cached:
+            obj, created = cls.objects.get_or_create(pk=1)
+            return obj
+        return _pricing_settings.get()
+
+
+PRICING_SETTINGS_VERSION = 'pricing_settings'
+_pricing_settings = LocalCopy(
+    PRICING_SETTINGS_VERSION,
+    lambda: PricingSetting.get_settings(cached=False)
+)
 
 
 class DistanceBasedFee(models.Model):
@@ -141,23 +209,27 @@ class DistanceBasedFee(models.Model):
     def __str__(self):
         return f"{self.description}: ${self.fee}"
     
+    def clean(self):
+        """Reject a change that would leave the active tiers overlapping or gapped"""
+        from .fees import validate_tiers
+        tiers = list(
+            DistanceBasedFee.objects.filter(is_active=True).exclude(pk=self.pk)
+            .values_list('min_distance_km', 'max_distance_km', 'fee')
+        )
+        if self.is_active:
+            tiers.append((self.min_distance_km, self.max_distance_km, self.fee))
+        validate_tiers(tiers)
+    
+    def save(self, *args, **kwargs):
+        # Forms run clean() through full_clean(), the shell and scripts do not
+        self.clean()
+        super().save(*args, **kwargs)
+    
     @staticmethod
     def get_fee_for_distance(distance_km):
-        """Get the fee for a given distance"""
-        if distance_km is None:
-            # Default to within 30km fee
-            fee_obj = DistanceBasedFee.objects.filter(
-                min_distance_km=0,
-                is_active=True
-            ).first()
-            return fee_obj.fee if fee_obj else 250.00
-        
-        fee_obj = DistanceBasedFee.objects.filter(
-            min_distance_km__lte=distance_km,
-            max_distance_km__gte=distance_km,
-            is_active=True
-        ).first()
-        return fee_obj.fee if fee_obj else 250.00
+        """Get the fee for a given distance from the cached tier table"""
+        from .fees import get_fee_table
+        return get_fee_table().fee_for(distance_km)
 
 
 class BlackoutDate(models.Model):
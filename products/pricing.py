@@ -0,0 +1,110 @@
+"""
+Rental price quotes in exact cents.
+
+Every price shown to a customer, charged through Stripe or stored on a
+Booking comes from quote(). Amounts are held as integer cents so totals never
+pick up float rounding, and Decimal dollars are derived from them for display
+and model fields. Nothing here touches the database except the fee table
+lookup in quote_for(), which is served from process memory.
+"""
+from dataclasses import dataclass
+from decimal import ROUND_HALF_UP, Decimal
+
+CENT = Decimal('0.01')
+
+
+def to_cents(amount):
+    """Dollars (Decimal, int, float or str) as integer cents, rounding half up"""
+    return int((Decimal(str(amount)) * 100).quantize(Decimal('1'), rounding=ROUND_HALF_UP))
+
+
+def to_dollars(cents):
+    """Integer cents as a two-place Decimal"""
+    return (Decimal(cents) / 100).quantize(CENT)
+
+
+@dataclass(frozen=True)
+class Quote:
+    """Itemized price of one rental; all amounts in cents"""
+    monthly_rate_cents: int
+    rental_months: int
+    transport_fee_cents: int
+
+    @property
+    def monthly_cost_cents(self):
+        return self.monthly_rate_cents * self.rental_months
+
+    @property
+    def total_cents(self):
+        return self.monthly_cost_cents + self.transport_fee_cents
+
+    @property
+    def monthly_rate(self):
+        return to_dollars(self.monthly_rate_cents)
+
+    @property
+    def monthly_cost(self):
+        return to_dollars(self.monthly_cost_cents)
+
+    @property
+    def transport_fee(self):
+        return to_dollars(self.transport_fee_cents)
+
+    @property
+    def total(self):
+        return to_dollars(self.total_cents)
+
+
+def quote(monthly_rate, rental_months, transport_fee):
+    """Quote from explicit amounts, e.g. the rates stored on a Booking"""
+    return Quote(to_cents(monthly_rate), int(rental_months), to_cents(transport_fee))
+
+
+def quote_for(product, rental_months, distance_km, fee_table=None):
+    """
+    Quote a product for a rental term and delivery distance.
+
+    Args:
+        product: Product (only monthly_rate is read)
+        rental_months: paid term in months
+        distance_km: delivery distance, None for the default tier
+        fee_table: FeeTable to use, defaults to the cached active tiers
+
+    Returns:
+        Quote
+    """
+    if fee_table is None:
+        from .fees import get_fee_table
+        fee_table = get_fee_table()
+    return quote(product.monthly_rate, rental_months, fee_table.fee_for(distance_km))
+
+
+def quote_matrix(products, months_options, distances=(), fee_table=None, fees=None):
+    """
+    Quote every (product, months, distance) combination in one call.
+
+    Rates and fees are converted to cents once per product and per distance,
+    so the inner loop is plain integer arithmetic and thousands of quotes
+    cost a few milliseconds.
+
+    Args:
+        distances: delivery distances to look up in the fee table
+        fees: {key: fee} to quote with as given instead, e.g. one per tier
+
+    Returns:
+        dict: {(product_id, months, distance_km or key): Quote}
+    """
+    if fees is None:
+        if fee_table is None:
+            from .fees import get_fee_table
+            fee_table = get_fee_table()
+        fees = {distance: fee_table.fee_for(distance) for distance in distances}
+    fee_cents = {key: to_cents(fee) for key, fee in fees.items()}
+    months_options = [int(months) for months in months_options]
+    quotes = {}
+    for product in products:
+        rate_cents = to_cents(product.monthly_rate)
+        for months in months_options:
+            for distance, fee in fee_cents.items():
+                quotes[(product.id, months, distance)] = Quote(rate_cents, months, fee)
+    return quotes
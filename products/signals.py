@@ -0,0 +1,39 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from .availability import ALL_AVAILABILITY_VERSION, availability_version
+from .cache import bump_version_on_commit
+from .fees import FEE_TABLE_VERSION
+from .models import (
+    PRICING_SETTINGS_VERSION,
+    BlackoutDate,
+    DistanceBasedFee,
+    PricingSetting,
+    Product,
+)
+
+
+@receiver(post_save, sender=Product)
+def product_saved(sender, instance, **kwargs):
+    """Stock changes alter every cached calendar month of the product"""
+    bump_version_on_commit(availability_version(instance.id))
+
+
+@receiver([post_save, post_delete], sender=BlackoutDate)
+def blackout_changed(sender, instance, **kwargs):
+    """Refresh cached calendars affected by a blackout date"""
+    if instance.product_id:
+        bump_version_on_commit(availability_version(instance.product_id))
+    else:
+        bump_version_on_commit(ALL_AVAILABILITY_VERSION)
+
+
+@receiver([post_save, post_delete], sender=DistanceBasedFee)
+def distance_fee_changed(sender, instance, **kwargs):
+    """Make every process reload its fee table"""
+    bump_version_on_commit(FEE_TABLE_VERSION)
+
+
+@receiver([post_save, post_delete], sender=PricingSetting)
+def pricing_settings_changed(sender, instance, **kwargs):
+    """Make every process reload its cached pricing settings"""
+    bump_version_on_commit(PRICING_SETTINGS_VERSION)
@@ -1,3 +1,382 @@
-from django.test import TestCase
+import re
+from datetime import date, timedelta
+from decimal import Decimal
+from io import StringIO
+
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from bookings.models import BookingStatus
+from bookings.reservations import place_hold
+from bookings.tests import LOCAL_CACHE, make_booking, make_product
+from .allocation import FIT_WINDOW_DAYS
+from .availability import (
+    DAY_AVAILABLE,
+    DAY_BLACKOUT,
+    DAY_LOW,
+    DAY_SOLD_OUT,
+    get_cached_month_grid,
+    get_month_grid,
+    search_available_products,
+)
+from .fees import DEFAULT_DISTANCE_FEE, FeeTable, get_fee_table
+from .ledger import rebuild_ledger
+from .models import (
+    BlackoutDate,
+    DistanceBasedFee,
+    PricingSetting,
+    Product,
+    ProductDayOccupancy,
+    RentalUnit,
+    UnitCondition,
+)
+from .pricing import quote, quote_for, quote_matrix, to_cents
+
+DAY = timedelta(days=1)
+
+
+def book(product, first_day, last_day, **fields):
+    booking = make_booking(product, drop_off_date=first_day, pickup_date=last_day, **fields)
+    booking.save()
+    return booking
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class AllocationTests(TestCase):
+    def setUp(self):
+        self.product = make_product(stock_quantity=3)
+        self.units = [
+            RentalUnit.objects.create(serial_number=f'UNIT-{i}', product=self.product)
+            for i in range(3)
+        ]
+        self.start = date(2030, 3, 1)
+
+    def test_picks_the_unit_with_the_tightest_gap(self):
+        # Saved with a unit that is free, a booking keeps it
+        book(self.product, self.start, self.start + 4 * DAY, rental_unit=self.units[0])
+        book(self.product, self.start, self.start + 9 * DAY, rental_unit=self.units[1])
+        booking = book(self.product, self.start + 10 * DAY, self.start + 20 * DAY)
+        self.assertEqual(booking.rental_unit_id, self.units[1].pk)
+
+    def test_prefers_a_booked_unit_over_an_idle_one(self):
+        book(self.product, self.start, self.start + 4 * DAY, rental_unit=self.units[2])
+        booking = book(self.product, self.start + 20 * DAY, self.start + 30 * DAY)
+        self.assertEqual(booking.rental_unit_id, self.units[2].pk)
+
+    def test_overlapping_bookings_get_different_units(self):
+        bookings = [book(self.product, self.start, self.start + 20 * DAY) for _ in range(3)]
+        self.assertEqual(len({booking.rental_unit_id for booking in bookings}), 3)
+        self.assertIsNone(book(self.product, self.start + 5 * DAY, self.start + 6 * DAY).rental_unit_id)
+
+    def test_uses_a_unit_booked_outside_the_window(self):
+        far = book(self.product, self.start, self.start + DAY)
+        RentalUnit.objects.exclude(pk=far.rental_unit_id).update(condition=UnitCondition.RETIRED)
+        later = self.start + (FIT_WINDOW_DAYS + 10) * DAY
+        self.assertEqual(book(self.product, later, later + DAY).rental_unit_id, far.rental_unit_id)
+
+    def test_extension_keeps_the_unit_while_it_is_free(self):
+        booking = book(self.product, self.start, self.start + 9 * DAY)
+        unit_id = booking.rental_unit_id
+        booking.pickup_date = self.start + 19 * DAY
+        booking.save()
+        self.assertEqual(booking.rental_unit_id, unit_id)
+
+    def test_extension_moves_when_the_unit_is_taken(self):
+        booking = book(self.product, self.start, self.start + 9 * DAY, rental_unit=self.units[0])
+        book(self.product, self.start + 12 * DAY, self.start + 20 * DAY, rental_unit=self.units[0])
+        booking.pickup_date = self.start + 15 * DAY
+        booking.save()
+        self.assertIn(booking.rental_unit_id, {self.units[1].pk, self.units[2].pk})
+
+    def test_cancelling_frees_the_unit(self):
+        booking = book(self.product, self.start, self.start + 9 * DAY)
+        booking.status = BookingStatus.CANCELLED
+        booking.save()
+        self.assertIsNone(booking.rental_unit_id)
+        self.assertEqual(book(self.product, self.start, self.start + 9 * DAY).rental_unit_id, self.units[0].pk)
+
+    def test_retired_units_are_never_assigned(self):
+        RentalUnit.objects.filter(pk__in=[unit.pk for unit in self.units[:2]]).update(
+            condition=UnitCondition.RETIRED
+        )
+        self.assertEqual(book(self.product, self.start, self.start + DAY).rental_unit_id, self.units[2].pk)
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class MonthGridTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.product = make_product(stock_quantity=5)
+        self.start = date(2030, 3, 1)
+        # Four of five units out on the 1st, five on the 2nd, one on the 3rd;
+        # a day is low with one unit left
+        for _ in range(3):
+            book(self.product, self.start, self.start + DAY)
+        book(self.product, self.start, self.start + 2 * DAY)
+        book(self.product, self.start + DAY, self.start + DAY)
+
+    def test_day_states(self):
+        BlackoutDate.objects.create(date=self.start + 4 * DAY, reason='Inventory', product=self.product)
+        BlackoutDate.objects.create(date=self.start + 5 * DAY, reason='Holiday')
+        other = make_product(name='Other Pod')
+        BlackoutDate.objects.create(date=self.start + 6 * DAY, reason='Other only', product=other)
+
+        grid = get_month_grid(self.product, 2030, 3)
+        self.assertEqual(len(grid), 31)
+        self.assertEqual(
+            [grid[(self.start + offset * DAY).isoformat()] for offset in range(7)],
+            [DAY_LOW, DAY_SOLD_OUT, DAY_AVAILABLE, DAY_AVAILABLE, DAY_BLACKOUT, DAY_BLACKOUT, DAY_AVAILABLE],
+        )
+        self.assertEqual(get_month_grid(other, 2030, 3)['2030-03-06'], DAY_BLACKOUT)
+
+    def test_cached_grid_is_reused_until_a_version_bump(self):
+        day = (self.start + 3 * DAY).isoformat()
+        self.assertEqual(get_cached_month_grid(self.product, 2030, 3)[day], DAY_AVAILABLE)
+        # A write that bumps nothing is not seen
+        ProductDayOccupancy.objects.filter(product=self.product, day=self.start).update(booked_units=0)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_cached_month_grid(self.product, 2030, 3)['2030-03-01'], DAY_LOW)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            for _ in range(5):
+                book(self.product, self.start + 3 * DAY, self.start + 3 * DAY)
+        self.assertEqual(get_cached_month_grid(self.product, 2030, 3)[day], DAY_SOLD_OUT)
+
+    def test_global_blackout_bumps_every_product(self):
+        day = (self.start + 9 * DAY).isoformat()
+        self.assertEqual(get_cached_month_grid(self.product, 2030, 3)[day], DAY_AVAILABLE)
+        with self.captureOnCommitCallbacks(execute=True):
+            BlackoutDate.objects.create(date=self.start + 9 * DAY, reason='Holiday')
+        self.assertEqual(get_cached_month_grid(self.product, 2030, 3)[day], DAY_BLACKOUT)
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class ProductSearchTests(TestCase):
+    def setUp(self):
+        self.start = date(2030, 3, 1)
+        self.busy = make_product(name='Busy Pod')
+        self.held = make_product(name='Held Pod')
+        self.idle = make_product(name='Idle Pod')
+        self.products = Product.objects.filter(pk__in=[self.busy.pk, self.held.pk, self.idle.pk])
+
+    def search(self, drop_off_date, rental_months=1):
+        return {
+            product.pk: (product.units_free, product.blacked_out)
+            for product in search_available_products(self.products, drop_off_date, rental_months)
+        }
+
+    def test_busiest_day_inside_the_window_counts(self):
+        # Both units are out only in the middle of the term
+        book(self.busy, self.start + 14 * DAY, self.start + 14 * DAY)
+        book(self.busy, self.start + 13 * DAY, self.start + 15 * DAY)
+        # Out before the drop-off and after the term ends
+        book(self.idle, self.start - 10 * DAY, self.start - DAY)
+        book(self.idle, self.start + 40 * DAY, self.start + 50 * DAY)
+        place_hold(self.held, self.start + 20 * DAY, 1)
+
+        results = self.search(self.start)
+        self.assertEqual(results, {
+            self.busy.pk: (0, False),
+            self.held.pk: (1, False),
+            self.idle.pk: (2, False),
+        })
+        # A shorter term ending before the busy days leaves both units free
+        self.assertEqual(self.search(self.start - 20 * DAY)[self.busy.pk], (2, False))
+
+    def test_product_and_global_blackouts(self):
+        BlackoutDate.objects.create(date=self.start, reason='Inventory', product=self.busy)
+        BlackoutDate.objects.create(date=self.start + DAY, reason='Holiday')
+
+        self.assertEqual(
+            {pk: blacked_out for pk, (_, blacked_out) in self.search(self.start).items()},
+            {self.busy.pk: True, self.held.pk: False, self.idle.pk: False},
+        )
+        self.assertTrue(all(blacked_out for _, blacked_out in self.search(self.start + DAY).values()))
+        self.assertFalse(any(blacked_out for _, blacked_out in self.search(self.start + 2 * DAY).values()))
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class LedgerLockOrderTests(TestCase):
+    def locked_products(self, queries):
+        """Product of every ledger lock taken, in order"""
+        return [
+            int(re.search(r'"product_id" = (\d+)', query['sql'])[1])
+            for query in queries.captured_queries
+            if 'productdayoccupancy' in query['sql'] and 'FOR UPDATE' in query['sql']
+        ]
+
+    def test_moving_to_another_product_locks_in_product_order(self):
+        first = make_product(name='First Pod')
+        second = make_product(name='Second Pod')
+        # Starts earlier on the higher product id, so day order alone would
+        # lock the second product first
+        booking = book(second, date(2030, 3, 1), date(2030, 3, 10))
+        booking.product = first
+        booking.drop_off_date, booking.pickup_date = date(2030, 4, 1), date(2030, 4, 10)
+        with CaptureQueriesContext(connection) as queries:
+            booking.save()
+
+        locked = self.locked_products(queries)
+        self.assertEqual(sorted(locked), locked)
+        self.assertEqual(set(locked), {first.id, second.id})
+        self.assertEqual(rebuild_ledger([first.id, second.id], dry_run=True), [])
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class RebuildLedgerCommandTests(TestCase):
+    def setUp(self):
+        self.product = make_product()
+        self.start = date(2030, 3, 1)
+        book(self.product, self.start, self.start + 2 * DAY)
+        # A raw write the booking code never sees, as a crash or a manual fix would leave
+        ProductDayOccupancy.objects.filter(product=self.product, day=self.start + DAY).update(booked_units=5)
+
+    def run_command(self, *args):
+        out = StringIO()
+        call_command('rebuild_occupancy_ledger', *args, stdout=out)
+        return out.getvalue()
+
+    def test_verify_reports_drift_and_writes_nothing(self):
+        output = self.run_command('--verify', '--product', str(self.product.id))
+        self.assertIn(f'product {self.product.id} {self.start + DAY}: ledger=(5, 0) bookings=(1, 0)', output)
+        self.assertIn('1 drifted day(s)', output)
+        self.assertEqual(len(rebuild_ledger([self.product.id], dry_run=True)), 1)
+
+    def test_rebuild_repairs_under_the_day_locks(self):
+        with CaptureQueriesContext(connection) as queries:
+            output = self.run_command()
+        self.assertIn('Rebuilt ledger', output)
+        self.assertIn('1 drifted day(s)', output)
+        locks = [query['sql'] for query in queries.captured_queries if 'FOR UPDATE' in query['sql']]
+        self.assertTrue(locks and all('productdayoccupancy' in sql for sql in locks))
+        self.assertEqual(rebuild_ledger(dry_run=True), [])
+        self.assertIn('0 drifted day(s)', self.run_command('--verify'))
+
+
+class PricingTests(SimpleTestCase):
+    def test_to_cents_rounds_half_up(self):
+        cases = [
+            (Decimal('0.005'), 1),
+            (Decimal('0.0049'), 0),
+            (Decimal('1.005'), 101),
+            (Decimal('2.675'), 268),
+            # Floats go through str(), so 2.675 is not 2.67499999...
+            (2.675, 268),
+            (0.1 + 0.2, 30),
+            ('19.995', 2000),
+            (199, 19900),
+        ]
+        for amount, cents in cases:
+            with self.subTest(amount=amount):
+                self.assertEqual(to_cents(amount), cents)
+
+    def test_quote_in_exact_cents(self):
+        for rate, fee in ((Decimal('199.99'), Decimal('89.995')), (199.99, 89.995), ('199.99', '89.995')):
+            with self.subTest(rate=rate):
+                result = quote(rate, 3, fee)
+                self.assertEqual(result.monthly_cost_cents, 59997)
+                self.assertEqual(result.transport_fee_cents, 9000)
+                self.assertEqual(result.total, Decimal('689.97'))
+                self.assertEqual(str(result.monthly_rate), '199.99')
+
+    def test_shared_boundary_belongs_to_the_lower_tier(self):
+        table = FeeTable([(30, 100, Decimal('175')), (0, 30, Decimal('100')), (101, 999, Decimal('250'))])
+        product = Product(monthly_rate=Decimal('199.00'))
+        fees = {
+            distance: quote_for(product, 1, distance, fee_table=table).transport_fee
+            for distance in (None, 0, 30, 31, 100, 101, 999, 1000)
+        }
+        self.assertEqual(fees, {
+            None: Decimal('100.00'),
+            0: Decimal('100.00'),
+            30: Decimal('100.00'),
+            31: Decimal('175.00'),
+            100: Decimal('175.00'),
+            101: Decimal('250.00'),
+            999: Decimal('250.00'),
+            1000: DEFAULT_DISTANCE_FEE,
+        })
+
+    def test_quote_matrix_keys(self):
+        products = [Product(id=1, monthly_rate=Decimal('199.00')), Product(id=2, monthly_rate=Decimal('0.995'))]
+        table = FeeTable([(0, 30, Decimal('100')), (31, 999, Decimal('250'))])
+
+        quotes = quote_matrix(products, ['1', 12], distances=[10, 500], fee_table=table)
+        self.assertEqual(set(quotes), {
+            (product_id, months, distance)
+            for product_id in (1, 2) for months in (1, 12) for distance in (10, 500)
+        })
+        self.assertEqual(quotes[(1, 12, 500)].total, Decimal('2638.00'))
+        self.assertEqual(quotes[(2, 1, 10)], quote(Decimal('0.995'), 1, 100))
+
+        by_tier = quote_matrix(products, [1], fees={(0, 30): Decimal('100')})
+        self.assertEqual(set(by_tier), {(1, 1, (0, 30)), (2, 1, (0, 30))})
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class PricingCacheTests(TestCase):
+    def setUp(self):
+        # Saving bumps the cache versions, so no copy from an earlier test survives
+        with self.captureOnCommitCallbacks(execute=True):
+            self.pricing = PricingSetting.get_settings(cached=False)
+            self.pricing.save()
+            self.near = DistanceBasedFee.objects.create(min_distance_km=0, max_distance_km=30, fee=100)
+            DistanceBasedFee.objects.create(min_distance_km=31, max_distance_km=999, fee=250)
+
+    def test_warm_reads_run_no_queries(self):
+        PricingSetting.get_settings()
+        get_fee_table()
+        with self.assertNumQueries(0):
+            self.assertEqual(PricingSetting.get_settings().pk, self.pricing.pk)
+            self.assertEqual(get_fee_table().fee_for(50), Decimal('250'))
+
+    def test_saving_settings_reloads_the_copy(self):
+        PricingSetting.get_settings()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.pricing.transport_fee = Decimal('95.00')
+            self.pricing.save()
+        with self.assertNumQueries(1):
+            self.assertEqual(PricingSetting.get_settings().transport_fee, Decimal('95.00'))
+
+    def test_saving_a_tier_reloads_the_fee_table(self):
+        self.assertEqual(get_fee_table().fee_for(10), Decimal('100'))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.near.fee = 120
+            self.near.save()
+        with self.assertNumQueries(1):
+            self.assertEqual(get_fee_table().fee_for(10), Decimal('120'))
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class DistanceFeeValidationTests(TestCase):
+    def setUp(self):
+        DistanceBasedFee.objects.create(min_distance_km=0, max_distance_km=30, fee=100, description='Near')
+        self.middle = DistanceBasedFee.objects.create(
+            min_distance_km=31, max_distance_km=100, fee=175, description='Middle'
+        )
+        self.far = DistanceBasedFee.objects.create(
+            min_distance_km=100, max_distance_km=999, fee=250, description='Far'
+        )
+
+    def test_save_rejects_overlaps_and_gaps(self):
+        for min_km, max_km in ((20, 40), (1005, 1200), (50, 40)):
+            with self.subTest(tier=(min_km, max_km)), self.assertRaises(ValidationError):
+                DistanceBasedFee.objects.create(min_distance_km=min_km, max_distance_km=max_km, fee=1)
+        self.assertEqual(DistanceBasedFee.objects.count(), 3)
+
+    def test_changes_are_checked_against_the_other_active_tiers(self):
+        self.middle.is_active = False
+        with self.assertRaises(ValidationError):
+            self.middle.save()
+        # An inactive tier may overlap, and the last tier may be retired
+        DistanceBasedFee.objects.create(min_distance_km=0, max_distance_km=50, fee=1, is_active=False)
+        self.far.is_active = False
+        self.far.save()
+        self.far.max_distance_km = 500
+        self.far.is_active = True
+        self.far.full_clean()
 
-# Create your tests here.
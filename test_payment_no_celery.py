@@ -1,39 +1,47 @@
 # Test that payment works without Redis/Celery running
 # Run: python manage.py shell < test_payment_no_celery.py
 
-from notifications.utils import send_notification_safe
-from notifications.tasks import send_booking_confirmation
+from notifications.dispatch import broker_breaker, enqueue
+from notifications.models import NotificationKind
+from notifications.outbox import queue_notification
+from notifications.tasks import deliver_notification_outbox
 from bookings.models import Booking
 import logging
+import time
 
 logging.basicConfig(level=logging.DEBUG)
 
 print("Testing notification fallback mechanism...")
 print("=" * 60)
 
-# Test 1: Try calling send_notification_safe with a fake booking ID
-print("\nTest 1: Sending notification without Celery running")
+# Test 1: Try publishing the delivery task without a broker
+print("\nTest 1: Publishing the outbox task without Celery running")
 print("-" * 60)
 
 try:
-    # This will fail because booking doesn't exist, but it tests the fallback mechanism
-    result = send_notification_safe(send_booking_confirmation, 999)
-    print(f"✓ Notification system handled gracefully: {result}")
+    started = time.monotonic()
+    result = enqueue(deliver_notification_outbox)
+    print(f"✓ Broker handled gracefully: queued={result} in {time.monotonic() - started:.2f}s, "
+          f"breaker {broker_breaker.state}")
 except Exception as e:
     print(f"✗ Unexpected error: {e}")
 
-print("\nTest 2: Checking if notifications can be sent synchronously")
+print("\nTest 2: Checking that a queued notification is delivered in-process")
 print("-" * 60)
 
 # Get a real booking if exists
 booking = Booking.objects.first()
 if booking:
     print(f"Found booking: {booking.booking_id}")
-    result = send_notification_safe(send_booking_confirmation, booking.id)
-    print(f"✓ Notification result: {result}")
+    # Outside a transaction the nudge runs at once; with the breaker open
+    # it hands the outbox to the fallback pool
+    row = queue_notification(NotificationKind.BOOKING_CONFIRMATION, booking)
+    time.sleep(5)
+    row.refresh_from_db()
+    print(f"✓ Notification result: email={row.email_status} sms={row.sms_status}")
 else:
     print("No bookings in database - test skipped")
 
 print("\n" + "=" * 60)
 print("Payment will ALWAYS succeed regardless of notification status")
-print("Notifications will try: Celery → Synchronous → Log failure")
+print("Notifications will try: Celery → in-process fallback pool → outbox retry")